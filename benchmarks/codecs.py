@@ -0,0 +1,97 @@
+"""
+Vector codecs (f32 / f16 / sq8 / pq) side by side: index memory per million chunks, recall@k against exact
+search with and without re-ranking on the full precision vectors, and search latency.
+
+    python -m benchmarks.codecs --chunks 100000 --queries 200 --index-type flat
+
+Vectors are HashingEmbedder embeddings of the synthetic corpus, so no API is called. The exact vectors are
+written to a temp file and read back memory-mapped for rescoring, the way a persisted partition does it.
+"""
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import faiss, numpy as np
+
+from classes.index_types import CODECS, build_index
+from classes.partition import Partition
+from utils import HashingEmbedder, iter_chunks
+
+from . import fakes
+
+
+def corpus_vectors(n_chunks: int, dimension: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    chunks = [c for _, _, text in fakes.synthetic_corpus(n_chunks, 1, seed=seed) for c in iter_chunks(text)]
+    embedder = HashingEmbedder(dimension)
+    vectors = np.concatenate([embedder.encode(chunks[i:i + 4096]) for i in range(0, len(chunks), 4096)])
+    # queries: a few words out of random chunks, so they sit near but not on stored vectors
+    rng = np.random.default_rng(seed + 1)
+    picks = rng.choice(len(chunks), size=min(len(chunks), 1000), replace=False)
+    queries = embedder.encode([' '.join(rng.permutation(chunks[i].split())[:8]) for i in picks])
+    return vectors, queries
+
+
+def recall(found: np.ndarray, query: np.ndarray, vectors: np.ndarray, kth: float) -> int:
+    # tie aware: a returned row counts if it is as close as the exact k-th neighbour (near duplicate chunks tie)
+    found = found[found >= 0]
+    distances = faiss.pairwise_distances(query[None, :], np.ascontiguousarray(vectors[np.sort(found)]))[0]
+    return int((distances <= kth * (1 + 1e-4) + 1e-6).sum())
+
+
+def bench_codec(codec: str, kind: str, vectors: np.ndarray, raw, queries: np.ndarray, kth: np.ndarray,
+                k: int, rescores: list[int]) -> dict:
+    with fakes.Timer() as build:
+        index = build_index(kind, vectors, codec)
+    partition = Partition(vectors.shape[1], base=index, vectors=lambda rows: raw[:rows])
+    index_bytes = len(faiss.serialize_index(index))
+
+    report = {'build_seconds': round(build.elapsed, 2), 'bytes_per_vector': round(index_bytes / len(vectors), 1),
+              'mb_per_million_chunks': round(index_bytes / len(vectors) * 1e6 / 2 ** 20, 1)}
+    for factor in [0] + rescores:
+        latencies, hits = [], 0
+        for query, distance in zip(queries, kth):
+            start = time.perf_counter()
+            _, indices = partition.search(query[None, :], k, factor)
+            latencies.append((time.perf_counter() - start) * 1000)
+            hits += recall(indices[0], query, vectors, distance)
+        report[f'rescore{factor}' if factor else 'raw'] = {f'recall@{k}': round(hits / (len(queries) * k), 4),
+                                                          'latency_ms': fakes.percentiles(latencies)}
+        if codec == 'f32': # nothing to re-rank
+            break
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=100_000)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--rescore', type=int, nargs='+', default=[4, 16],
+                        help='candidates per result re-ranked on exact vectors, one run per factor')
+    parser.add_argument('--index-type', default='flat', choices=('flat', 'hnsw', 'ivf_flat'))
+    parser.add_argument('--codecs', nargs='+', default=list(CODECS), choices=CODECS)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    vectors, queries = corpus_vectors(args.chunks, args.dimension, args.seed)
+    queries = queries[:args.queries]
+    kth = faiss.knn(queries, vectors, args.k)[0][:, -1] # exact distance of each query's k-th neighbour
+
+    with tempfile.TemporaryDirectory(prefix='bench-codecs-') as tmp:
+        path = Path(tmp) / 'vectors.f32'
+        vectors.tofile(path)
+        raw = np.memmap(path, dtype='float32', mode='r', shape=vectors.shape)
+        results = {'chunks': len(vectors), 'dimension': args.dimension, 'index_type': args.index_type,
+                   'text_bytes_per_chunk': 300, 'codecs': {}}
+        for codec in args.codecs:
+            results['codecs'][codec] = bench_codec(codec, args.index_type, vectors, raw, queries, kth,
+                                                   args.k, args.rescore)
+        del raw
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Diffs two benchmarks.hot_paths result files and flags regressions beyond --threshold (exit status 1 if any).
+
+    python -m benchmarks.compare base.json head.json --threshold 0.1
+"""
+import argparse
+import json
+import sys
+
+
+def flatten(metrics: dict, prefix: str = '') -> dict[str, float]:
+    flat = {}
+    for key, value in metrics.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + '.'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def higher_is_better(name: str) -> bool:
+    return 'per_sec' in name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change that counts as a regression')
+    args = parser.parse_args()
+
+    base, head = (json.load(open(path)) for path in (args.base, args.head))
+    old, new = flatten(base['metrics']), flatten(head['metrics'])
+    print(f"base {base.get('git_commit')}  head {head.get('git_commit')}")
+    differing = {k for k in base['params'].keys() | head['params'].keys()
+                 if k != 'out' and base['params'].get(k) != head['params'].get(k)}
+    if differing:
+        print(f"warning: runs used different parameters ({', '.join(sorted(differing))}), deltas aren't like for like")
+
+    regressions = []
+    for name in sorted(old.keys() & new.keys()):
+        change = (new[name] - old[name]) / old[name] if old[name] else 0.0
+        worse = -change if higher_is_better(name) else change
+        # counts (chunks, vectors, calls) aren't better or worse, they only say the runs were comparable
+        flag = ''
+        if any(unit in name for unit in ('per_sec', '_ms', 'bytes', 'rss', 'seconds')) and worse > args.threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+        print(f"{name:45} {old[name]:>14,.3f} {new[name]:>14,.3f} {change:+8.1%}{flag}")
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""
+Cross-user dedup (Faiss(dedup=True)) against one partition per user when many users upload the same
+documents: vectors stored, their bytes, add throughput and query latency.
+
+    python -m benchmarks.dedup --chunks 20000 --users 50 --overlap 0.8
+
+Every user uploads `overlap` of a common corpus plus their own private share. Vectors are HashingEmbedder
+embeddings, computed once up front so only the index side is timed; no API is called.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from classes import Faiss
+from utils import HashingEmbedder, iter_chunks, runner
+
+from . import fakes
+
+
+def uploads(n_chunks: int, n_users: int, overlap: float, embedder: HashingEmbedder, seed: int):
+    """Yields (username, file_name, embedded chunks) per upload, shared documents first."""
+    common = [(name, text) for _, name, text in fakes.synthetic_corpus(int(n_chunks * overlap), 1, seed=seed)]
+    private = list(fakes.synthetic_corpus(int(n_chunks * (1 - overlap)) * n_users, n_users, seed=seed + 1))
+    embedded = {}
+    for user in range(n_users):
+        files = common + [(f"own-{name}", text) for owner, name, text in private if owner == f"user{user}"]
+        for name, text in files:
+            if name not in embedded:
+                chunks = list(iter_chunks(text))
+                embedded[name] = list(zip(chunks, embedder.encode(chunks)))
+            yield f"user{user}", name, [{'values': vector, 'metadata': {'text': chunk, 'file_name': name}}
+                                        for chunk, vector in embedded[name]]
+
+
+def bench(dedup: bool, args, embedder: HashingEmbedder, queries: np.ndarray) -> dict:
+    faiss_agent = Faiss(embedder=embedder, dedup=dedup)
+    chunks = 0
+    with fakes.Timer() as add:
+        for username, file_name, embedded in uploads(args.chunks, args.users, args.overlap, embedder, args.seed):
+            faiss_agent.add_embedded(username, embedded, replace_file=file_name)
+            chunks += len(embedded)
+
+    partitions = faiss_agent.partitions.values()
+    latencies = []
+    for i, query in enumerate(queries):
+        start = time.perf_counter()
+        runner.run(faiss_agent.query(texts='', user_id=f"user{i % args.users}", top_k=args.k,
+                                     query_vector=query))
+        latencies.append((time.perf_counter() - start) * 1000)
+    vectors = sum(p.ntotal for p in partitions)
+    return {'chunks_uploaded': chunks, 'vectors': vectors,
+            'vector_mb': round(vectors * embedder.dimension * 4 / 2 ** 20, 1),
+            'metadata_mb': round(sum(p.info.nbytes() for p in partitions) / 2 ** 20, 1),
+            'add_chunks_per_sec': round(chunks / add.elapsed, 1), 'query_ms': fakes.percentiles(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20_000, help='chunks each user uploads')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--overlap', type=float, default=0.8, help='share of every upload that is common')
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    embedder = HashingEmbedder(args.dimension)
+    rng = np.random.default_rng(args.seed)
+    queries = embedder.encode([' '.join(rng.choice(fakes.VOCAB, size=8)) for _ in range(args.queries)])
+    results = {'users': args.users, 'chunks_per_user': args.chunks, 'overlap': args.overlap,
+               'per_user': bench(False, args, embedder, queries), 'dedup': bench(True, args, embedder, queries)}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
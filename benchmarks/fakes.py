@@ -0,0 +1,101 @@
+"""Deterministic local stand-ins for the Gemini embedder and the Groq LLM, with injectable latency."""
+import asyncio
+import hashlib
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import numpy as np
+
+VOCAB = [f"{stem}{i}" for stem in ('data', 'model', 'index', 'query', 'user', 'page', 'vector', 'token') for i in range(500)]
+
+
+def fake_vector(text: str, dimension: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), 'little')
+    return np.random.default_rng(seed).standard_normal(dimension, dtype='float32')
+
+
+class FakeEmbedder():
+    """Drop-in for gemini_embed: same text -> same vector, `latency` seconds per request."""
+
+    def __init__(self, dimension: int = 768, latency: float = 0.0):
+        self.dimension = dimension
+        self.latency = latency
+        self.calls = 0
+
+    async def __call__(self, texts: list[str], method: str, model: str | None = None, **kwargs) -> list[list[float]]:
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return [fake_vector(text, self.dimension).tolist() for text in texts]
+
+
+class FakeGroq():
+    """Drop-in for AsyncGroq in groq_generate: streams `tokens` words, first after `ttft`, then one per `per_token`."""
+
+    def __init__(self, tokens: int = 200, ttft: float = 0.0, per_token: float = 0.0):
+        self.tokens = tokens
+        self.ttft = ttft
+        self.per_token = per_token
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, *, messages: list[dict], stream: bool = True, **kwargs):
+        seed = int.from_bytes(hashlib.blake2b(messages[-1]['content'].encode(), digest_size=8).digest(), 'little')
+        words = np.random.default_rng(seed).choice(VOCAB, size=self.tokens).tolist()
+
+        async def chunks():
+            await asyncio.sleep(self.ttft)
+            for word in words:
+                if self.per_token:
+                    await asyncio.sleep(self.per_token)
+                yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=word + ' '))])
+        return chunks()
+
+
+def install(embedder: FakeEmbedder, *, max_in_flight: int = 8, batch_size: int = 10, cache_dir: str | None = None):
+    """
+    Points utils' embedding path at `embedder`, with a fresh embedding cache (so ingest numbers are cold).
+    Returns the temp dir holding the cache when none was given.
+    """
+    import utils.utils as utils_
+    from utils.cache import EmbeddingCache
+    from utils.embed_engine import EmbeddingEngine
+
+    tmp = None
+    if cache_dir is None:
+        tmp = tempfile.TemporaryDirectory(prefix='bench-cache-')
+        cache_dir = tmp.name
+    utils_.embedding_cache = EmbeddingCache(Path(cache_dir) / 'embeddings.sqlite')
+    utils_.embedding_engine = EmbeddingEngine(embedder, batch_size=batch_size, max_in_flight=max_in_flight,
+                                              progress=False)
+    return tmp
+
+
+WORDS_PER_CHUNK = 23 # of VOCAB words, per 300-char chunk (measured)
+
+
+def synthetic_corpus(n_chunks: int, n_users: int, chunks_per_doc: int = 50, seed: int = 0):
+    """Yields (username, file_name, text) documents that chunk into about n_chunks chunks spread over n_users."""
+    rng = np.random.default_rng(seed)
+    words_per_doc = max(40, chunks_per_doc * WORDS_PER_CHUNK // 40 * 40)
+    n_docs = max(1, n_chunks // chunks_per_doc)
+    for doc in range(n_docs):
+        paragraphs = rng.choice(VOCAB, size=words_per_doc).reshape(-1, 40)
+        text = '\n\n'.join(' '.join(p) + '.' for p in paragraphs)
+        yield f"user{doc % n_users}", f"doc{doc}.txt", text
+
+
+def percentiles(samples: list[float], points=(50, 95, 99)) -> dict[str, float]:
+    if not samples:
+        return {}
+    return {f"p{p}": round(float(np.percentile(samples, p)), 3) for p in points}
+
+
+class Timer():
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
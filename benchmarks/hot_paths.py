@@ -0,0 +1,181 @@
+"""
+Offline benchmark of the ingest and query hot paths: langchain_chunk, batch_embed_text, Faiss.upsert_doc,
+Faiss.query and groq_generate, with the fake embedder/LLM from benchmarks.fakes standing in for Gemini and Groq.
+No API keys or secrets file needed.
+
+    python -m benchmarks.hot_paths --chunks 100000 --users 50 --embed-latency-ms 40 --out results.json
+    python -m benchmarks.compare old.json new.json
+
+Results are JSON (git commit, parameters, metrics) so runs on two commits can be diffed with benchmarks.compare.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import resource
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from . import fakes
+
+
+def _peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # KB on Linux
+
+
+def _git_commit() -> str | None:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def _dir_bytes(path: Path) -> int:
+    return sum(f.stat().st_size for f in path.rglob('*') if f.is_file())
+
+
+async def bench_chunk(docs: list[str]) -> dict:
+    from utils import langchain_chunk
+    chunks = 0
+    with fakes.Timer() as t:
+        for text in docs:
+            chunks += len(await langchain_chunk(text, 300, 20))
+    chars = sum(map(len, docs))
+    return {'chunks': chunks, 'seconds': round(t.elapsed, 3), 'chunks_per_sec': round(chunks / t.elapsed, 1),
+            'mb_per_sec': round(chars / 1e6 / t.elapsed, 2)}
+
+
+async def bench_embed(texts: list[str], embedder=None) -> dict:
+    from utils.utils import batch_embed_text
+    with fakes.Timer() as cold:
+        await batch_embed_text(texts, method='RETRIEVAL_DOCUMENT', embedder=embedder)
+    with fakes.Timer() as warm: # same texts again: served from the embedding cache (when the embedder is cached)
+        await batch_embed_text(texts, method='RETRIEVAL_DOCUMENT', embedder=embedder)
+    return {'texts': len(texts), 'cold_per_sec': round(len(texts) / cold.elapsed, 1),
+            'cached_per_sec': round(len(texts) / warm.elapsed, 1)}
+
+
+async def bench_ingest(faiss_agent, corpus: list[tuple[str, str, str]]) -> dict:
+    with fakes.Timer() as t:
+        for username, file_name, text in corpus:
+            await faiss_agent.upsert_doc(text, username, {"file_name": file_name})
+    chunks = sum(p.ntotal for p in faiss_agent.partitions.values())
+    return {'chunks': chunks, 'seconds': round(t.elapsed, 3), 'chunks_per_sec': round(chunks / t.elapsed, 1)}
+
+
+async def bench_query(faiss_agent, n_queries: int, top_k: int, mode: str, seed: int) -> dict:
+    rng = np.random.default_rng(seed)
+    users = sorted(faiss_agent.partitions)
+    latencies = []
+    for i in range(n_queries):
+        text = ' '.join(rng.choice(fakes.VOCAB, size=8)) + f' q{i}' # unique, so every query embeds
+        with fakes.Timer() as t:
+            await faiss_agent.query(texts=text, user_id=users[i % len(users)], top_k=top_k, mode=mode)
+        latencies.append(t.elapsed * 1000)
+    return {'queries': n_queries, 'mode': mode, 'latency_ms': fakes.percentiles(latencies)}
+
+
+async def bench_generate(llm: fakes.FakeGroq, n_calls: int, passages: list[str]) -> dict:
+    from utils.utils import groq_generate
+    ttft, total = [], []
+    for i in range(n_calls):
+        start = time.perf_counter()
+        first = None
+        async for _ in groq_generate(query=f"\nPrevious interactions: \nCurrent Query: question {i}",
+                                     relevant_passage=passages, client=llm):
+            first = first or time.perf_counter()
+        ttft.append(((first or time.perf_counter()) - start) * 1000)
+        total.append((time.perf_counter() - start) * 1000)
+    return {'calls': n_calls, 'ttft_ms': fakes.percentiles(ttft), 'total_ms': fakes.percentiles(total)}
+
+
+async def run(args) -> dict:
+    from classes import Faiss
+    from utils import HashingEmbedder
+
+    # --embedder hashing runs the real offline backend instead of the fake remote one
+    backend = HashingEmbedder(args.dimension) if args.embedder == 'hashing' else None
+    embedder = fakes.FakeEmbedder(dimension=args.dimension, latency=args.embed_latency_ms / 1000)
+    cache_tmp = fakes.install(embedder, max_in_flight=args.max_in_flight)
+    store_tmp = tempfile.TemporaryDirectory(prefix='bench-store-') if args.persist else None
+
+    corpus = list(fakes.synthetic_corpus(args.chunks, args.users, seed=args.seed))
+    results = {
+        'git_commit': _git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'metrics': {},
+        'params': {k: str(v) if isinstance(v, Path) else v for k, v in vars(args).items()},
+    }
+    metrics = results['metrics']
+
+    sample = [text for _, _, text in corpus[:args.sample_docs]]
+    metrics['langchain_chunk'] = await bench_chunk(sample)
+    from utils import iter_chunks
+    metrics['batch_embed_text'] = await bench_embed([c for text in sample[:2] for c in iter_chunks(text)], backend)
+
+    faiss_agent = Faiss(persist_dir=store_tmp.name if store_tmp else None, index_type=args.index_type,
+                        promote_at=args.promote_at, embedder=backend, codec=args.codec)
+    metrics['upsert_doc'] = await bench_ingest(faiss_agent, corpus)
+    metrics['upsert_doc']['embed_calls'] = embedder.calls
+    metrics['peak_rss_mb_after_ingest'] = round(_peak_rss_mb(), 1)
+
+    metrics['query'] = await bench_query(faiss_agent, args.queries, args.top_k, args.mode, args.seed)
+    passages = [faiss_agent.partitions['user0'].info.text(row) for row in range(5)]
+    metrics['groq_generate'] = await bench_generate(
+        fakes.FakeGroq(tokens=args.llm_tokens, ttft=args.llm_ttft_ms / 1000, per_token=args.llm_token_ms / 1000),
+        args.generate_calls, passages)
+
+    partitions = faiss_agent.partitions.values()
+    metrics['index'] = {
+        'partitions': len(faiss_agent.partitions),
+        'vectors': sum(p.ntotal for p in partitions),
+        'metadata_bytes': sum(p.info.nbytes() for p in partitions),
+        'bytes': (_dir_bytes(Path(store_tmp.name)) if store_tmp else
+                  sum(p.vectors().nbytes + p.info.nbytes() for p in partitions)),
+    }
+    metrics['peak_rss_mb'] = round(_peak_rss_mb(), 1)
+
+    for tmp in (cache_tmp, store_tmp):
+        if tmp is not None:
+            tmp.cleanup()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=10_000, help='corpus size, 1k .. 1M')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--dimension', type=int, default=768)
+    parser.add_argument('--embedder', default='fake', choices=('fake', 'hashing'),
+                        help='fake: gemini stand-in through the embedding engine, hashing: offline HashingEmbedder')
+    parser.add_argument('--embed-latency-ms', type=float, default=0.0, help='per embedding request')
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--llm-ttft-ms', type=float, default=0.0)
+    parser.add_argument('--llm-token-ms', type=float, default=0.0)
+    parser.add_argument('--llm-tokens', type=int, default=200)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--mode', default='dense', choices=('dense', 'hybrid', 'lexical'))
+    parser.add_argument('--generate-calls', type=int, default=50)
+    parser.add_argument('--sample-docs', type=int, default=20, help='docs used for the chunk/embed microbenchmarks')
+    parser.add_argument('--index-type', default='flat')
+    parser.add_argument('--promote-at', type=int, default=50_000)
+    parser.add_argument('--codec', default='f32', choices=('f32', 'f16', 'sq8', 'pq'))
+    parser.add_argument('--persist', action='store_true', help='use an on-disk IndexStore (temp dir)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', type=Path, help='write the JSON results here as well')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    if args.out is not None:
+        args.out.parent.mkdir(parents=True, exist_ok=True)
+        args.out.write_text(json.dumps(results, indent=2))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,106 @@
+"""
+Dense vs BM25 vs hybrid retrieval on a synthetic corpus: hit rate / MRR at k, and per-query latency.
+
+    python -m benchmarks.retrieval --chunks 20000 --queries 500
+
+Chunks are built from topic words plus a unique part number each. Two kinds of query:
+  keyword    a chunk's part number plus one of its words (what dense search is bad at)
+  paraphrase half a chunk's words, with every word swapped for a synonym (what BM25 is bad at)
+
+Vectors come from a local hashed bag-of-words embedder in which synonyms share a direction, standing in for a
+real embedding model, so no API is called. Dense and hybrid queries pay one embedding round trip on top of the
+search in the app; that is added as --rtt-ms rather than measured.
+"""
+import argparse
+import asyncio
+import json
+import time
+import zlib
+
+import numpy as np
+
+from classes import Faiss
+
+DIM = 256
+
+
+_word_vectors: dict[str, np.ndarray] = {}
+
+
+def embed(text: str, synonyms: dict[str, str]) -> list[float]:
+    vector = np.zeros(DIM, dtype='float32')
+    for word in text.lower().split():
+        word = synonyms.get(word, word)
+        if word not in _word_vectors:
+            _word_vectors[word] = np.random.default_rng(zlib.crc32(word.encode())).standard_normal(DIM, dtype='float32')
+        vector += _word_vectors[word]
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def build_corpus(n_chunks: int, rng: np.random.Generator):
+    vocab = [f"w{i}" for i in range(3000)]
+    synonyms = {f"s{i}": f"w{i}" for i in range(3000)} # s<i> means the same as w<i>
+    chunks = []
+    for i in range(n_chunks):
+        words = rng.choice(vocab, size=rng.integers(20, 50)).tolist()
+        words.insert(int(rng.integers(len(words))), f"pn-{i:06d}")
+        chunks.append(' '.join(words))
+    return chunks, synonyms
+
+
+def build_queries(chunks: list[str], n_queries: int, rng: np.random.Generator):
+    queries = []
+    for target in rng.choice(len(chunks), size=n_queries, replace=False).tolist():
+        words = [w for w in chunks[target].split() if not w.startswith('pn-')]
+        if len(queries) % 2:
+            picked = rng.choice(words, size=len(words) // 2, replace=False)
+            queries.append(('paraphrase', ' '.join('s' + w[1:] for w in picked), target))
+        else:
+            queries.append(('keyword', f"pn-{target:06d} {rng.choice(words)}", target))
+    return queries
+
+
+async def run(args):
+    rng = np.random.default_rng(args.seed)
+    chunks, synonyms = build_corpus(args.chunks, rng)
+    queries = build_queries(chunks, args.queries, rng)
+
+    faiss_agent = Faiss()
+    embedded = [{'id': None, 'values': embed(text, synonyms),
+                 'metadata': {'text': text, 'user_id': 'bench', 'file_name': f'doc{i // 100}'}}
+                for i, text in enumerate(chunks)]
+    faiss_agent.add_embedded('bench', embedded)
+    faiss_agent.partitions['bench'].lexical # build outside the timed region
+
+    report = {'chunks': args.chunks, 'queries': args.queries, 'k': args.k, 'rtt_ms': args.rtt_ms, 'modes': {}}
+    for mode in ('dense', 'lexical', 'hybrid'):
+        latencies, ranks = [], {'keyword': [], 'paraphrase': []}
+        for kind, text, target in queries:
+            vector = None if mode == 'lexical' else np.asarray([embed(text, synonyms)], dtype='float32')
+            start = time.perf_counter()
+            results = await faiss_agent.query(texts=text, user_id='bench', top_k=args.k, query_vector=vector, mode=mode)
+            latencies.append((time.perf_counter() - start) * 1000)
+            ids = [r['id'] for r in results or []]
+            ranks[kind].append(ids.index(target) + 1 if target in ids else None) # vector ids follow insertion order
+
+        search_ms = np.asarray(latencies)
+        e2e = search_ms + (0 if mode == 'lexical' else args.rtt_ms)
+        report['modes'][mode] = {
+            'search_ms_p50': round(float(np.percentile(search_ms, 50)), 3),
+            'search_ms_p95': round(float(np.percentile(search_ms, 95)), 3),
+            'end_to_end_ms_p50': round(float(np.percentile(e2e, 50)), 3),
+            **{f'{kind}_hit@{args.k}': round(sum(r is not None for r in rs) / len(rs), 3) for kind, rs in ranks.items()},
+            **{f'{kind}_mrr': round(sum(1 / r for r in rs if r) / len(rs), 3) for kind, rs in ranks.items()},
+        }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chunks', type=int, default=20_000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--rtt-ms', type=float, default=120.0, help='embedding round trip dense/hybrid pay')
+    parser.add_argument('--seed', type=int, default=0)
+    print(json.dumps(asyncio.run(run(parser.parse_args())), indent=2))
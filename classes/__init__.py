@@ -1 +1,4 @@
-from .faiss_ import Faiss
\ No newline at end of file
+from .faiss_ import Faiss
+from .store import IndexStore
+from .answer_cache import AnswerCache
+from .retrieval import RetrievalServer, RetrievalClient
\ No newline at end of file
@@ -0,0 +1,88 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+
+@dataclass
+class CachedAnswer():
+    vector: np.ndarray # unit-normalised query embedding
+    chunk_ids: frozenset[int] # vector ids the answer was generated from
+    files: frozenset[str]
+    answer: str
+    created: float = field(default_factory=time.monotonic)
+
+
+class AnswerCache():
+    """
+    Semantic cache of generated answers. A lookup hits when the same user asks a question whose embedding is
+    within `threshold` cosine similarity of a cached one *and* retrieval came back with the same chunk ids,
+    so the answer was generated from exactly the context the new question would get.
+
+    Entries expire after `ttl` seconds, the least recently used go first once there are more than
+    `max_entries`, and everything generated from a file is dropped when that file is replaced or deleted
+    (hook `invalidate` up to Faiss.on_change).
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 24 * 3600, max_entries: int = 10_000):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: OrderedDict[tuple[str, int], CachedAnswer] = OrderedDict()
+        self._by_user: dict[str, set[int]] = {}
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _normalise(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype='float32').ravel()
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _drop(self, key: tuple[str, int]):
+        self._entries.pop(key, None)
+        self._by_user.get(key[0], set()).discard(key[1])
+
+    def get(self, user_id: str, vector, chunk_ids) -> str | None:
+        vector, chunk_ids = self._normalise(vector), frozenset(chunk_ids)
+        now = time.monotonic()
+        with self._lock:
+            keys = [(user_id, k) for k in self._by_user.get(user_id, ())]
+            for key in keys:
+                if now - self._entries[key].created > self.ttl:
+                    self._drop(key)
+
+            candidates = [key for key in keys if key in self._entries and self._entries[key].chunk_ids == chunk_ids]
+            if candidates:
+                matrix = np.stack([self._entries[key].vector for key in candidates])
+                scores = matrix @ vector
+                best = int(np.argmax(scores))
+                if scores[best] >= self.threshold:
+                    self._entries.move_to_end(candidates[best])
+                    self.hits += 1
+                    return self._entries[candidates[best]].answer
+
+            self.misses += 1
+            return None
+
+    def put(self, user_id: str, vector, chunk_ids, files, answer: str):
+        if not answer:
+            return
+        entry = CachedAnswer(self._normalise(vector), frozenset(chunk_ids), frozenset(files), answer)
+        with self._lock:
+            key = (user_id, self._next_key)
+            self._next_key += 1
+            self._entries[key] = entry
+            self._by_user.setdefault(user_id, set()).add(key[1])
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+
+    def invalidate(self, user_id: str, file_name: str):
+        with self._lock:
+            for k in list(self._by_user.get(user_id, ())):
+                if file_name in self._entries[(user_id, k)].files:
+                    self._drop((user_id, k))
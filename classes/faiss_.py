@@ -1,84 +1,501 @@
 import faiss, numpy as np
+import logging
+import threading
+from typing import Callable
 
-from utils import  batch_embed_text, langchain_chunk
+from utils import  Embedder, batch_embed_text, default_embedder, embed_chunks, embedder_spec, iter_chunks, tracer
+from .index_types import INDEX_TYPES, build_index, normalize_codec, recall_at_k
+from .lexical import reciprocal_rank_fusion
+from .metadata import ChunkStore
+from .partition import Partition, remap_rows
+from .shared import SharedChunks, chunk_digest
+from .store import IndexStore
+
+logger = logging.getLogger(__name__)
+
+# dense: vectors only, lexical: BM25 only (no embedding call at all), hybrid: both fused by reciprocal rank
+RETRIEVAL_MODES = ('dense', 'hybrid', 'lexical')
+HYBRID_DEPTH = 4 # hybrid fuses top_k * HYBRID_DEPTH candidates from each side
+SHARED_PARTITION = 'shared' # with dedup, the one partition every user's chunks go to
 
 
 
 class Faiss():
     
-    def __init__(self): 
-        self.index = None
-        self.embedded_info = [] # This will store the list of dicts {id, values, metadata}
+    def __init__(self, persist_dir: str | None = None, snapshot_every: int = 5000,
+                 index_type: str = 'flat', promote_at: int = 50_000, compact_ratio: float = 0.2,
+                 embedder: Embedder | None = None, codec: str = 'f32', rescore: int = 4, dedup: bool = False): 
+        # every username gets its own partition, so a query only ever scans that user's vectors ...
+        self.partitions: dict[str, Partition] = {}
+        # documents and queries are embedded by the same backend (gemini unless told otherwise)
+        self.embedder = embedder or default_embedder()
         self.dimension = None # To store the dimension of embeddings
+        self.next_id = 0 # stable vector ids, they survive compaction and restarts
+        self._lock = threading.Lock()
+        # called with (username, file_name) whenever a file's chunks are deleted or replaced
+        self.on_change: list[Callable[[str, str], None]] = []
+
+        # deleted/replaced chunks are tombstoned, a partition is compacted once this share of it is dead
+        self.compact_ratio = compact_ratio
+
+        # partitions start as exact flat indexes and get rebuilt as `index_type` once they reach promote_at vectors
+        if index_type not in INDEX_TYPES:
+            raise ValueError(f"Unknown index type {index_type!r}, expected one of {INDEX_TYPES}")
+        self.index_type = index_type
+        self.promote_at = promote_at
+
+        # ... storing their vectors as `codec` (f16 / sq8 / pq shrink the index 2x / 4x / 64x at 768 dims); a
+        # compressed search fetches top_k * rescore candidates and re-ranks them on the exact vectors
+        # (normalised to what the index really stores, so it compares equal to a promoted partition's codec)
+        self.codec = normalize_codec(index_type, codec)
+        self.rescore = rescore
+
+        # ... unless dedup is on: then there is one shared partition, each distinct chunk text is stored and
+        # searched once however many users uploaded it, and a query only looks at the chunks its user references
+        self.shared: SharedChunks | None = None
+
+        # with a persist_dir every upsert is logged to disk and a restart reopens the snapshots memory-mapped
+        self.store = IndexStore(persist_dir, snapshot_every, embedder=embedder_spec(self.embedder),
+                                dedup=dedup) if persist_dir else None
+        if dedup:
+            self.shared = SharedChunks(self.store.shared_dir if self.store is not None else None)
+        if self.store is not None:
+            self.dimension = self.store.dimension
+            self.partitions = self.store.load()
+            for username, partition in self.partitions.items():
+                if len(partition.info):
+                    self.next_id = max(self.next_id, partition.info.vector_id(-1) + 1)
+                self._maybe_promote(username, partition)
+            if self.shared is not None:
+                self._index_shared()
+
+    def _index_shared(self):
+        # digests of the shared partition's live chunks, and a sweep for chunks a crash left unreferenced
+        partition = self.partitions.get(SHARED_PARTITION)
+        if partition is None:
+            return
+        ids = partition.info.rows['id']
+        live = np.setdiff1d(np.arange(len(ids)), np.fromiter(partition.dead, dtype='int64', count=len(partition.dead)))
+        referenced = self.shared.referenced(ids[live])
+        for row in live[referenced].tolist():
+            self.shared.digests[chunk_digest(partition.info.text(row))] = int(ids[row])
+        self._drop_shared(partition, ids[live[~referenced]].tolist())
+
+    def _drop_shared(self, partition: Partition, vector_ids: list[int]):
+        # tombstones shared chunks nobody references any more; the caller holds partition.lock
+        if not vector_ids:
+            return
+        rows = partition.info.find(sorted(vector_ids)).tolist()
+        for row in rows:
+            self.shared.digests.pop(chunk_digest(partition.info.text(row)), None)
+        if self.store is not None:
+            self.store.append_tombstones(SHARED_PARTITION, rows)
+        partition.tombstone(rows)
+
+    def _searchable(self, username: str) -> Partition | None:
+        """The partition holding the user's chunks, if they have any live ones."""
+        if self.shared is None:
+            partition = self.partitions.get(username)
+            return partition if partition is not None and partition.live else None
+        return self.partitions.get(SHARED_PARTITION) if len(self.shared.visible(username)) else None
+
+    def has_chunks(self, username: str) -> bool:
+        """Whether a query for this user can find anything, checked before paying for the query embedding."""
+        return self._searchable(username) is not None
+
+    def _scope(self, username: str) -> tuple | None:
+        return self.shared.scope(username) if self.shared is not None else None
+
+    def users(self) -> list[str]:
+        return list(self.partitions) if self.shared is None else self.shared.usernames()
     
-    # uses google's embeddings.      
+    # uses self.embedder (google's embeddings by default)
     async def _get_embed_vals(self, texts:str, username:str,  embed_method : str, metadata: dict):
         
-        chunks: list[str] = await langchain_chunk(texts, 300, 20)
-        embedded = await batch_embed_text( chunks, method = embed_method, id = username, metadata = metadata)
-        
-        embed_mat = np.zeros((len(chunks), len(embedded[0]['values'])))  # assuming all have same dim
+        embedded = await embed_chunks(iter_chunks(texts), method = embed_method, id = username, metadata = metadata,
+                                      embedder = self.embedder)
 
-        for i, doc in enumerate(embedded):
-            embed_mat[i] = np.array(doc['values'])
+        return self._to_matrix(embedded), embedded
 
-        return embed_mat, embedded
+    @staticmethod
+    def _to_matrix(embedded: list[dict]) -> np.ndarray:
+        # one C-level conversion straight to float32, faiss's type, instead of a float64 matrix filled row by row
+        return np.asarray([doc['values'] for doc in embedded], dtype='float32')
   
  
     # Faiss only allows upserting embed values 
     
-    async def upsert_doc(self, texts:str, username:str, metadata: dict, embed_method : str = "RETRIEVAL_DOCUMENT") -> faiss.IndexFlatL2:
+    async def upsert_doc(self, texts:str, username:str, metadata: dict, embed_method : str = "RETRIEVAL_DOCUMENT") -> Partition:
         
         matrix_to_add, new_embedded_info = await self._get_embed_vals(texts= texts, username = username,
                                                                       embed_method = embed_method, metadata = metadata)
+        return self._add(username, matrix_to_add, new_embedded_info)
+
+    async def replace_doc(self, texts:str, username:str, metadata: dict, embed_method : str = "RETRIEVAL_DOCUMENT") -> Partition:
+        """Re-indexes metadata['file_name']: its old chunks are swapped for the new ones in one step."""
+        matrix_to_add, new_embedded_info = await self._get_embed_vals(texts= texts, username = username,
+                                                                      embed_method = embed_method, metadata = metadata)
+        return self._add(username, matrix_to_add, new_embedded_info, replace_file=metadata['file_name'])
+
+    def add_embedded(self, username: str, embedded: list[dict], replace_file: str | None = None) -> Partition | None:
+        """
+        Adds chunks that were already embedded (batch_embed_text output), used by the ingestion pipeline.
+        With replace_file, that file's previous chunks are tombstoned in the same step.
+        """
+        if not embedded:
+            if replace_file is not None:
+                self.delete_doc(username, replace_file)
+            return self.partitions.get(username)
+        return self._add(username, self._to_matrix(embedded), embedded, replace_file=replace_file)
+
+    def delete_doc(self, username: str, file_name: str) -> int:
+        """Tombstones every chunk of file_name, returns how many were removed."""
+        if self.shared is not None:
+            return self._delete_shared(username, file_name)
+        partition = self.partitions.get(username)
+        if partition is None:
+            return 0
+
+        with partition.lock:
+            rows = partition.rows_of(file_name)
+            self._tombstone(username, partition, rows, file_name)
+        self._maybe_compact(username, partition)
+        return len(rows)
+
+    def file_ids(self, username: str, file_name: str) -> set[int]:
+        """Vector ids of file_name's live chunks."""
+        if self.shared is not None:
+            return self.shared.file_ids(username, file_name)
+        partition = self.partitions.get(username)
+        if partition is None:
+            return set()
+        with partition.lock:
+            return {partition.info.vector_id(row) for row in partition.rows_of(file_name)}
+
+    def drop_ids(self, username: str, file_name: str, vector_ids) -> int:
+        """
+        Removes the chunks of file_name with these vector ids and leaves the rest of the file alone. This is how
+        the pipeline swaps in a re-upload that's indexed in several steps, or backs out the steps of a failed one.
+        """
+        vector_ids = set(vector_ids)
+        if self.shared is not None:
+            partition = self.partitions.get(SHARED_PARTITION)
+            if partition is None or not vector_ids:
+                return 0
+            with partition.lock:
+                current = self.shared.file_ids(username, file_name)
+                _, orphaned = self.shared.set_file(username, file_name, current - vector_ids)
+                self._drop_shared(partition, orphaned)
+                if current & vector_ids:
+                    for callback in self.on_change:
+                        callback(username, file_name)
+            self._maybe_compact(SHARED_PARTITION, partition)
+            return len(current & vector_ids)
+
+        partition = self.partitions.get(username)
+        if partition is None or not vector_ids:
+            return 0
+        with partition.lock:
+            rows = [row for row in partition.rows_of(file_name) if partition.info.vector_id(row) in vector_ids]
+            self._tombstone(username, partition, rows, file_name)
+        self._maybe_compact(username, partition)
+        return len(rows)
+
+    def _delete_shared(self, username: str, file_name: str) -> int:
+        partition = self.partitions.get(SHARED_PARTITION)
+        if partition is None:
+            return 0
+
+        with partition.lock:
+            old, orphaned = self.shared.set_file(username, file_name, ())
+            self._drop_shared(partition, orphaned)
+            if old:
+                for callback in self.on_change:
+                    callback(username, file_name)
+        self._maybe_compact(SHARED_PARTITION, partition)
+        return len(old)
+
+    def _tombstone(self, username: str, partition: Partition, rows: list[int], file_name: str,
+                   logged: bool = False):
+        if not rows:
+            return
+        if self.store is not None and not logged:
+            self.store.append_tombstones(username, rows)
+        partition.tombstone(rows)
+        for callback in self.on_change:
+            callback(username, file_name)
+
+    def _add(self, username: str, matrix_to_add: np.ndarray, new_embedded_info: list[dict],
+             replace_file: str | None = None) -> Partition:
 
-        if self.index is None:
-            # First time upserting: initialize the index
-            self.dimension = matrix_to_add.shape[1]
-            self.index = faiss.IndexFlatL2(self.dimension)
-        elif self.dimension != matrix_to_add.shape[1]:
-            raise ValueError("Embedding dimension mismatch! Cannot add vectors of different dimensions to the same index.")
+        with self._lock:
+            if self.dimension is None:
+                self.dimension = matrix_to_add.shape[1]
+            elif self.dimension != matrix_to_add.shape[1]:
+                raise ValueError("Embedding dimension mismatch! Cannot add vectors of different dimensions to the same index.")
 
-        self.index.add(matrix_to_add) # Add new vectors to the existing index
-        self.embedded_info.extend(new_embedded_info) # Extend the list of metadata dictionaries
+            key = username if self.shared is None else SHARED_PARTITION
+            if key not in self.partitions:
+                # First time this user upserts: give them their own partition
+                self.partitions[key] = (self.store.new_partition(key, self.dimension) if self.store is not None
+                                        else Partition(self.dimension))
+
+            if self.shared is None: # shared ids are only handed to chunks that turn out to be new
+                for i, info in enumerate(new_embedded_info):
+                    info['id'] = self.next_id + i
+                self.next_id += len(new_embedded_info)
+
+        partition = self.partitions[key]
+        if self.shared is not None:
+            self._add_shared(username, partition, matrix_to_add, new_embedded_info, replace_file)
+        else:
+            # queries take the partition lock too, so they see either the old copy of a replaced file or the new one
+            with tracer.span('index.add', user=username, rows=len(new_embedded_info)), partition.lock:
+                stale = partition.rows_of(replace_file) if replace_file is not None else []
+                if self.store is not None:
+                    # the old copy's tombstones go first, only counting once the new rows are all logged
+                    if stale:
+                        self.store.append_tombstones(username, stale, once_rows=partition.ntotal + len(matrix_to_add))
+                    self.store.append(username, matrix_to_add)
+                partition.add(matrix_to_add, new_embedded_info) # Add new vectors and their metadata to the user's partition
+                self._tombstone(username, partition, stale, replace_file, logged=True)
+
+        if self.store is not None:
+            self.store.maybe_snapshot(key, partition)
+
+        self._maybe_promote(key, partition)
+        self._maybe_compact(key, partition)
+        return partition
+
+    def _add_shared(self, username: str, partition: Partition, matrix_to_add: np.ndarray,
+                    new_embedded_info: list[dict], replace_file: str | None):
+        with tracer.span('index.add', user=username, rows=len(new_embedded_info)) as span, partition.lock:
+            # a chunk whose text is already stored (uploaded by anyone) only gets a reference to the stored vector
+            fresh, fresh_ids = [], {}
+            file_ids: dict[str, set[int]] = {}
+            for i, info in enumerate(new_embedded_info):
+                digest = chunk_digest(info['metadata'].get('text', ''))
+                vector_id = self.shared.digests.get(digest, fresh_ids.get(digest))
+                if vector_id is None:
+                    with self._lock:
+                        vector_id, self.next_id = self.next_id, self.next_id + 1
+                    fresh_ids[digest] = vector_id
+                    fresh.append(i)
+                info['id'] = vector_id
+                file_ids.setdefault(info['metadata'].get('file_name', ''), set()).add(vector_id)
+            span.set(new=len(fresh))
+
+            if fresh:
+                if self.store is not None:
+                    self.store.append(SHARED_PARTITION, matrix_to_add[fresh])
+                partition.add(matrix_to_add[fresh], [new_embedded_info[i] for i in fresh])
+                self.shared.digests.update(fresh_ids)
+
+            if replace_file is not None:
+                old, orphaned = self.shared.set_file(username, replace_file, file_ids.pop(replace_file, ()))
+                self._drop_shared(partition, orphaned)
+                if old:
+                    for callback in self.on_change:
+                        callback(username, replace_file)
+            for file_name, ids in file_ids.items(): # added to whatever the file already had
+                self.shared.set_file(username, file_name, ids | self.shared.file_ids(username, file_name))
+
+    def _maybe_promote(self, username: str, partition: Partition):
+        if (self.index_type, self.codec) == ('flat', 'f32') or partition.rebuilding:
+            return
+        if (partition.kind, partition.codec) == (self.index_type, self.codec):
+            return
+        if partition.live < self.promote_at or not partition.start_rebuild():
+            return
+        threading.Thread(target=self._promote, args=(username, partition), daemon=True).start()
+
+    def _maybe_compact(self, username: str, partition: Partition):
+        if partition.rebuilding or not partition.dead or len(partition.dead) < self.compact_ratio * partition.ntotal:
+            return
+        if not partition.start_rebuild():
+            return
+        threading.Thread(target=self._compact, args=(username, partition), daemon=True).start()
+
+    def _compact(self, username: str, partition: Partition):
+        """Drops tombstoned rows for good, in the background; queries keep using the tombstoned copy meanwhile."""
+        ok = False
+        try:
+            with tracer.span('index.compact', user=username, dropped=len(partition.dead)):
+                kind, codec = (self.index_type, self.codec) if partition.live >= self.promote_at else ('flat', 'f32')
+                if self.store is not None:
+                    self.store.compact(username, partition, kind, codec)
+                else:
+                    self._compact_in_memory(partition, kind, codec)
+            ok = True
+        except Exception as e:
+            logger.error(f"Compacting a partition failed (attempt {partition.failures + 1}): {e}")
+        finally:
+            partition.end_rebuild(ok)
+
+    def _compact_in_memory(self, partition: Partition, kind: str, codec: str):
+        with partition.lock:
+            covered, dead = partition.ntotal, set(partition.dead)
+        live = np.setdiff1d(np.arange(covered), np.fromiter(dead, dtype='int64', count=len(dead)))
+        raw = np.ascontiguousarray(partition.vectors(0, covered)[live])
+        info = ChunkStore()
+        info.copy_rows(partition.info, live)
+        base = build_index(kind, raw, codec) if len(live) else None
+
+        with partition.lock:
+            raw = np.concatenate([raw, partition.vectors(covered, partition.ntotal)])
+            info.copy_rows(partition.info, np.arange(covered, partition.ntotal))
+            partition.replace_contents(base, info, remap_rows(partition.dead - dead, live, covered),
+                                       None, raw, len(raw))
+        logger.info(f"Compacted an in-memory partition: dropped {len(dead)} rows, {len(raw)} left")
+
+    def _promote(self, username: str, partition: Partition):
+        """Trains and builds the ANN index in the background; queries hit the old index until the swap."""
+        ok = False
+        try:
+            with tracer.span('index.promote', user=username, kind=self.index_type, codec=self.codec):
+                covered = partition.ntotal
+                vectors = partition.vectors(0, covered)
+                index = build_index(self.index_type, vectors, self.codec)
+                if self.store is not None:
+                    index = self.store.write_snapshot(username, index)
+
+                partition.recall = recall_at_k(index, vectors)
+                partition.swap(index, covered)
+                logger.info(f"Promoted a partition to {self.index_type}/{self.codec} over {covered} vectors, "
+                            f"recall@10 vs flat: {partition.recall:.3f}")
+            ok = True
+        except Exception as e:
+            logger.error(f"Promoting a partition to {self.index_type} failed (attempt {partition.failures + 1}): {e}")
+        finally:
+            partition.end_rebuild(ok)
+
+    def recall_at_k(self, username: str, k: int = 10, n_queries: int = 100) -> float | None:
+        """
+        How much of the exact (flat) top-k the user's current index returns, sampled from their own vectors.
+        Both sides only look at the rows a query of theirs can return: not tombstoned, and in their scope.
+        """
+        partition = self._searchable(username)
+        if partition is None:
+            return None
+        scope = self._scope(username)
+        with partition.lock:
+            vectors = partition.vectors()
+            if scope is not None:
+                rows = np.sort(partition._scoped(scope)[0])
+            else:
+                dead = np.fromiter(partition.dead, dtype='int64', count=len(partition.dead))
+                rows = np.setdiff1d(np.arange(len(vectors)), dead)
+        return recall_at_k(None, vectors, k=k, n_queries=n_queries, rows=rows,
+                           search=lambda queries, k: partition.search(queries, k, self.rescore, scope))
 
 
         
-    async def query(self, *, texts: str, user_id: str, embed_method: str = 'RETRIEVAL_QUERY', top_k: int = 3) -> list[dict[str, str]] | None:
+    async def embed_query(self, texts: str, embed_method: str = 'RETRIEVAL_QUERY') -> np.ndarray:
+            queried = await batch_embed_text( texts, method=embed_method, embedder=self.embedder)
+            return np.array([queried[0]['values']]).astype('float32') # Ensure float32 for FAISS
+
+    async def query(self, *, texts: str, user_id: str, embed_method: str = 'RETRIEVAL_QUERY', top_k: int = 3,
+                    query_vector: np.ndarray | None = None, mode: str = 'dense') -> list[dict[str, str]] | None:
             """
-            Queries the FAISS index with the given text and always filters results by the provided user_id.
+            Queries the FAISS index with the given text. Only the sub-index belonging to user_id is searched,
+            so latency scales with that user's corpus and a full top_k comes back whenever they have enough chunks.
+            Pass query_vector (from embed_query) when the caller already embedded the text.
 
+            mode is one of RETRIEVAL_MODES; 'lexical' answers from the BM25 index without embedding the query.
             """
-            if self.index is None or not self.embedded_info:
+            if mode not in RETRIEVAL_MODES:
+                raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+            partition = self._searchable(user_id)
+            if partition is None:
                 return None
 
-            queried = await batch_embed_text( texts, method=embed_method)
-            query_matrix = np.array([queried[0]['values']]).astype('float32') # Ensure float32 for FAISS
-
-            # Check query dimension against index dimension
-            if query_matrix.shape[1] != self.dimension:
-                raise ValueError(f"Query embedding dimension {query_matrix.shape[1]} does not match index dimension {self.dimension}")
-
-            # Search for a larger number of candidates initially to increase the chances per user
-            search_candidates_k = top_k * 2
-            if search_candidates_k > len(self.embedded_info):
-                search_candidates_k = len(self.embedded_info) # Don't search more than available docs
-
-            _, distances_and_indices = self.index.search(query_matrix, search_candidates_k)
-            
-            # Filter results by user_id
-            filtered_results_text = []
-            for idx in distances_and_indices[0]:
-                if idx >= len(self.embedded_info):
-                    continue
-
-                item_metadata = self.embedded_info[idx]['metadata']
-                
-                # Filter by id
-                if item_metadata.get('user_id') == user_id:
-                    filtered_results_text.append({"text" :item_metadata.get('text', ''),
-                                                  "file_name" :item_metadata.get('file_name', '')}) 
-                    if len(filtered_results_text) >= top_k: # Stop once we have enough results
-                        break
-            
-            return filtered_results_text
\ No newline at end of file
+            query_matrix = None
+            if mode != 'lexical':
+                if query_vector is None:
+                    with tracer.span('query.embed', user=user_id):
+                        query_vector = await self.embed_query(texts, embed_method)
+                query_matrix = np.asarray(query_vector, dtype='float32').reshape(1, -1)
+
+                # Check query dimension against index dimension
+                if query_matrix.shape[1] != self.dimension:
+                    raise ValueError(f"Query embedding dimension {query_matrix.shape[1]} does not match index dimension {self.dimension}")
+
+            with tracer.span('query.search', user=user_id, mode=mode, k=top_k, kind=partition.kind), \
+                    partition.lock: # rows are only meaningful until the next compaction swaps them
+                return self._results(partition, self._rank(partition, [texts], query_matrix, top_k, mode,
+                                                           self.rescore, self._scope(user_id))[0], user_id)
+
+    @staticmethod
+    def _rank(partition: Partition, texts: list[str], query_matrix: np.ndarray | None, top_k: int,
+              mode: str, rescore: int = 0, scope: tuple | None = None) -> list:
+        # best-first rows per query; the caller holds partition.lock
+        if mode == 'lexical':
+            return [partition.search_lexical(text, top_k, scope)[1] for text in texts]
+
+        depth = top_k if mode == 'dense' else top_k * HYBRID_DEPTH
+        _, indices = partition.search(query_matrix, depth, rescore, scope)
+        if mode == 'dense':
+            return list(indices)
+        return [reciprocal_rank_fusion([dense, partition.search_lexical(text, depth, scope)[1]])[:top_k]
+                for dense, text in zip(indices, texts)]
+
+    def _results(self, partition: Partition, row_indices, username: str) -> list[dict]:
+        results = []
+        for idx in row_indices:
+            if idx < 0 or idx >= len(partition.info):
+                continue
+
+            info = partition.info
+            vector_id = info.vector_id(idx)
+            # a shared chunk's stored file name is its first uploader's, the user's own may differ
+            results.append({"id": vector_id,
+                            "text" :info.text(idx),
+                            "file_name" :info.file_name(idx) if self.shared is None
+                                         else self.shared.file_of(username, vector_id)}) 
+        return results
+
+    async def query_many(self, queries: list[str], user_id: str | list[str], embed_method: str = 'RETRIEVAL_QUERY',
+                         top_k: int = 3, mode: str = 'dense',
+                         query_matrix: np.ndarray | None = None) -> list[list[dict[str, str]] | None]:
+        """
+        Batched query: embeds all queries through the batching embedding engine and runs one matrix search per
+        user partition. user_id is either one user for every query or one per query; results line up with queries.
+        Pass query_matrix (one row per query) when the caller already embedded them.
+        """
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        if not queries:
+            return []
+        users = [user_id] * len(queries) if isinstance(user_id, str) else list(user_id)
+        if len(users) != len(queries):
+            raise ValueError(f"Got {len(users)} user ids for {len(queries)} queries")
+
+        results: list[list[dict[str, str]] | None] = [None] * len(queries)
+        wanted = [i for i, user in enumerate(users) if self._searchable(user) is not None]
+        if not wanted:
+            return results
+
+        if mode == 'lexical':
+            query_matrix = None
+        elif query_matrix is not None:
+            query_matrix = np.asarray(query_matrix, dtype='float32')[wanted]
+        else:
+            queried = await batch_embed_text([queries[i] for i in wanted], method=embed_method, embedder=self.embedder)
+            query_matrix = np.asarray([q['values'] for q in queried], dtype='float32')
+        if query_matrix is not None and query_matrix.shape[1] != self.dimension:
+            raise ValueError(f"Query embedding dimension {query_matrix.shape[1]} does not match index dimension {self.dimension}")
+
+        positions = np.asarray(wanted)
+        wanted_users = np.asarray([users[i] for i in wanted], dtype=object)
+        for user in dict.fromkeys(wanted_users):
+            rows = np.flatnonzero(wanted_users == user)
+            partition = self._searchable(user)
+            if partition is None: # their last file was deleted since
+                continue
+            with tracer.span('query.search', user=user, mode=mode, k=top_k, queries=len(rows)), partition.lock:
+                indices = self._rank(partition, [queries[positions[row]] for row in rows],
+                                     None if query_matrix is None else query_matrix[rows], top_k, mode,
+                                     self.rescore, self._scope(user))
+                for row, row_indices in zip(rows, indices):
+                    results[positions[row]] = self._results(partition, row_indices, user)
+        return results
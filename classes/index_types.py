@@ -0,0 +1,197 @@
+import math
+
+import faiss, numpy as np
+
+# everything but flat is approximate and needs enough vectors (and, for IVF, training) before it pays off
+INDEX_TYPES = ('flat', 'hnsw', 'ivf_flat', 'ivf_pq')
+
+# how the index stores each vector, independent of the search structure; bytes per d-dim vector:
+# f32 4d, f16 2d, sq8 d (8-bit scalar quantization, trained per dimension), pq d/16 (product quantization)
+CODECS = ('f32', 'f16', 'sq8', 'pq')
+
+
+def _nlist(n_vectors: int) -> int:
+    return int(min(65536, max(16, 4 * math.sqrt(n_vectors))))
+
+
+def _pq_m(dimension: int) -> int:
+    # ~16 dims per sub-quantizer, and it has to divide the dimension
+    m = max(1, dimension // 16)
+    while dimension % m:
+        m -= 1
+    return m
+
+
+def _storage(codec: str, dimension: int) -> str:
+    if codec == 'f32':
+        return 'Flat'
+    if codec == 'f16':
+        return 'SQfp16'
+    if codec == 'sq8':
+        return 'SQ8'
+    if codec == 'pq':
+        return f'PQ{_pq_m(dimension)}x8'
+    raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+
+
+def normalize_codec(kind: str, codec: str) -> str:
+    """The codec an index of `kind` built with `codec` actually ends up with (ivf_pq always stores PQ codes)."""
+    if codec not in CODECS:
+        raise ValueError(f"Unknown codec {codec!r}, expected one of {CODECS}")
+    if kind == 'flat' and codec == 'pq':
+        # a bare IndexPQ refuses SearchParameters, so it couldn't skip tombstoned or out-of-scope rows
+        raise ValueError("flat can't use the 'pq' codec (it can't filter deleted rows), use hnsw or ivf_pq")
+    if kind == 'ivf_flat' and codec == 'pq':
+        raise ValueError("ivf_flat with PQ codes is ivf_pq, use index_type='ivf_pq'")
+    if kind == 'ivf_pq':
+        if codec not in ('f32', 'pq'): # f32 is the default, i.e. nothing asked for
+            raise ValueError(f"ivf_pq stores PQ codes, it can't use the {codec!r} codec")
+        return 'pq'
+    return codec
+
+
+def factory_string(kind: str, dimension: int, n_vectors: int, codec: str = 'f32') -> str:
+    storage = _storage(codec, dimension)
+    if kind == 'flat':
+        return storage
+    if kind == 'hnsw':
+        # faiss spells the PQ flavour of HNSW differently
+        return f'HNSW32_PQ{_pq_m(dimension)}' if codec == 'pq' else f'HNSW32,{storage}'
+    if kind == 'ivf_flat':
+        return f'IVF{_nlist(n_vectors)},{storage}'
+    if kind == 'ivf_pq': # PQ is its codec already
+        return f'IVF{_nlist(n_vectors)},PQ{_pq_m(dimension)}x8'
+    raise ValueError(f"Unknown index type {kind!r}, expected one of {INDEX_TYPES}")
+
+
+def index_kind(index: faiss.Index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        return 'hnsw'
+    if isinstance(index, faiss.IndexIVFPQ):
+        return 'ivf_pq'
+    if isinstance(index, faiss.IndexIVF): # IVF over flat or scalar quantized lists
+        return 'ivf_flat'
+    return 'flat'
+
+
+def index_codec(index: faiss.Index) -> str:
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return 'pq'
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return 'f16' if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else 'sq8'
+    return 'f32'
+
+
+def tune(index: faiss.Index, nprobe: int = 16, ef_search: int = 64) -> faiss.Index:
+    """Search-time knobs aren't reliably kept by write_index, so they're set again on every build/load."""
+    # the downcast wrapper doesn't own the C++ object, so only use it to set fields and hand back the original
+    typed = faiss.downcast_index(index)
+    if isinstance(typed, faiss.IndexIVF):
+        typed.nprobe = min(nprobe, typed.nlist)
+    if isinstance(typed, faiss.IndexHNSW):
+        typed.hnsw.efSearch = ef_search
+    return index
+
+
+def search_params(index: faiss.Index, selector: faiss.IDSelector) -> faiss.SearchParameters:
+    """SearchParameters of the right subtype for `index`, carrying its tuned knobs and an id selector."""
+    typed = faiss.downcast_index(index)
+    if isinstance(typed, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=typed.nprobe)
+    if isinstance(typed, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=typed.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def read_index(path: str) -> faiss.Index:
+    # flat float32 snapshots are memory-mapped; the ANN types and compressed codecs are small enough (or
+    # graph-shaped enough) to load, and a mapped copy couldn't be added to after a clone
+    index = faiss.read_index(path, faiss.IO_FLAG_MMAP_IFC | faiss.IO_FLAG_READ_ONLY)
+    if index_kind(index) != 'flat' or index_codec(index) != 'f32':
+        index = faiss.read_index(path)
+    return tune(index)
+
+
+def build_index(kind: str, vectors: np.ndarray, codec: str = 'f32', block: int = 65536,
+                train_size: int = 256) -> faiss.Index:
+    """
+    Builds (training first if needed) an index of the given kind and codec over `vectors`, which may be a memmap.
+    """
+    n_vectors, dimension = vectors.shape
+    index = faiss.index_factory(dimension, factory_string(kind, dimension, n_vectors, codec))
+
+    if not index.is_trained:
+        if codec == 'pq' and n_vectors < 256:
+            raise ValueError(f"PQ needs at least 256 vectors to train its codebooks, got {n_vectors}")
+        ivf = faiss.try_extract_index_ivf(index)
+        # faiss wants ~39 points per centroid, for IVF lists and PQ codebooks (256 centroids each) alike
+        sample = min(n_vectors, max(train_size * ivf.nlist if ivf else 0, 256 * 39))
+        rows = np.sort(np.random.default_rng(0).choice(n_vectors, size=sample, replace=False))
+        index.train(np.ascontiguousarray(vectors[rows], dtype='float32'))
+
+    for start in range(0, n_vectors, block):
+        index.add(np.ascontiguousarray(vectors[start:start + block], dtype='float32'))
+    return tune(index)
+
+
+def rescore_exact(queries: np.ndarray, vectors: np.ndarray, candidates: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Re-ranks each query's candidate rows (-1 padded) by exact L2 distance against the full precision `vectors`
+    (typically the memory-mapped vector log), keeping the best k.
+    """
+    rows = np.unique(candidates[candidates >= 0])
+    exact = np.ascontiguousarray(vectors[rows], dtype='float32') # one sorted gather, reads each row once
+    positions = np.searchsorted(rows, np.maximum(candidates, 0))
+    distances = np.take_along_axis(faiss.pairwise_distances(np.ascontiguousarray(queries, dtype='float32'), exact),
+                                   positions, axis=1)
+    distances = np.where(candidates >= 0, distances, np.inf).astype('float32')
+    order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(candidates, order, axis=1)
+
+
+def exact_search(queries: np.ndarray, vectors: np.ndarray, k: int, block: int = 65536,
+                 rows: np.ndarray | None = None) -> np.ndarray:
+    # brute force over `vectors` (only the sorted `rows` of it, if given) a block at a time, so a memmap never
+    # has to be loaded whole
+    heap = faiss.ResultHeap(len(queries), k)
+    for start in range(0, len(vectors), block):
+        if rows is None:
+            ids = None
+            chunk = np.ascontiguousarray(vectors[start:start + block], dtype='float32')
+        else:
+            ids = rows[np.searchsorted(rows, start):np.searchsorted(rows, start + block)]
+            if not len(ids):
+                continue
+            chunk = np.ascontiguousarray(vectors[ids], dtype='float32')
+        distances, indices = faiss.knn(queries, chunk, min(k, len(chunk)))
+        if indices.shape[1] < k: # a short last block, pad it out to k columns
+            pad = k - indices.shape[1]
+            distances = np.pad(distances, ((0, 0), (0, pad)), constant_values=np.inf)
+            indices = np.pad(indices, ((0, 0), (0, pad)), constant_values=-1)
+        found = indices + start if ids is None else ids[np.maximum(indices, 0)]
+        heap.add_result(np.ascontiguousarray(distances, dtype='float32'), np.where(indices >= 0, found, indices))
+    heap.finalize()
+    return heap.I
+
+
+def recall_at_k(index, vectors: np.ndarray, k: int = 10, n_queries: int = 100, search=None,
+                rows: np.ndarray | None = None) -> float:
+    """
+    Average overlap between the top-k of `index` (or the `search` callable) and the exact top-k over `vectors`,
+    using a sample of the stored vectors as queries. `rows` (sorted) limits both, and the exact side, to the
+    rows the search can return, e.g. a partition's live or in-scope ones.
+    """
+    n_vectors = len(vectors) if rows is None else len(rows)
+    k = min(k, n_vectors)
+    sample = np.sort(np.random.default_rng(1).choice(n_vectors, size=min(n_queries, n_vectors), replace=False))
+    queries = np.ascontiguousarray(vectors[sample if rows is None else rows[sample]], dtype='float32')
+
+    exact = exact_search(queries, vectors, k, rows=rows)
+    _, approx = (search or index.search)(queries, k)
+
+    hits = sum(len(set(e[e >= 0]) & set(a[a >= 0])) for e, a in zip(exact, approx))
+    return hits / (len(queries) * k)
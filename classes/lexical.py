@@ -0,0 +1,95 @@
+import math
+import re
+from array import array
+
+import numpy as np
+
+from .metadata import ChunkStore
+
+# words, keeping part numbers / versions / dotted names (ab-123, v2.1, foo.bar) in one piece
+_TOKEN = re.compile(r"\w+(?:[-./]\w+)*")
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN.findall(text.lower())
+
+
+class LexicalIndex():
+    """
+    In-process BM25 inverted index over a partition's chunks, row-aligned with its ChunkStore.
+
+    Postings are per term arrays of (row, term frequency), appended as chunks come in. Tombstoned rows are
+    skipped at search time; document frequencies still count them until a compaction rebuilds the index.
+    """
+
+    def __init__(self, k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._rows: dict[str, array] = {}
+        self._freqs: dict[str, array] = {}
+        self._lengths = array('i')
+        self._total_length = 0
+
+    @classmethod
+    def from_chunks(cls, chunks: ChunkStore, **kwargs) -> 'LexicalIndex':
+        index = cls(**kwargs)
+        index.add(chunks.text(row) for row in range(len(chunks)))
+        return index
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def add(self, texts):
+        for text in texts:
+            row = len(self._lengths)
+            tokens = tokenize(text)
+            counts: dict[str, int] = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                if token not in self._rows:
+                    self._rows[token], self._freqs[token] = array('q'), array('i')
+                self._rows[token].append(row)
+                self._freqs[token].append(count)
+            self._lengths.append(len(tokens))
+            self._total_length += len(tokens)
+
+    def search(self, query: str, k: int, dead: set[int] | None = None,
+               allowed: np.ndarray | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k (scores, rows) for `query`, best first. Rows with no query term in them never come back, nor do
+        `dead` rows or, when `allowed` is given, rows outside it.
+        """
+        n = len(self._lengths)
+        terms = [t for t in dict.fromkeys(tokenize(query)) if t in self._rows]
+        if not n or not terms or k <= 0:
+            return np.zeros(0, dtype='float32'), np.zeros(0, dtype='int64')
+
+        lengths = np.frombuffer(self._lengths, dtype='int32')
+        norm = self.k1 * (1 - self.b + self.b * lengths / (self._total_length / n))
+        scores = np.zeros(n, dtype='float32')
+        for term in terms:
+            rows = np.frombuffer(self._rows[term], dtype='int64')
+            freqs = np.frombuffer(self._freqs[term], dtype='int32')
+            idf = math.log(1 + (n - len(rows) + 0.5) / (len(rows) + 0.5))
+            scores[rows] += idf * freqs * (self.k1 + 1) / (freqs + norm[rows])
+
+        candidates = np.flatnonzero(scores)
+        if dead:
+            candidates = candidates[~np.isin(candidates, np.fromiter(dead, dtype='int64', count=len(dead)))]
+        if allowed is not None:
+            candidates = candidates[np.isin(candidates, allowed)]
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        order = np.argsort(-scores[candidates], kind='stable')
+        return scores[candidates[order]], candidates[order]
+
+
+def reciprocal_rank_fusion(rankings: list, k: int = 60) -> list[int]:
+    """Merges several best-first lists of rows into one by summing 1 / (k + rank) over the lists a row is in."""
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking):
+            if row >= 0:
+                scores[int(row)] = scores.get(int(row), 0.0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.__getitem__, reverse=True)
@@ -0,0 +1,266 @@
+import json
+import mmap
+import os
+from pathlib import Path
+
+import numpy as np
+
+# one fixed-width record per chunk; the text itself lives in a separate blob ending at `end`
+ROW = np.dtype([('id', '<i8'), ('file', '<i4'), ('user', '<i4'), ('end', '<i8')])
+
+CHUNKS = 'chunks.bin'
+TEXT = 'text.bin'
+FILES = 'files.jsonl'
+USERS = 'users.jsonl'
+
+# a persisted store maps what it appended once this much is held in RAM (tail rows plus their text)
+REMAP_BYTES = 32 << 20
+
+
+def _append(path: Path, data: bytes):
+    with open(path, 'ab') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class StringTable():
+    """Interns strings (file names, user ids) to small ints, optionally backed by a one-string-per-line log."""
+
+    def __init__(self, path: Path | None = None):
+        self.path = path
+        self.values: list[str] = []
+        self.index: dict[str, int] = {}
+        if path is not None and path.exists():
+            with open(path, 'rb') as f:
+                data = f.read()
+            complete = data[:data.rfind(b'\n') + 1]
+            if len(complete) != len(data): # torn tail
+                os.truncate(path, len(complete))
+            for line in complete.splitlines():
+                self._remember(json.loads(line))
+
+    def _remember(self, value: str) -> int:
+        self.index[value] = len(self.values)
+        self.values.append(value)
+        return self.index[value]
+
+    def intern(self, value: str) -> int:
+        if value in self.index:
+            return self.index[value]
+        if self.path is not None:
+            _append(self.path, json.dumps(value).encode() + b'\n')
+        return self._remember(value)
+
+
+class ChunkStore():
+    """
+    Columnar chunk metadata, row-aligned with a partition's vectors.
+
+    Per chunk this holds one ROW record (vector id, interned file and user ids, end offset of its text)
+    and its utf-8 text in one contiguous blob. Embedding values are not kept here, they already live in
+    the index/vector log. Lookups by row are O(1); by vector id a binary search over the (sorted) id column.
+
+    With a `path` the columns are append logs (chunks.bin, text.bin, files.jsonl, users.jsonl) and
+    whatever existed at open is read through memory maps rather than loaded. Rows appended since are held
+    in RAM (a growable tail) until there are REMAP_BYTES of them, then the logs are mapped again.
+    """
+
+    def __init__(self, path: Path | None = None):
+        self.path = Path(path) if path is not None else None
+        self.files = StringTable(self.path / FILES if self.path else None)
+        self.users = StringTable(self.path / USERS if self.path else None)
+        self._mapped = np.zeros(0, dtype=ROW) # rows that were on disk at open (a memmap), then the tail
+        self._mapped_ids: np.ndarray | None = None # their id column, contiguous for searchsorted
+        self._tail = np.zeros(0, dtype=ROW) # capacity doubles, the first _tail_len rows are used
+        self._tail_ids = np.zeros(0, dtype='int64')
+        self._tail_len = 0
+        self._blob = bytearray() # in-memory text, or text appended since the mmap was taken
+        self._blob_mm = None
+        self._blob_mapped = 0
+        if self.path is not None:
+            self._open()
+
+    def _open(self):
+        chunks_path, text_path = self.path / CHUNKS, self.path / TEXT
+        chunks_path.touch()
+        text_path.touch()
+
+        rows = chunks_path.stat().st_size // ROW.itemsize
+        if rows:
+            # torn or zero-filled records at the tail have text offsets that go backwards or past the text log
+            ends = np.memmap(chunks_path, dtype=ROW, mode='r', shape=(rows,))['end']
+            text_size = text_path.stat().st_size
+            while rows and (ends[rows - 1] > text_size or (rows > 1 and ends[rows - 1] < ends[rows - 2])):
+                rows -= 1
+            del ends
+        if chunks_path.stat().st_size != rows * ROW.itemsize:
+            os.truncate(chunks_path, rows * ROW.itemsize)
+        if rows:
+            self._mapped = np.memmap(chunks_path, dtype=ROW, mode='r', shape=(rows,))
+        self._mapped_ids = None
+
+        text_end = int(self._mapped['end'][-1]) if rows else 0
+        if text_path.stat().st_size != text_end: # text written for rows that never made it
+            os.truncate(text_path, text_end)
+        self._map_blob()
+
+    def truncate(self, rows: int):
+        """Cuts a persisted store back to its first `rows` rows (crash recovery, before anything is appended)."""
+        end = self._end(rows - 1)
+        self._mapped = np.zeros(0, dtype=ROW)
+        os.truncate(self.path / CHUNKS, rows * ROW.itemsize)
+        os.truncate(self.path / TEXT, end)
+        self._open()
+
+    def _remap(self):
+        # everything appended is fsynced already: map it and let the RAM copy go
+        rows = len(self)
+        self._mapped = np.memmap(self.path / CHUNKS, dtype=ROW, mode='r', shape=(rows,))
+        self._mapped_ids = None
+        self._tail, self._tail_ids, self._tail_len = np.zeros(0, dtype=ROW), np.zeros(0, dtype='int64'), 0
+        self._map_blob()
+
+    def _map_blob(self):
+        if self._blob_mm is not None:
+            self._blob_mm.close()
+            self._blob_mm = None
+        size = (self.path / TEXT).stat().st_size
+        if size:
+            with open(self.path / TEXT, 'rb') as f:
+                self._blob_mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._blob_mapped = size
+        self._blob = bytearray()
+
+    @property
+    def rows(self) -> np.ndarray:
+        """Every row as one array: a copy once rows were appended to a mapped store, for whole-store passes."""
+        tail = self._tail[:self._tail_len]
+        if not len(self._mapped):
+            return tail
+        return np.concatenate([self._mapped, tail]) if self._tail_len else self._mapped
+
+    def _parts(self) -> list[tuple[int, np.ndarray, np.ndarray]]:
+        # (first row, rows, their ids) for the mapped rows and the tail, searched where they are, not concatenated
+        if self._mapped_ids is None:
+            self._mapped_ids = np.ascontiguousarray(self._mapped['id'])
+        return [(0, self._mapped, self._mapped_ids),
+                (len(self._mapped), self._tail[:self._tail_len], self._tail_ids[:self._tail_len])]
+
+    def __len__(self) -> int:
+        return len(self._mapped) + self._tail_len
+
+    def _row(self, row: int) -> np.void:
+        if row < 0:
+            row += len(self)
+        if row < len(self._mapped):
+            return self._mapped[row]
+        return self._tail[row - len(self._mapped)]
+
+    def _end(self, row: int) -> int:
+        return int(self._row(row)['end']) if row >= 0 else 0
+
+    def _text_bytes(self, start: int, end: int) -> bytes:
+        if start == end:
+            return b''
+        if end <= self._blob_mapped:
+            return self._blob_mm[start:end]
+        if start >= self._blob_mapped:
+            return bytes(self._blob[start - self._blob_mapped:end - self._blob_mapped])
+        return self._blob_mm[start:self._blob_mapped] + bytes(self._blob[:end - self._blob_mapped])
+
+    def text(self, row: int) -> str:
+        return self._text_bytes(self._end(row - 1), self._end(row)).decode('utf-8')
+
+    def vector_id(self, row: int) -> int:
+        return int(self._row(row)['id'])
+
+    def file_name(self, row: int) -> str:
+        return self.files.values[int(self._row(row)['file'])]
+
+    def user_id(self, row: int) -> str:
+        return self.users.values[int(self._row(row)['user'])]
+
+    def __getitem__(self, row: int) -> dict:
+        # same shape batch_embed_text hands out, minus the values
+        return {'id': self.vector_id(row),
+                'metadata': {'text': self.text(row), 'user_id': self.user_id(row), 'file_name': self.file_name(row)}}
+
+    def find(self, vector_ids) -> np.ndarray:
+        """Rows holding these vector ids, -1 for the ones that aren't stored."""
+        vector_ids = np.asarray(vector_ids, dtype='int64')
+        found = np.full(len(vector_ids), -1, dtype='int64')
+        for first, _, ids in self._parts():
+            if not len(ids):
+                continue
+            pos = np.minimum(np.searchsorted(ids, vector_ids), len(ids) - 1)
+            hit = ids[pos] == vector_ids
+            found[hit] = first + pos[hit]
+        return found
+
+    def row_of(self, vector_id: int) -> int | None:
+        row = int(self.find([vector_id])[0])
+        return row if row >= 0 else None
+
+    def rows_of_file(self, file_name: str) -> np.ndarray:
+        if file_name not in self.files.index:
+            return np.zeros(0, dtype='int64')
+        file = self.files.index[file_name]
+        return np.concatenate([first + np.flatnonzero(rows['file'] == file) for first, rows, _ in self._parts()])
+
+    def _append_rows(self, records: np.ndarray, text: bytes):
+        if self.path is not None:
+            # text before records: a crash in between leaves orphan text, which _open trims
+            _append(self.path / TEXT, text)
+            _append(self.path / CHUNKS, records.tobytes())
+        self._blob.extend(text)
+        used = self._tail_len + len(records)
+        if used > len(self._tail):
+            capacity = max(used, 2 * len(self._tail), 1024)
+            self._tail = np.concatenate([self._tail[:self._tail_len], np.zeros(capacity - self._tail_len, dtype=ROW)])
+            self._tail_ids = np.concatenate([self._tail_ids[:self._tail_len],
+                                             np.zeros(capacity - self._tail_len, dtype='int64')])
+        self._tail[self._tail_len:used] = records
+        self._tail_ids[self._tail_len:used] = records['id']
+        self._tail_len = used
+        if self.path is not None and len(self._blob) + used * ROW.itemsize >= REMAP_BYTES:
+            self._remap()
+
+    def extend(self, infos: list[dict]):
+        """Appends batch_embed_text style dicts ({id, values, metadata}); `values` is dropped."""
+        records = np.zeros(len(infos), dtype=ROW)
+        texts = []
+        end = self._end(len(self) - 1)
+        for i, info in enumerate(infos):
+            metadata = info['metadata']
+            encoded = metadata.get('text', '').encode('utf-8')
+            end += len(encoded)
+            texts.append(encoded)
+            records[i] = (info['id'], self.files.intern(metadata.get('file_name', '')),
+                          self.users.intern(metadata.get('user_id') or ''), end)
+        self._append_rows(records, b''.join(texts))
+
+    def copy_rows(self, source: 'ChunkStore', rows: np.ndarray):
+        """Appends `rows` of another store (compaction), re-interning strings and repacking their text."""
+        if not len(rows):
+            return
+        all_rows = source.rows
+        src = all_rows[rows]
+        starts = np.where(rows > 0, all_rows['end'][np.maximum(rows - 1, 0)], 0)
+        lengths = src['end'] - starts
+        text = b''.join(source._text_bytes(int(s), int(s + n)) for s, n in zip(starts, lengths))
+
+        records = np.zeros(len(rows), dtype=ROW)
+        records['id'] = src['id']
+        file_map = np.asarray([self.files.intern(v) for v in source.files.values], dtype='int32')
+        user_map = np.asarray([self.users.intern(v) for v in source.users.values], dtype='int32')
+        records['file'] = file_map[src['file']] if len(file_map) else 0
+        records['user'] = user_map[src['user']] if len(user_map) else 0
+        records['end'] = self._end(len(self) - 1) + np.cumsum(lengths)
+        self._append_rows(records, text)
+
+    def nbytes(self) -> int:
+        """Resident bytes held outside memory maps."""
+        tables = sum(len(v) + 64 for v in self.files.values + self.users.values)
+        ids = self._mapped_ids.nbytes if self._mapped_ids is not None else 0
+        return self._tail.nbytes + self._tail_ids.nbytes + ids + len(self._blob) + tables
@@ -0,0 +1,288 @@
+import threading
+import time
+from typing import Callable
+
+import faiss, numpy as np
+
+from .index_types import index_codec, index_kind, rescore_exact, search_params
+from .lexical import LexicalIndex
+from .metadata import ChunkStore
+
+
+# a promotion or compaction that failed isn't tried again for this long, doubling per failure up to the cap
+REBUILD_BACKOFF = 30.0
+REBUILD_BACKOFF_MAX = 3600.0
+
+
+def _stored(index: faiss.Index) -> np.ndarray:
+    # the float32 rows a flat index holds, as a view: only valid under the partition lock, an add can move them
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype='float32')
+    return faiss.rev_swig_ptr(index.get_xb(), index.ntotal * index.d).reshape(index.ntotal, index.d)
+
+
+def remap_rows(rows: set[int], live: np.ndarray, covered: int) -> set[int]:
+    """
+    Where `rows` of a partition end up after compacting it down to `live` (sorted surviving rows below
+    `covered`); rows from `covered` on were appended during the compaction and keep their order after them.
+    """
+    remapped = set()
+    for row in rows:
+        if row >= covered:
+            remapped.add(len(live) + row - covered)
+        else:
+            pos = int(np.searchsorted(live, row))
+            if pos < len(live) and live[pos] == row:
+                remapped.add(pos)
+    return remapped
+
+
+class Partition():
+    """
+    One user's slice of the vector index.
+
+    `base` is a read-only snapshot (memory-mapped when it comes off disk, or a trained ANN index after a
+    promotion) and `delta` is a flat index holding whatever was added since. Rows run across both: rows
+    [0, base.ntotal) live in the base and the rest in the delta. Each row's stable vector id and metadata live
+    in `info`, a row-aligned ChunkStore; rows only move when the partition is compacted.
+
+    `lexical` is a BM25 index over the same rows' text, built on first use and kept up to date by `add`.
+
+    The base may store its vectors compressed (see index_types.CODECS); searches can then re-rank a wider
+    candidate set against the exact vectors, which stay in the raw vector log.
+
+    Deleted rows are tombstoned in `dead` and excluded from searches through an id selector until a
+    compaction drops them for good.
+
+    A search can also be scoped to a subset of vector ids (one user's view of a shared, deduplicated
+    partition, see shared.SharedChunks); the rows and selectors for each scope are cached until it changes.
+
+    The raw float32 rows are kept too, for rebuilding and retraining: persisted partitions read them back
+    from the store's vector log via `vectors`. In-memory ones read them out of the flat indexes that already
+    hold them, and only keep their own copy (`_raw`) of the rows a trained or compressed base covers.
+
+    Promotions and compactions claim the partition with start_rebuild() and report back with end_rebuild();
+    after a failure the next attempt waits out a backoff instead of starting on the very next add.
+    """
+
+    def __init__(self, dimension: int, base: faiss.Index | None = None, info: ChunkStore | None = None,
+                 vectors: Callable[[int], np.ndarray] | None = None, dead: set[int] | None = None):
+        self.dimension = dimension
+        self.base = base
+        self.delta = faiss.IndexFlatL2(dimension)
+        self.info = info if info is not None else ChunkStore()
+        self.dead: set[int] = dead if dead is not None else set()
+        self._vectors = vectors
+        self._raw: np.ndarray | None = None # in memory: exact rows under a base that isn't flat float32
+        self._selectors = None
+        self._scopes: dict = {} # scope key -> (rows, selectors)
+        self._lexical: LexicalIndex | None = None
+        self.lock = threading.RLock() # swaps happen from background threads
+        self.rebuilding = False # a promotion or compaction is running in the background
+        self.failures = 0 # rebuilds failed in a row
+        self.retry_at = 0.0 # time.monotonic() before which no rebuild is started
+        self.recall: float | None = None # recall@k measured at the last promotion
+
+    @property
+    def kind(self) -> str:
+        return index_kind(self.base) if self.base is not None else 'flat'
+
+    @property
+    def codec(self) -> str:
+        return index_codec(self.base) if self.base is not None else 'f32'
+
+    @property
+    def base_rows(self) -> int:
+        return self.base.ntotal if self.base is not None else 0
+
+    @property
+    def ntotal(self) -> int:
+        return self.base_rows + self.delta.ntotal
+
+    @property
+    def live(self) -> int:
+        return self.ntotal - len(self.dead)
+
+    def vectors(self, start: int = 0, stop: int | None = None) -> np.ndarray:
+        stop = self.ntotal if stop is None else stop
+        if self._vectors is not None:
+            return self._vectors(stop)[start:stop]
+        with self.lock: # a copy: the flat indexes' storage can move once the lock is let go
+            return self._exact_rows(np.arange(start, stop))
+
+    def _exact_rows(self, rows: np.ndarray) -> np.ndarray:
+        # in memory, under the lock: base rows from _raw (or a flat base itself), the rest out of the delta
+        base_rows = self.base_rows
+        in_base = rows < base_rows
+        exact = np.empty((len(rows), self.dimension), dtype='float32')
+        if in_base.any():
+            exact[in_base] = (self._raw if self._raw is not None else _stored(self.base))[rows[in_base]]
+        if not in_base.all():
+            exact[~in_base] = _stored(self.delta)[rows[~in_base] - base_rows]
+        return exact
+
+    def _keeps_raw(self, base: faiss.Index | None) -> bool:
+        # an in-memory base that can't hand back its exact rows
+        return self._vectors is None and base is not None and (index_kind(base), index_codec(base)) != ('flat', 'f32')
+
+    def start_rebuild(self) -> bool:
+        """Claims the partition for a background rebuild: False if one is running or a failed one is backing off."""
+        with self.lock:
+            if self.rebuilding or time.monotonic() < self.retry_at:
+                return False
+            self.rebuilding = True
+            return True
+
+    def end_rebuild(self, ok: bool):
+        with self.lock:
+            self.rebuilding = False
+            self.failures = 0 if ok else self.failures + 1
+            if not ok:
+                self.retry_at = time.monotonic() + min(REBUILD_BACKOFF_MAX, REBUILD_BACKOFF * 2 ** (self.failures - 1))
+
+    def add(self, matrix: np.ndarray, infos: list[dict]) -> range:
+        matrix = np.ascontiguousarray(matrix, dtype='float32')
+        with self.lock:
+            rows = range(self.ntotal, self.ntotal + len(matrix))
+            self.delta.add(matrix)
+            self.info.extend(infos)
+            if self._lexical is not None:
+                self._lexical.add(info['metadata'].get('text', '') for info in infos)
+            return rows
+
+    def rows_of(self, file_name: str) -> list[int]:
+        """Live rows belonging to file_name."""
+        with self.lock:
+            return [row for row in self.info.rows_of_file(file_name).tolist() if row not in self.dead]
+
+    def tombstone(self, rows: list[int]):
+        with self.lock:
+            self.dead.update(rows)
+            self._selectors = None
+            self._scopes = {}
+
+    def swap(self, base: faiss.Index, covered_rows: int):
+        """Makes `base` (built over the first covered_rows rows) the new base; later rows move to a fresh delta."""
+        with self.lock:
+            delta = faiss.IndexFlatL2(self.dimension)
+            if self.ntotal > covered_rows:
+                delta.add(np.ascontiguousarray(self.vectors(covered_rows, self.ntotal), dtype='float32'))
+            if self._vectors is None:
+                self._raw = self.vectors(0, covered_rows) if self._keeps_raw(base) else None
+            self.base, self.delta = base, delta
+            self._selectors = None
+            self._scopes = {}
+
+    def replace_contents(self, base: faiss.Index | None, info: ChunkStore, dead: set[int],
+                         vectors: Callable[[int], np.ndarray] | None, raw: np.ndarray | None, rows: int):
+        """Swaps in a compacted copy of the partition: `rows` rows, the first base.ntotal of them in `base`."""
+        with self.lock:
+            self._vectors = vectors
+            self.info = info
+            self._lexical = None # rows moved, rebuilt from `info` on next use
+            self.base, self.delta = base, faiss.IndexFlatL2(self.dimension)
+            if rows > self.base_rows:
+                tail = self.vectors(self.base_rows, rows) if vectors is not None else raw[self.base_rows:rows]
+                self.delta.add(np.ascontiguousarray(tail, dtype='float32'))
+            self._raw = raw[:self.base_rows].copy() if self._keeps_raw(base) else None
+            self.dead = dead
+            self._selectors = None
+            self._scopes = {}
+
+    @property
+    def lexical(self) -> LexicalIndex:
+        with self.lock:
+            if self._lexical is None:
+                self._lexical = LexicalIndex.from_chunks(self.info)
+            return self._lexical
+
+    def search_lexical(self, query: str, k: int, scope: tuple | None = None) -> tuple[np.ndarray, np.ndarray]:
+        with self.lock:
+            if scope is None:
+                return self.lexical.search(query, k, self.dead)
+            return self.lexical.search(query, k, allowed=self._scoped(scope)[0])
+
+    def _get_selectors(self):
+        # local row numbers to skip in the base and in the delta, rebuilt whenever tombstones or the split change
+        if self._selectors is None:
+            dead = np.fromiter(self.dead, dtype='int64', count=len(self.dead))
+            selectors = []
+            for ids in (dead[dead < self.base_rows], dead[dead >= self.base_rows] - self.base_rows):
+                batch = faiss.IDSelectorBatch(ids)
+                selectors.append((faiss.IDSelectorNot(batch), batch)) # keep the inner selector alive too
+            self._selectors = selectors
+        return self._selectors
+
+    def _scoped(self, scope: tuple):
+        # (key, vector ids) -> the live rows holding those ids, and selectors keeping only them in base / delta
+        key, vector_ids = scope
+        if key not in self._scopes:
+            rows = self.info.find(vector_ids)
+            rows = rows[rows >= 0]
+            if self.dead:
+                rows = rows[~np.isin(rows, np.fromiter(self.dead, dtype='int64', count=len(self.dead)))]
+            selectors = []
+            for half in (rows[rows < self.base_rows], rows[rows >= self.base_rows] - self.base_rows):
+                batch = faiss.IDSelectorBatch(half)
+                selectors.append((batch, batch))
+            if len(self._scopes) >= 256: # one entry per user and version, old versions are never asked for again
+                self._scopes = {}
+            self._scopes[key] = (rows.astype('int64'), selectors)
+        return self._scopes[key]
+
+    def search(self, matrix: np.ndarray, k: int, rescore: int = 0,
+               scope: tuple | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        With a compressed base and rescore > 0, k * rescore candidates are fetched and re-ranked by exact
+        distance to the raw vectors. `scope` is (key, sorted vector ids) to only search those.
+        """
+        # faiss indexes aren't safe to read while they are being added to, so searches take the lock as well
+        with self.lock:
+            if scope is None:
+                live, selectors = self.live, self._get_selectors() if self.dead else None
+            else:
+                rows, selectors = self._scoped(scope)
+                live = len(rows)
+            k = min(k, live)
+            if k <= 0:
+                return np.zeros((len(matrix), 0), dtype='float32'), np.zeros((len(matrix), 0), dtype='int64')
+            if rescore <= 0 or self.codec == 'f32':
+                return self._search(matrix, k, selectors)
+            _, candidates = self._search(matrix, min(k * rescore, live), selectors)
+            return rescore_exact(matrix, self.vectors() if self._vectors is not None else _Exact(self),
+                                 candidates, k)
+
+    @staticmethod
+    def _search_one(index: faiss.Index, matrix: np.ndarray, k: int, selectors, which: int):
+        if selectors is None:
+            return index.search(matrix, k)
+        selector, _ = selectors[which]
+        return index.search(matrix, k, params=search_params(index, selector))
+
+    def _search(self, matrix: np.ndarray, k: int, selectors=None) -> tuple[np.ndarray, np.ndarray]:
+        if self.base is None or self.delta.ntotal == 0:
+            which = 0 if self.delta.ntotal == 0 else 1
+            index = self.base if which == 0 else self.delta
+            distances, indices = self._search_one(index, matrix, min(k, index.ntotal), selectors, which)
+            if which == 1:
+                indices = np.where(indices >= 0, indices + self.base_rows, indices)
+            return distances, indices
+
+        # merge the base's and the delta's candidates by distance
+        base_d, base_i = self._search_one(self.base, matrix, min(k, self.base_rows), selectors, 0)
+        delta_d, delta_i = self._search_one(self.delta, matrix, min(k, self.delta.ntotal), selectors, 1)
+        delta_i = np.where(delta_i >= 0, delta_i + self.base_rows, delta_i)
+
+        distances = np.concatenate([base_d, delta_d], axis=1)
+        indices = np.concatenate([base_i, delta_i], axis=1)
+        order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(indices, order, axis=1)
+
+
+class _Exact():
+    # vectors[rows] for rescore_exact on an in-memory partition, gathered without joining base and delta
+    def __init__(self, partition: Partition):
+        self.partition = partition
+
+    def __getitem__(self, rows: np.ndarray) -> np.ndarray:
+        return self.partition._exact_rows(np.asarray(rows))
@@ -0,0 +1,400 @@
+"""
+Faiss as a local retrieval service, so several app replicas share one index and search runs on more than one core.
+
+    python -m classes.retrieval --shards 4 --port 7070 --persist-dir faiss_store --embedder gemini
+
+RetrievalServer spawns one worker process per shard, each owning a plain Faiss over its own store directory.
+Users are hashed to shards, so every user's partition lives in exactly one of them. RetrievalClient stands in
+for Faiss in the app (main.py, the ingestion pipeline and IngestQueue): it embeds locally with its own embedder
+and ships vectors over a multiprocessing.connection socket.
+
+That socket carries pickles, so whoever can connect can run code in the server: there is no built in key.
+Pass a long random one with --authkey or RETRIEVAL_AUTHKEY (the app reads it from its secrets), and keep the
+port off untrusted networks.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Client, Connection, Listener
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from utils import Embedder, batch_embed_text, embed_chunks, embedder_spec, get_embedder, iter_chunks, runner
+from .faiss_ import RETRIEVAL_MODES
+from .index_types import CODECS
+
+logger = logging.getLogger(__name__)
+
+# what a shard worker will run for the router, nothing else gets through
+SHARD_METHODS = ('add_embedded', 'delete_doc', 'drop_ids', 'file_ids', 'has_chunks', 'query', 'query_many', 'stats')
+
+
+def shard_of(username: str, n_shards: int) -> int:
+    # stable across processes and restarts, unlike hash()
+    return int.from_bytes(hashlib.blake2b(username.encode(), digest_size=8).digest(), 'little') % n_shards
+
+
+def _shard_main(conn: Connection, persist_dir: str | None, embedder: str, faiss_kwargs: dict):
+    """Worker process: one Faiss, requests answered in order over `conn`."""
+    from .faiss_ import Faiss
+
+    faiss_agent = Faiss(persist_dir=persist_dir, embedder=get_embedder(embedder), **faiss_kwargs)
+    changes: list[tuple[str, str]] = []
+    faiss_agent.on_change.append(lambda username, file_name: changes.append((username, file_name)))
+
+    def stats() -> dict:
+        return {'users': len(faiss_agent.users()), 'dimension': faiss_agent.dimension,
+                'vectors': sum(p.live for p in faiss_agent.partitions.values())}
+
+    def add_embedded(username: str, embedded: list[dict], replace_file: str | None = None) -> list[int]:
+        faiss_agent.add_embedded(username, embedded, replace_file=replace_file)
+        return [info['id'] for info in embedded] # the ids are handed out here, the client's copies need them too
+
+    handlers = {'stats': stats, 'add_embedded': add_embedded, 'delete_doc': faiss_agent.delete_doc,
+                'file_ids': faiss_agent.file_ids, 'drop_ids': faiss_agent.drop_ids,
+                'has_chunks': faiss_agent.has_chunks,
+                'query': faiss_agent.query, 'query_many': faiss_agent.query_many}
+    conn.send(('ready', {**stats(), 'embedder': embedder_spec(faiss_agent.embedder)}))
+    while True:
+        try:
+            method, args, kwargs = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        try:
+            result = handlers[method](*args, **kwargs)
+            if asyncio.iscoroutine(result):
+                result = runner.run(result)
+            reply = (True, result, changes[:])
+        except Exception as e:
+            reply = (False, e, changes[:])
+        changes.clear()
+        try:
+            conn.send(reply)
+        except Exception as e: # an unpicklable result or exception
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}"), reply[2]))
+
+
+class _Shard():
+    def __init__(self, index: int, persist_dir: str | None, embedder: str, faiss_kwargs: dict):
+        self.index = index
+        self.conn, child = mp.get_context('spawn').Pipe()
+        self.process = mp.get_context('spawn').Process(target=_shard_main, args=(child, persist_dir, embedder, faiss_kwargs),
+                                                       daemon=True, name=f'retrieval-shard-{index}')
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock() # one request in flight per shard, the worker is single threaded anyway
+
+    def call(self, method: str, *args, **kwargs):
+        with self.lock:
+            self.conn.send((method, args, kwargs))
+            return self.conn.recv()
+
+
+class RetrievalServer():
+    """
+    Router in front of `n_shards` Faiss worker processes (spawned, one core each). Every request is routed by
+    user: single-user calls go to that user's shard; query_many and stats scatter to the shards involved in
+    parallel and gather the results back in request order.
+
+    Files replaced or deleted on any shard are appended to a change log, so every client can fire its own
+    on_change callbacks (answer cache invalidation) for changes made through other replicas.
+    """
+
+    def __init__(self, address=('127.0.0.1', 7070), n_shards: int = 4, persist_dir: str | Path | None = None, *,
+                 embedder: str = 'gemini', authkey: bytes, change_log: int = 10_000, **faiss_kwargs):
+        if not authkey:
+            raise ValueError("RetrievalServer needs an authkey, the transport unpickles what clients send")
+        self.address = address
+        self.n_shards = n_shards
+        self.persist_dir = Path(persist_dir) if persist_dir else None
+        self.embedder = embedder
+        self.authkey = authkey
+        self.faiss_kwargs = faiss_kwargs
+        self.shards: list[_Shard] = []
+        self.embedder_spec: dict | None = None
+        self.listener: Listener | None = None
+        self._changes: deque[tuple[int, str, str]] = deque(maxlen=change_log)
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=n_shards, thread_name_prefix='scatter')
+        self._closed = threading.Event()
+
+    def _shard_dirs(self) -> list[str | None]:
+        if self.persist_dir is None:
+            return [None] * self.n_shards
+        # the shard count is part of the layout: users would hash to different shards under another count
+        existing = {p.name for p in self.persist_dir.glob('shard-*')} if self.persist_dir.exists() else set()
+        wanted = [f'shard-{i}-of-{self.n_shards}' for i in range(self.n_shards)]
+        if existing - set(wanted):
+            raise ValueError(f"{self.persist_dir} holds shards {sorted(existing)}, not a {self.n_shards} shard layout")
+        return [str(self.persist_dir / name) for name in wanted]
+
+    def start(self) -> 'RetrievalServer':
+        self.shards = [_Shard(i, path, self.embedder, self.faiss_kwargs) for i, path in enumerate(self._shard_dirs())]
+        for shard in self.shards: # wait for every worker to load its partitions
+            status, stats = shard.conn.recv()
+            self.embedder_spec = stats.pop('embedder')
+            logger.info(f"Shard {shard.index} ready: {stats}")
+        self.listener = Listener(self.address, authkey=self.authkey)
+        self.address = self.listener.address # the real port when 0 was asked for
+        threading.Thread(target=self._accept, daemon=True, name='retrieval-accept').start()
+        logger.info(f"Retrieval server with {self.n_shards} shards on {self.address}")
+        return self
+
+    def serve_forever(self):
+        self.start()
+        self._closed.wait()
+
+    def close(self):
+        self._closed.set()
+        if self.listener is not None:
+            self.listener.close()
+        for shard in self.shards:
+            shard.conn.close()
+            shard.process.join(timeout=5)
+            if shard.process.is_alive():
+                shard.process.terminate()
+        self._pool.shutdown(wait=False)
+
+    def __enter__(self) -> 'RetrievalServer':
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _accept(self):
+        while not self._closed.is_set():
+            try:
+                conn = self.listener.accept()
+            except (OSError, EOFError):
+                if self._closed.is_set():
+                    return
+                continue
+            except Exception as e: # a client with the wrong authkey
+                logger.warning(f"Rejected retrieval client: {e}")
+                continue
+            threading.Thread(target=self._serve, args=(conn,), daemon=True, name='retrieval-conn').start()
+
+    def _serve(self, conn: Connection):
+        with conn:
+            while True:
+                try:
+                    method, args, kwargs = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (True, self._dispatch(method, *args, **kwargs), self._seq)
+                except Exception as e:
+                    reply = (False, e, self._seq)
+                try:
+                    conn.send(reply)
+                except Exception as e:
+                    conn.send((False, RuntimeError(f"{type(e).__name__}: {e}"), self._seq))
+
+    def _call(self, shard: _Shard, method: str, *args, **kwargs):
+        ok, result, changes = shard.call(method, *args, **kwargs)
+        if changes:
+            with self._lock:
+                for username, file_name in changes:
+                    self._seq += 1
+                    self._changes.append((self._seq, username, file_name))
+        if not ok:
+            raise result
+        return result
+
+    def _dispatch(self, method: str, *args, **kwargs):
+        if method == 'info':
+            return {'shards': self.n_shards, 'embedder': self.embedder_spec, 'seq': self._seq}
+        if method == 'changes':
+            since, = args
+            with self._lock:
+                return [change for change in self._changes if change[0] > since]
+        if method == 'stats':
+            per_shard = list(self._pool.map(lambda shard: self._call(shard, 'stats'), self.shards))
+            return {'shards': per_shard, 'users': sum(s['users'] for s in per_shard),
+                    'vectors': sum(s['vectors'] for s in per_shard)}
+        if method == 'query_many':
+            return self._query_many(*args, **kwargs)
+        if method not in SHARD_METHODS:
+            raise ValueError(f"Unknown retrieval method {method!r}")
+        username = kwargs['user_id'] if method == 'query' else args[0]
+        return self._call(self.shards[shard_of(username, self.n_shards)], method, *args, **kwargs)
+
+    def _query_many(self, queries: list[str], users: list[str], *, query_matrix: np.ndarray | None = None, **kwargs):
+        # scatter: each shard gets its users' queries (and vector rows) in one batched call
+        by_shard: dict[int, list[int]] = {}
+        for i, user in enumerate(users):
+            by_shard.setdefault(shard_of(user, self.n_shards), []).append(i)
+
+        def search(item):
+            shard, positions = item
+            rows = None if query_matrix is None else np.asarray(query_matrix)[positions]
+            return positions, self._call(self.shards[shard], 'query_many', [queries[i] for i in positions],
+                                         [users[i] for i in positions], query_matrix=rows, **kwargs)
+
+        # gather, back in request order
+        results = [None] * len(queries)
+        for positions, found in self._pool.map(search, by_shard.items()):
+            for i, result in zip(positions, found):
+                results[i] = result
+        return results
+
+
+class RetrievalClient():
+    """
+    Drop-in for Faiss backed by a RetrievalServer. Texts are embedded here, with `embedder` (which has to be
+    the one the server's index was built with), and only vectors travel. Connections are pooled, so Streamlit
+    sessions on different threads don't queue behind each other.
+    """
+
+    def __init__(self, address=('127.0.0.1', 7070), embedder: Embedder | None = None, *,
+                 authkey: bytes, pool_size: int = 8):
+        if not authkey:
+            raise ValueError("RetrievalClient needs the server's authkey")
+        self.address = address
+        self.authkey = authkey
+        self._pool: queue.LifoQueue[Connection] = queue.LifoQueue(maxsize=pool_size)
+        self.on_change: list[Callable[[str, str], None]] = []
+        self._changes_lock = threading.Lock()
+
+        info = self._request('info')
+        self._seen = info['seq'] # changes before we connected are already reflected in what we'll read
+        self.embedder = embedder or get_embedder()
+        if embedder_spec(self.embedder) != info['embedder']:
+            raise ValueError(f"Retrieval server index uses embedder {info['embedder']}, "
+                             f"not {embedder_spec(self.embedder)}")
+        self.n_shards = info['shards']
+
+    def _request(self, method: str, *args, **kwargs):
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = Client(self.address, authkey=self.authkey)
+        try:
+            conn.send((method, args, kwargs))
+            ok, result, seq = conn.recv()
+        except (EOFError, OSError):
+            conn.close()
+            raise
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+        if method not in ('info', 'changes') and seq > self._seen:
+            self._sync_changes()
+        if not ok:
+            raise result
+        return result
+
+    def _sync_changes(self):
+        # replaced/deleted files, from this client or any other, reach our on_change callbacks (the answer cache)
+        with self._changes_lock:
+            for seq, username, file_name in self._request('changes', self._seen):
+                self._seen = max(self._seen, seq)
+                for callback in self.on_change:
+                    callback(username, file_name)
+
+    async def _arequest(self, method: str, *args, **kwargs):
+        return await asyncio.to_thread(self._request, method, *args, **kwargs)
+
+    @property
+    def dimension(self) -> int:
+        return self.embedder.dimension
+
+    def stats(self) -> dict:
+        return self._request('stats')
+
+    def add_embedded(self, username: str, embedded: list[dict], replace_file: str | None = None) -> int:
+        ids = self._request('add_embedded', username, embedded, replace_file=replace_file)
+        for info, vector_id in zip(embedded, ids):
+            info['id'] = vector_id
+        return len(ids)
+
+    def delete_doc(self, username: str, file_name: str) -> int:
+        return self._request('delete_doc', username, file_name)
+
+    def file_ids(self, username: str, file_name: str) -> set[int]:
+        return self._request('file_ids', username, file_name)
+
+    def has_chunks(self, username: str) -> bool:
+        return self._request('has_chunks', username)
+
+    def drop_ids(self, username: str, file_name: str, vector_ids) -> int:
+        return self._request('drop_ids', username, file_name, set(vector_ids))
+
+    async def upsert_doc(self, texts: str, username: str, metadata: dict, embed_method: str = "RETRIEVAL_DOCUMENT") -> int:
+        embedded = await embed_chunks(iter_chunks(texts), method=embed_method, id=username, metadata=metadata,
+                                      embedder=self.embedder)
+        return await asyncio.to_thread(self.add_embedded, username, embedded)
+
+    async def replace_doc(self, texts: str, username: str, metadata: dict, embed_method: str = "RETRIEVAL_DOCUMENT") -> int:
+        embedded = await embed_chunks(iter_chunks(texts), method=embed_method, id=username, metadata=metadata,
+                                      embedder=self.embedder)
+        return await asyncio.to_thread(self.add_embedded, username, embedded, replace_file=metadata['file_name'])
+
+    async def embed_query(self, texts: str, embed_method: str = 'RETRIEVAL_QUERY') -> np.ndarray:
+        queried = await batch_embed_text(texts, method=embed_method, embedder=self.embedder)
+        return np.array([queried[0]['values']]).astype('float32')
+
+    async def query(self, *, texts: str, user_id: str, embed_method: str = 'RETRIEVAL_QUERY', top_k: int = 3,
+                    query_vector: np.ndarray | None = None, mode: str = 'dense') -> list[dict[str, str]] | None:
+        if mode not in RETRIEVAL_MODES:
+            raise ValueError(f"Unknown retrieval mode {mode!r}, expected one of {RETRIEVAL_MODES}")
+        if mode != 'lexical' and query_vector is None:
+            query_vector = await self.embed_query(texts, embed_method)
+        return await self._arequest('query', texts=texts, user_id=user_id, top_k=top_k,
+                                    query_vector=query_vector, mode=mode)
+
+    async def query_many(self, queries: list[str], user_id: str | list[str], embed_method: str = 'RETRIEVAL_QUERY',
+                         top_k: int = 3, mode: str = 'dense',
+                         query_matrix: np.ndarray | None = None) -> list[list[dict[str, str]] | None]:
+        if not queries:
+            return []
+        users = [user_id] * len(queries) if isinstance(user_id, str) else list(user_id)
+        if mode != 'lexical' and query_matrix is None:
+            queried = await batch_embed_text(queries, method=embed_method, embedder=self.embedder)
+            query_matrix = np.asarray([q['values'] for q in queried], dtype='float32')
+        return await self._arequest('query_many', queries, users, top_k=top_k, mode=mode, query_matrix=query_matrix)
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=7070)
+    parser.add_argument('--shards', type=int, default=max(1, mp.cpu_count() // 2))
+    parser.add_argument('--persist-dir', help='shards persist under <dir>/shard-<i>-of-<n>; in memory without it')
+    parser.add_argument('--embedder', default='gemini', help='gemini[:model], hashing[:dimension] or local:<path>')
+    parser.add_argument('--index-type', default='flat')
+    parser.add_argument('--promote-at', type=int, default=50_000)
+    parser.add_argument('--codec', default='f32', choices=CODECS)
+    parser.add_argument('--rescore', type=int, default=4)
+    parser.add_argument('--dedup', action='store_true',
+                        help="store each distinct chunk once per shard, shared by the users who uploaded it")
+    parser.add_argument('--authkey', default=os.environ.get('RETRIEVAL_AUTHKEY'),
+                        help='shared secret clients must present (default: $RETRIEVAL_AUTHKEY), required')
+    args = parser.parse_args()
+    if not args.authkey:
+        parser.error("no authkey: pass --authkey or set RETRIEVAL_AUTHKEY")
+
+    RetrievalServer((args.host, args.port), args.shards, args.persist_dir, embedder=args.embedder,
+                    authkey=args.authkey.encode(), index_type=args.index_type,
+                    promote_at=args.promote_at, codec=args.codec, rescore=args.rescore,
+                    dedup=args.dedup).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
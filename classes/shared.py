@@ -0,0 +1,147 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from .metadata import StringTable, _append
+
+# one record per reference added (+1) or dropped (-1): vector `id` is part of `user`'s file `file`
+REF = np.dtype([('id', '<i8'), ('user', '<i4'), ('file', '<i4'), ('op', '<i4')])
+
+REFS = 'refs.bin'
+USERS = 'users.jsonl'
+FILES = 'files.jsonl'
+
+
+def chunk_digest(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+
+class SharedChunks():
+    """
+    Bookkeeping for a deduplicated Faiss (dedup=True): every distinct chunk text is stored, embedded and
+    searched once, in one shared partition, and users see it through references.
+
+    A reference says vector `id` is part of a user's file. Each user's visible vector ids are the union over
+    their files; a vector nobody references any more is tombstoned by Faiss. `digests` maps the hash of each
+    live chunk's text to its vector id, so an upload only adds the chunks nobody has uploaded before.
+
+    With a `path` references are an append log (refs.bin, plus interned users.jsonl/files.jsonl) replayed at
+    open; `digests` is rebuilt from the shared partition's text by Faiss.
+    """
+
+    def __init__(self, path: str | Path | None = None):
+        self.path = Path(path) if path is not None else None
+        if self.path is not None:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.users = StringTable(self.path / USERS if self.path else None)
+        self.files = StringTable(self.path / FILES if self.path else None)
+        self.digests: dict[bytes, int] = {}
+        self._files: dict[int, dict[int, set[int]]] = {} # user -> file -> vector ids
+        self._refs: dict[int, int] = {} # vector id -> how many (user, file) pairs reference it
+        self._visible: dict[int, np.ndarray] = {} # user -> sorted vector ids, dropped whenever their files change
+        self._versions: dict[int, int] = {}
+        self._version = 0
+        if self.path is not None:
+            self._replay()
+
+    def _replay(self):
+        path = self.path / REFS
+        path.touch()
+        size = path.stat().st_size
+        if size % REF.itemsize: # torn tail
+            os.truncate(path, size - size % REF.itemsize)
+        records = np.fromfile(path, dtype=REF)
+        for vector_id, user, file, op in records.tolist():
+            ids = self._files.setdefault(user, {}).setdefault(file, set())
+            if op > 0:
+                ids.add(vector_id)
+            else:
+                ids.discard(vector_id)
+        for user, files in self._files.items():
+            for ids in files.values():
+                for vector_id in ids:
+                    self._refs[vector_id] = self._refs.get(vector_id, 0) + 1
+            self._files[user] = {file: ids for file, ids in files.items() if ids}
+
+        # re-uploads and deletes leave records that cancel out, rewrite the log once they dominate it
+        if len(records) > 2 * sum(self._refs.values()) + 1024:
+            self._rewrite()
+
+    def _rewrite(self):
+        records = [(vector_id, user, file, 1) for user, files in self._files.items()
+                   for file, ids in files.items() for vector_id in sorted(ids)]
+        tmp = self.path / (REFS + '.tmp')
+        with open(tmp, 'wb') as f:
+            f.write(np.asarray(records, dtype=REF).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path / REFS)
+
+    def set_file(self, username: str, file_name: str, vector_ids) -> tuple[set[int], list[int]]:
+        """
+        Makes `vector_ids` the chunks of the user's file. Returns the ids it referenced before, and the ids that
+        no longer have any reference at all (for the caller to tombstone).
+        """
+        user, file = self.users.intern(username), self.files.intern(file_name)
+        files = self._files.setdefault(user, {})
+        old, new = files.get(file, set()), set(vector_ids)
+        dropped, added = old - new, new - old
+        if not dropped and not added:
+            return old, []
+
+        if self.path is not None:
+            records = [(i, user, file, -1) for i in sorted(dropped)] + [(i, user, file, 1) for i in sorted(added)]
+            _append(self.path / REFS, np.asarray(records, dtype=REF).tobytes())
+
+        orphaned = []
+        for vector_id in added:
+            self._refs[vector_id] = self._refs.get(vector_id, 0) + 1
+        for vector_id in dropped:
+            self._refs[vector_id] -= 1
+            if not self._refs[vector_id]:
+                del self._refs[vector_id]
+                orphaned.append(vector_id)
+        if new:
+            files[file] = new
+        else:
+            files.pop(file, None)
+        self._visible.pop(user, None)
+        self._version += 1
+        self._versions[user] = self._version
+        return old, orphaned
+
+    def file_ids(self, username: str, file_name: str) -> set[int]:
+        user, file = self.users.index.get(username), self.files.index.get(file_name)
+        return set(self._files.get(user, {}).get(file, ()))
+
+    def visible(self, username: str) -> np.ndarray:
+        """Sorted vector ids the user can see."""
+        user = self.users.index.get(username)
+        if user is None or not self._files.get(user):
+            return np.zeros(0, dtype='int64')
+        if user not in self._visible:
+            ids = set().union(*self._files[user].values())
+            self._visible[user] = np.sort(np.fromiter(ids, dtype='int64', count=len(ids)))
+        return self._visible[user]
+
+    def scope(self, username: str) -> tuple[tuple, np.ndarray]:
+        # (a key that changes whenever the user's references do, their vector ids), see Partition.search
+        return (username, self._versions.get(self.users.index.get(username), 0)), self.visible(username)
+
+    def file_of(self, username: str, vector_id: int) -> str:
+        for file, ids in self._files.get(self.users.index.get(username), {}).items():
+            if vector_id in ids:
+                return self.files.values[file]
+        return ''
+
+    def referenced(self, vector_ids: np.ndarray) -> np.ndarray:
+        return np.fromiter((int(i) in self._refs for i in vector_ids), dtype=bool, count=len(vector_ids))
+
+    def usernames(self) -> list[str]:
+        return [self.users.values[user] for user, files in self._files.items() if files]
+
+    def stats(self) -> dict[str, int]:
+        return {'users': len(self.usernames()), 'unique_chunks': len(self._refs),
+                'references': sum(len(ids) for files in self._files.values() for ids in files.values())}
@@ -0,0 +1,406 @@
+import faiss, numpy as np
+import hashlib
+import json
+import logging
+import os
+import shutil
+import struct
+import threading
+from pathlib import Path
+
+from .index_types import build_index, read_index
+from .metadata import CHUNKS, FILES, TEXT, USERS, ChunkStore
+from .partition import Partition, remap_rows
+
+logger = logging.getLogger(__name__)
+
+# bump whenever the on-disk layout changes; older versions are migrated when there is a migration for them,
+# and refused otherwise instead of being misread
+FORMAT_VERSION = 4
+
+MANIFEST = 'manifest.json'
+SNAPSHOT = 'index.faiss'
+VECTORS = 'vectors.f32'
+META = 'meta.jsonl' # format <= 2 only
+TOMBSTONES = 'tombstones.i64'
+
+# a flat float32 snapshot is faiss's IndexFlatL2 file: 'IxF2', d, ntotal (int64 at 8), two dummies, is_trained,
+# metric, the float count (uint64 at 37), then the vectors. Appending to it in place only writes the new rows.
+FLAT_FOURCC = b'IxF2'
+FLAT_HEADER = 45
+
+# stores written before the embedder was recorded in the manifest were all gemini
+LEGACY_EMBEDDER = {'name': 'models/gemini-embedding-001', 'dimension': 768, 'metric': 'l2'}
+
+
+def _atomic_write(path: Path, data: bytes):
+    tmp = path.with_suffix(path.suffix + '.tmp')
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class IndexStore():
+    """
+    On-disk home of the Faiss partitions.
+
+    Layout (FORMAT_VERSION 4):
+        manifest.json              format version, dimension, embedder, dedup and username -> partition dir
+        <partition>/vectors.f32    append log of raw float32 vectors
+        <partition>/chunks.bin     append log of fixed-width chunk records (see metadata.ChunkStore)
+        <partition>/text.bin       append log of chunk text
+        <partition>/files.jsonl    interned file names (users.jsonl likewise for user ids)
+        <partition>/tombstones.i64 append log of deleted row numbers; a negative entry -n makes the rows after it
+                                   count only once the logs hold n rows (see append_tombstones)
+        <partition>/index.faiss    periodic snapshot of the first N vectors (flat, or the promoted ANN type);
+                                   a flat one is extended in place with the rows added since
+        shared/                    with dedup, the one shared partition's references (see shared.SharedChunks)
+
+    Every upsert is appended (and fsync'd) to the logs. Replacing a file logs the old copy's tombstones first,
+    conditional on the new rows, so after a crash exactly one of the two copies is live. Snapshots are written to a temp file and renamed in,
+    so a crash at any point leaves either the old or the new snapshot plus logs to replay on top of it.
+    Compaction writes a whole new partition dir and only then points the manifest at it.
+
+    Older stores are migrated in place when opened: 1 -> 2 swaps uuid ids for integer ids, 2 -> 3 converts
+    meta.jsonl into the columnar chunk store, 3 -> 4 only bumps the version (v3 tombstones are all unconditional).
+
+    `embedder` (name, dimension, metric) is recorded on creation; opening the store with a different one raises
+    rather than searching one model's vectors with another model's queries. `dedup` likewise: a deduplicated
+    store holds a single shared partition instead of one per user, and can't be opened as the other kind.
+    """
+
+    def __init__(self, root: str | Path, snapshot_every: int = 5000, embedder: dict | None = None,
+                 dedup: bool = False):
+        self.root = Path(root)
+        self.snapshot_every = snapshot_every
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._snapshot_lock = threading.Lock()
+        self.manifest = self._read_manifest()
+        if self.manifest.get('embedder') is None:
+            self.manifest['embedder'] = LEGACY_EMBEDDER if self.manifest['partitions'] else embedder
+        if embedder is not None and self.manifest['embedder'] not in (None, embedder):
+            raise ValueError(f"Index store at {self.root} was built with embedder {self.manifest['embedder']}, "
+                             f"not {embedder}; re-ingest into a new persist dir to switch embedders")
+        if self.manifest.get('dedup') is None:
+            self.manifest['dedup'] = False if self.manifest['partitions'] else dedup
+        if self.manifest['dedup'] != dedup:
+            raise ValueError(f"Index store at {self.root} was built with dedup={self.manifest['dedup']}, "
+                             f"not dedup={dedup}; re-ingest into a new persist dir to switch")
+
+    def _read_manifest(self) -> dict:
+        path = self.root / MANIFEST
+        if not path.exists():
+            return {'format_version': FORMAT_VERSION, 'dimension': None, 'partitions': {}}
+
+        manifest = json.loads(path.read_text())
+        if manifest.get('format_version') == 1:
+            manifest = self._migrate_v1(manifest)
+        if manifest.get('format_version') == 2:
+            manifest = self._migrate_v2(manifest)
+        if manifest.get('format_version') == 3:
+            manifest = self._migrate_v3(manifest)
+        if manifest.get('format_version') != FORMAT_VERSION:
+            raise ValueError(f"Index store at {self.root} has format version {manifest.get('format_version')}, "
+                             f"expected {FORMAT_VERSION}")
+        return manifest
+
+    def _migrate_v1(self, manifest: dict) -> dict:
+        # v1 meta lines carried uuid4 ids, give every chunk an integer vector id instead
+        next_id = 0
+        for dirname in manifest['partitions'].values():
+            meta_path = self.root / dirname / META
+            tmp = meta_path.with_suffix('.tmp')
+            with open(meta_path, 'rb') as src, open(tmp, 'wb') as dst:
+                for line in src:
+                    if not line.endswith(b'\n'):
+                        break # torn tail, recovery would have cut it anyway
+                    record = json.loads(line)
+                    record['id'] = next_id
+                    next_id += 1
+                    dst.write(json.dumps(record).encode() + b'\n')
+                dst.flush()
+                os.fsync(dst.fileno())
+            os.replace(tmp, meta_path)
+
+        manifest['format_version'] = 2
+        self.manifest = manifest
+        self._write_manifest()
+        logger.info(f"Migrated index store at {self.root} from format 1 to 2")
+        return manifest
+
+    def _migrate_v2(self, manifest: dict) -> dict:
+        # meta.jsonl (one json dict per chunk) -> columnar chunks.bin/text.bin
+        for dirname in manifest['partitions'].values():
+            path = self.root / dirname
+            for leftover in (CHUNKS, TEXT, FILES, USERS):
+                (path / leftover).unlink(missing_ok=True) # from a migration that crashed half way
+
+            chunks = ChunkStore(path)
+            batch = []
+            with open(path / META, 'rb') as f:
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    batch.append(json.loads(line))
+                    if len(batch) == 10_000:
+                        chunks.extend(batch)
+                        batch = []
+            chunks.extend(batch)
+
+        manifest['format_version'] = 3
+        self.manifest = manifest
+        self._write_manifest()
+        for dirname in manifest['partitions'].values():
+            (self.root / dirname / META).unlink(missing_ok=True)
+        logger.info(f"Migrated index store at {self.root} from format 2 to 3")
+        return manifest
+
+    def _migrate_v3(self, manifest: dict) -> dict:
+        # v4 only adds conditional tombstones, which v3 logs never contain
+        manifest['format_version'] = 4
+        self.manifest = manifest
+        self._write_manifest()
+        logger.info(f"Migrated index store at {self.root} from format 3 to 4")
+        return manifest
+
+    def _write_manifest(self):
+        _atomic_write(self.root / MANIFEST, json.dumps(self.manifest, indent=2).encode())
+
+    def _dir(self, username: str) -> Path:
+        return self.root / self.manifest['partitions'][username]
+
+    @property
+    def shared_dir(self) -> Path:
+        return self.root / 'shared'
+
+    @property
+    def dimension(self) -> int | None:
+        return self.manifest['dimension']
+
+    def new_partition(self, username: str, dimension: int) -> Partition:
+        if self.manifest['dimension'] is None:
+            self.manifest['dimension'] = dimension
+        # usernames are free text, so the directory is named after a hash of it
+        dirname = hashlib.sha1(username.encode()).hexdigest()[:16]
+        (self.root / dirname).mkdir(exist_ok=True)
+        self.manifest['partitions'][username] = dirname
+        self._write_manifest()
+        return Partition(dimension, info=ChunkStore(self.root / dirname),
+                         vectors=lambda rows: self.vectors(username, rows))
+
+    def append(self, username: str, matrix: np.ndarray):
+        """
+        Appends new rows to the vector log. Called before the rows are added to the partition, so anything that
+        reads partition.vectors() finds them on disk. Metadata goes through partition.info (a ChunkStore).
+        """
+        with open(self._dir(username) / VECTORS, 'ab') as f:
+            f.write(np.ascontiguousarray(matrix, dtype='float32').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def append_tombstones(self, username: str, rows: list[int], once_rows: int | None = None):
+        """
+        Appends deleted row numbers. With `once_rows` they only count once the logs hold that many rows: a
+        replace logs the old copy's tombstones this way before appending the new copy, so a crash in between
+        leaves the old copy live and a crash after leaves only the new one.
+        """
+        entries = np.asarray(rows, dtype='int64')
+        if once_rows is not None:
+            entries = np.concatenate([np.asarray([-once_rows], dtype='int64'), entries])
+        with open(self._dir(username) / TOMBSTONES, 'ab') as f:
+            f.write(entries.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def maybe_snapshot(self, username: str, partition: Partition):
+        # claims the partition the way a promotion/compaction does: one in flight writes its own snapshot when it
+        # is done, and none can start (and move the directory or the snapshot file) while this one is written
+        if partition.delta.ntotal < self.snapshot_every or not partition.start_rebuild():
+            return
+        ok = False
+        try:
+            self.snapshot(username, partition)
+            ok = True
+        finally:
+            partition.end_rebuild(ok)
+
+    def vectors(self, username: str, rows: int) -> np.ndarray:
+        path = self._dir(username) / VECTORS
+        if rows == 0:
+            return np.zeros((0, self.dimension), dtype='float32')
+        return np.memmap(path, dtype='float32', mode='r', shape=(rows, self.dimension))
+
+    def snapshot(self, username: str, partition: Partition):
+        with self._snapshot_lock:
+            with partition.lock:
+                base, covered = partition.base, partition.ntotal
+
+            if base is None:
+                index = self.write_snapshot(username, build_index('flat', partition.vectors(0, covered)))
+            elif (partition.kind, partition.codec) == ('flat', 'f32'):
+                # the snapshot already holds base.ntotal rows, only the delta is written
+                index = self._extend_flat(username, partition, base.ntotal, covered)
+            else:
+                # keep the trained ANN index (or codec), just fold the delta rows into a copy of it
+                index = faiss.clone_index(base)
+                index.add(np.ascontiguousarray(partition.vectors(base.ntotal, covered), dtype='float32'))
+                index = self.write_snapshot(username, index)
+
+            partition.swap(index, covered)
+        logger.info(f"Snapshotted {covered} vectors for partition {self.manifest['partitions'][username]}")
+
+    def _extend_flat(self, username: str, partition: Partition, start: int, stop: int) -> faiss.Index:
+        # rows first, then the header that counts them in one write: a crash in between leaves bytes past the
+        # end of a valid snapshot, which faiss never reads and the next snapshot notices and rewrites
+        path = self._dir(username) / SNAPSHOT
+        with open(path, 'r+b') as f:
+            header = bytearray(f.read(FLAT_HEADER))
+            expected = (header[:4] == FLAT_FOURCC and struct.unpack_from('<q', header, 8)[0] == start
+                        and struct.unpack_from('<Q', header, 37)[0] == start * self.dimension
+                        and os.fstat(f.fileno()).st_size == FLAT_HEADER + start * 4 * self.dimension)
+            if expected:
+                f.seek(0, os.SEEK_END)
+                vectors = partition.vectors(start, stop)
+                for block in range(0, len(vectors), 65536):
+                    f.write(np.ascontiguousarray(vectors[block:block + 65536], dtype='float32').tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+                struct.pack_into('<q', header, 8, stop)
+                struct.pack_into('<Q', header, 37, stop * self.dimension)
+                os.pwrite(f.fileno(), bytes(header), 0)
+                os.fsync(f.fileno())
+
+        if not expected:
+            logger.info(f"Flat snapshot of partition {path.parent.name} isn't the {start} rows expected, rewriting it")
+            return self.write_snapshot(username, build_index('flat', partition.vectors(0, stop)))
+        return read_index(str(path))
+
+    def write_snapshot(self, username: str, index: faiss.Index) -> faiss.Index:
+        """Atomically replaces the partition's snapshot with `index` and returns it reopened from disk."""
+        path = self._dir(username) / SNAPSHOT
+        tmp = path.with_suffix('.tmp')
+        faiss.write_index(index, str(tmp))
+        with open(tmp, 'rb') as f:
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        del index
+        return read_index(str(path))
+
+    def compact(self, username: str, partition: Partition, kind: str, codec: str = 'f32'):
+        """
+        Rewrites the partition without its tombstoned rows into a fresh directory, then points the manifest at it.
+        The bulk of the copy runs without the partition lock; only rows/tombstones that arrived meanwhile are
+        carried over under it.
+        """
+        with partition.lock:
+            covered, dead = partition.ntotal, set(partition.dead)
+        live = np.setdiff1d(np.arange(covered), np.fromiter(dead, dtype='int64', count=len(dead)))
+
+        old_dirname = self.manifest['partitions'][username]
+        stem, _, generation = old_dirname.partition('-g')
+        new_dirname = f"{stem}-g{int(generation or 0) + 1}"
+        new_dir = self.root / new_dirname
+        shutil.rmtree(new_dir, ignore_errors=True) # leftovers of a compaction that crashed
+        new_dir.mkdir()
+
+        chunks = ChunkStore(new_dir)
+        with open(new_dir / VECTORS, 'wb') as f:
+            vectors = partition.vectors(0, covered)
+            for start in range(0, len(live), 65536):
+                f.write(np.ascontiguousarray(vectors[live[start:start + 65536]], dtype='float32').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        chunks.copy_rows(partition.info, live)
+
+        base = None
+        if len(live):
+            index = build_index(kind, np.memmap(new_dir / VECTORS, dtype='float32', mode='r',
+                                                shape=(len(live), self.dimension)), codec)
+            faiss.write_index(index, str(new_dir / SNAPSHOT))
+            del index
+            with open(new_dir / SNAPSHOT, 'rb') as f:
+                os.fsync(f.fileno())
+
+        with partition.lock:
+            extra = np.arange(covered, partition.ntotal)
+            with open(new_dir / VECTORS, 'ab') as f:
+                f.write(np.ascontiguousarray(partition.vectors(covered, partition.ntotal), dtype='float32').tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            chunks.copy_rows(partition.info, extra)
+
+            new_dead = remap_rows(partition.dead - dead, live, covered)
+            with open(new_dir / TOMBSTONES, 'wb') as f:
+                f.write(np.asarray(sorted(new_dead), dtype='int64').tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+            self.manifest['partitions'][username] = new_dirname
+            self._write_manifest()
+
+            if len(live):
+                base = read_index(str(new_dir / SNAPSHOT))
+            partition.replace_contents(base, chunks, new_dead,
+                                       lambda rows: self.vectors(username, rows), None, len(live) + len(extra))
+
+        shutil.rmtree(self.root / old_dirname, ignore_errors=True)
+        logger.info(f"Compacted partition {new_dirname}: dropped {len(dead)} rows, {len(live) + len(extra)} left")
+
+    def _recover(self, path: Path) -> tuple[ChunkStore, int]:
+        """Opens the partition's chunk store and cuts it and the vector log back to the rows both have in full."""
+        chunks = ChunkStore(path)
+        vec_path = path / VECTORS
+        row_bytes = 4 * self.dimension
+
+        vec_rows = vec_path.stat().st_size // row_bytes if vec_path.exists() else 0
+        rows = min(len(chunks), vec_rows)
+
+        # a crash mid-append leaves a torn tail on one or both logs
+        if len(chunks) != rows:
+            chunks.truncate(rows)
+        if vec_path.exists() and vec_path.stat().st_size != rows * row_bytes:
+            os.truncate(vec_path, rows * row_bytes)
+        return chunks, rows
+
+    def _tombstones(self, path: Path, rows: int) -> set[int]:
+        tomb_path = path / TOMBSTONES
+        if not tomb_path.exists():
+            return set()
+        size = tomb_path.stat().st_size
+        if size % 8: # torn tail
+            os.truncate(tomb_path, size - size % 8)
+        entries = np.fromfile(tomb_path, dtype='int64')
+        # a -n marker whose rows never made it to the logs is from a replace that crashed half way; it's cut off
+        # (with everything after it) so rows appended later can't make it count
+        unmet = np.flatnonzero((entries < 0) & (-entries > rows))
+        if len(unmet):
+            os.truncate(tomb_path, int(unmet[0]) * 8)
+            entries = entries[:unmet[0]]
+        dead = entries[entries >= 0]
+        return set(dead[dead < rows].tolist())
+
+    def load(self) -> dict[str, Partition]:
+        partitions = {}
+        for username, dirname in self.manifest['partitions'].items():
+            path = self.root / dirname
+            chunks, rows = self._recover(path)
+
+            base = None
+            if (path / SNAPSHOT).exists():
+                base = read_index(str(path / SNAPSHOT))
+                if base.ntotal > rows:
+                    raise ValueError(f"Snapshot of partition {dirname} is ahead of its logs ({base.ntotal} > {rows})")
+
+            partition = Partition(self.dimension, base=base, info=chunks,
+                                  vectors=lambda rows, username=username: self.vectors(username, rows),
+                                  dead=self._tombstones(path, rows))
+            # replay whatever was appended after the last snapshot
+            if rows > partition.base_rows:
+                partition.delta.add(np.ascontiguousarray(partition.vectors(partition.base_rows, rows)))
+            partitions[username] = partition
+
+        logger.info(f"Loaded {len(partitions)} partitions from {self.root}")
+        return partitions
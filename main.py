@@ -4,23 +4,21 @@ try:
 except Exception:
     pass
 
-from classes import Faiss
-from utils import groq_generate, parse, transcribe, render_unified_input, apply_premium_theme
-import asyncio
+from classes import Faiss, AnswerCache, RetrievalClient
+from utils import groq_generate, transcribe, render_unified_input, apply_premium_theme, pack_prompt
+from utils import IngestQueue, get_parser_pool, render_ingest_jobs
+from utils import tracer, render_trace_panel, get_embedder, runner, as_bool
 import streamlit as st
-import base64
-from google import genai
-from groq import Groq
 import hashlib 
-import tempfile
-from pathlib import Path
 
 apply_premium_theme()
-GOOGLE_API_KEY = st.secrets["general"]["GOOGLE_API_KEY"]
-client = genai.Client(api_key=GOOGLE_API_KEY)
 
-GROQ_API_KEY = st.secrets["general"]["GROQ_API_KEY"]
-groq_client = Groq(api_key=GROQ_API_KEY)
+# per-stage latency tracing, off unless TRACING is set (or CHANDRA_TRACING in the environment)
+tracer.enabled = tracer.enabled or as_bool(st.secrets["general"].get("TRACING", False))
+if tracer.enabled and st.secrets["general"].get("TRACE_PORT"):
+    tracer.serve(int(st.secrets["general"]["TRACE_PORT"])) # /metrics and /spans
+# async work (embedding, search, generation, transcription) all runs on utils' runner loop, so the API
+# clients and their keep-alive connections live as long as the app instead of one asyncio.run
 
 # --- Session State Initialization ---
 # This variable will control whether the username has been entered
@@ -50,9 +48,49 @@ else:
 
     @st.cache_resource
     def get_faiss_agent():
-        return Faiss()
+        embedder = get_embedder(st.secrets["general"].get("EMBEDDER", "gemini"))
+        # replicas share one index through a retrieval server (python -m classes.retrieval) when one is configured
+        if st.secrets["general"].get("RETRIEVAL_SERVER"):
+            host, port = st.secrets["general"]["RETRIEVAL_SERVER"].rsplit(":", 1)
+            # the server's shared secret, there's no default (the transport is pickle)
+            if not st.secrets["general"].get("RETRIEVAL_AUTHKEY"):
+                raise ValueError("RETRIEVAL_SERVER is set but RETRIEVAL_AUTHKEY isn't")
+            return RetrievalClient((host, int(port)), embedder,
+                                   authkey=st.secrets["general"]["RETRIEVAL_AUTHKEY"].encode())
+        # vectors survive restarts/redeploys, they are reopened memory-mapped from here
+        return Faiss(persist_dir=st.secrets["general"].get("INDEX_DIR", "faiss_store"),
+                     index_type=st.secrets["general"].get("INDEX_TYPE", "flat"),
+                     promote_at=int(st.secrets["general"].get("INDEX_PROMOTE_AT", 50_000)),
+                     # f32 / f16 / sq8 / pq vectors in promoted partitions, re-ranked on exact ones (0 = don't)
+                     codec=st.secrets["general"].get("INDEX_CODEC", "f32"),
+                     rescore=int(st.secrets["general"].get("INDEX_RESCORE", 4)),
+                     # one shared copy of every distinct chunk instead of one per uploading user
+                     dedup=as_bool(st.secrets["general"].get("INDEX_DEDUP", False)),
+                     # "gemini", "hashing" (offline, CPU only) or "local:<path to sentence-transformers weights>"
+                     embedder=embedder)
     
+    @st.cache_resource
+    def get_answer_cache():
+        cache = AnswerCache(threshold=float(st.secrets["general"].get("ANSWER_CACHE_THRESHOLD", 0.95)))
+        # answers built on a file go stale the moment that file is replaced or deleted
+        get_faiss_agent().on_change.append(cache.invalidate)
+        return cache
+
+    @st.cache_resource
+    def get_ingest_queue():
+        # one worker for every session; jobs (and their uploaded files) persist in JOBS_DIR across restarts
+        # each run takes up to INGEST_BATCH of a user's files through the staged pipeline together, parsing
+        # with as many of them at once as the parser pool has workers
+        queue = IngestQueue(st.secrets["general"].get("JOBS_DIR", "ingest_jobs"), get_faiss_agent(),
+                            concurrency=int(st.secrets["general"].get("INGEST_CONCURRENCY", 2)),
+                            batch=int(st.secrets["general"].get("INGEST_BATCH", 8)),
+                            parse_workers=get_parser_pool().workers)
+        queue.start()
+        return queue
+
     faiss_agent = get_faiss_agent()
+    answer_cache = get_answer_cache()
+    ingest_queue = get_ingest_queue()
     # 
     # faiss_agent.index. #i wanted to see if it'll have similarity_search,(unless you loaded it from LangChain)
 
@@ -67,11 +105,6 @@ else:
     if 'audio_key' not in st.session_state:
         st.session_state.audio_key = 0
 
-    def track_queries(query: str, previous_interactions: list[str]) -> str:
-        interactions= '\n\n'.join(previous_interactions)
-        augment_prompt = f'''\nPrevious interactions: {interactions}\nCurrent Query: {query}'''
-        return augment_prompt
-
     if 'processed_file_metadata' not in st.session_state:
         st.session_state.processed_file_metadata = {}
 
@@ -81,49 +114,35 @@ else:
         accept_multiple_files=True,
     )
 
+    # file name -> (hash, job id) of what this session submitted; a file taken out of the uploader is forgotten,
+    # so putting it back submits it again
+    processed = st.session_state.processed_file_metadata
+    for name in processed.keys() - {uploaded_file.name for uploaded_file in uploaded_files or ()}:
+        del processed[name]
+
     if uploaded_files:
-        file_names = [f.name for f in uploaded_files]
-        
-    if uploaded_files:
-        files_to_process = []
-        current_uploaded_file_names = {f.name for f in uploaded_files}
-        to_append = list(current_uploaded_file_names)
-        file_names.append(to_append)
-        
+        submitted = 0
         for uploaded_file in uploaded_files:
             uploaded_file.seek(0) 
             file_bytes = uploaded_file.read()
             file_hash = hashlib.md5(file_bytes).hexdigest() 
 
-            # we use this to determine what files to upsert in session, by filtering those already uploaded and new ones
-            if uploaded_file.name not in st.session_state.processed_file_metadata or \
-            st.session_state.processed_file_metadata[uploaded_file.name] != file_hash:
-                files_to_process.append((uploaded_file.name, file_bytes, file_hash))
-                
+            # we use this to determine what files to submit in session, by filtering those already uploaded and new ones
+            if uploaded_file.name in processed and processed[uploaded_file.name][0] == file_hash:
+                job = ingest_queue.get(processed[uploaded_file.name][1])
+                if job is None or job.status != 'error':
+                    continue
+                # its job failed: submit it again rather than leave it unindexed for the rest of the session
+
+            # parsed, embedded and indexed in the background, chat keeps working on what's indexed already
+            job = ingest_queue.submit(st.session_state.username, uploaded_file.name, file_bytes)
+            processed[uploaded_file.name] = (file_hash, job.id)
+            submitted += 1
 
-        if files_to_process: # if we have a list of files now
-            with st.spinner("Processing new/changed files... This may take a moment."):
-                processed_count = 0
-                for file_name, file_bytes, file_hash in files_to_process:
-                    with tempfile.TemporaryDirectory() as tmpdir:
-                        tmp_path = Path(tmpdir) / file_name
-                        tmp_path.write_bytes(file_bytes)
-                        try:
-                            parsed_content = asyncio.run(parse(tmp_path))
-                            asyncio.run(faiss_agent.upsert_doc(texts=f'NEW BOOK: {parsed_content}', 
-                                                            username = st.session_state.username,
-                                                            metadata= {"file_name": file_name}))
-                            
-                            st.session_state.processed_file_metadata[file_name] = file_hash
-                            processed_count += 1
-                        except Exception as e:
-                            st.error(f"Error processing {file_name}: {e}")
-
-            if processed_count > 0:
-                st.success(f"✅ {processed_count} files processed!")
-
-        elif uploaded_files and not files_to_process:
-            st.info("All uploaded files are already processed.")
+        if submitted:
+            st.toast(f"{submitted} files queued for processing")
+
+    render_ingest_jobs(ingest_queue, st.session_state.username)
 
     for message in st.session_state.messages[3:]: 
         with st.chat_message(message['role']):
@@ -141,32 +160,55 @@ else:
     user_input = render_unified_input()
 
     if user_input:
-        # here i am well not in a graceful way adding past interactions into my query...there was a way to add history to the llm
-        query = track_queries(query = user_input, 
-                            previous_interactions= [f"{msg['role']}: {msg['content']}" 
-                                                    for msg in st.session_state.messages[-7:]] )
         with st.chat_message('user'):
             st.markdown(user_input)
 
-        # The assistant's response is generated and streamed
-        with st.chat_message('assistant'):
-            extracted = asyncio.run(faiss_agent.query(texts=user_input, user_id=st.session_state.username,
-                                                      top_k= 5))
-            extracted_text = [i.get('text', '') for i in extracted] if isinstance(extracted, list) else None
-
-            full_response = st.write_stream(groq_generate(query= query, relevant_passage=extracted_text))
+        with tracer.context(user=st.session_state.username), tracer.span('request') as request_span:
+            # The assistant's response is generated and streamed
+            with st.chat_message('assistant'):
+                # dense / hybrid (BM25 fused with dense) / lexical (BM25 only, no embedding round trip); the
+                # BM25 ones keep an in-memory index of every partition's text, so deployments opt in
+                retrieval_mode = st.secrets["general"].get("RETRIEVAL_MODE", "dense")
+                request_span.set(mode=retrieval_mode)
+                query_vector, extracted = None, None
+                # nothing indexed yet for this user: no embedding call, no search
+                if faiss_agent.has_chunks(st.session_state.username):
+                    if retrieval_mode != 'lexical':
+                        with tracer.span('query.embed'):
+                            query_vector = runner.run(faiss_agent.embed_query(user_input))
+                    extracted = runner.run(faiss_agent.query(texts=user_input, user_id=st.session_state.username,
+                                                              top_k= 5, query_vector=query_vector, mode=retrieval_mode))
+                # passages and past interactions are fitted into a token budget instead of sent whole
+                with tracer.span('prompt.pack'):
+                    packed = pack_prompt(user_input, extracted, st.session_state.messages[3:],
+                                         budget=int(st.secrets["general"].get("PROMPT_TOKEN_BUDGET", 4000)))
+
+                # the same question over the same retrieved chunks gets the stored answer instead of a new completion
+                chunk_ids = [i['id'] for i in extracted] if extracted else []
+                use_cache = bool(extracted) and query_vector is not None
+                cached = answer_cache.get(st.session_state.username, query_vector, chunk_ids) if use_cache else None
+                request_span.set(answer_cache_hit=bool(cached), prompt_tokens=packed.tokens['total'])
+                if cached:
+                    full_response = st.write_stream(iter([cached]))
+                else:
+                    with tracer.span('generate'): # groq_generate records llm.ttft / llm.stream itself
+                        full_response = st.write_stream(runner.iterate(groq_generate(query= packed.query,
+                                                                                    relevant_passage=packed.passages)))
+                    if use_cache:
+                        answer_cache.put(st.session_state.username, query_vector, chunk_ids,
+                                         {i['file_name'] for i in extracted}, full_response)
             
-            if extracted:
-                with st.expander("View Source Context"):
-                    for i, item in enumerate(extracted):
-                        file_name = item.get("file_name", "Unknown File") 
-                        text = item.get("text", "")
-                        st.markdown(f"""
-                        <div class="source-box">
-                            <div class="source-title">📄 {file_name}</div>
-                            <div class="source-text">{text}</div>
-                        </div>
-                        """, unsafe_allow_html=True)
+                if extracted:
+                    with st.expander("View Source Context"):
+                        for i, item in enumerate(extracted):
+                            file_name = item.get("file_name", "Unknown File") 
+                            text = item.get("text", "")
+                            st.markdown(f"""
+                            <div class="source-box">
+                                <div class="source-title">📄 {file_name}</div>
+                                <div class="source-text">{text}</div>
+                            </div>
+                            """, unsafe_allow_html=True)
                 
         st.session_state.messages.append({"role": 'user', "content": f'{user_input}'})
         if not extracted:
@@ -174,6 +216,9 @@ else:
         else:
             st.session_state.messages.append({"role": 'AI assistant', "content": f'{full_response}',
                 "sources": extracted})
-                                        
-
 
+    if tracer.enabled:
+        if st.secrets["general"].get("TRACE_EXPORT_PATH"):
+            tracer.export(st.secrets["general"]["TRACE_EXPORT_PATH"]) # .json, or prometheus text otherwise
+        if as_bool(st.secrets["general"].get("TRACE_PANEL", False)):
+            render_trace_panel(tracer)
@@ -0,0 +1,50 @@
+import random
+
+import pytest
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils.chunker import CHUNK_OVERLAP, CHUNK_SIZE, SEPARATORS, clean_chunk, iter_chunks, token_length
+
+WORDS = "the cat sat on a mat. economy grew fast\n lorem ipsum-dolor".split(' ')
+BREAKS = ["\n\n", "\n", "\n\n\n", " ", "\n\n\n\n", "NEW BOOK: "]
+
+
+def document(rng: random.Random, paragraphs: int) -> str:
+    parts = []
+    for _ in range(paragraphs):
+        parts.append(' '.join(rng.choice(WORDS) for _ in range(rng.choice([1, 5, 20, 60, 150, 400]))))
+        parts.append(rng.choice(BREAKS))
+    return ''.join(parts)
+
+
+def splitter_chunks(text: str, length_function=len, size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP) -> list[str]:
+    splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, is_separator_regex=True, chunk_size=size,
+                                              chunk_overlap=overlap, length_function=length_function)
+    return [chunk for chunk in map(clean_chunk, splitter.split_text(text)) if chunk]
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_same_chunks_as_the_splitter(seed):
+    rng = random.Random(seed)
+    text = document(rng, rng.randint(1, 200))
+    length_function = token_length() if seed % 4 == 0 else len
+    # as one string, and streamed in pieces cut at random (mid paragraph, mid separator)
+    cuts = sorted(rng.sample(range(len(text)), min(len(text), 30)))
+    pieces = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+    expected = splitter_chunks(text, length_function)
+    assert list(iter_chunks(text, length_function=length_function)) == expected
+    assert list(iter_chunks(pieces, length_function=length_function)) == expected
+
+
+def test_overlap_carries_across_paragraphs():
+    text = "\n\n".join(f"paragraph {i} " + "w " * 6 for i in range(40)) # short enough to be carried over
+    chunks = list(iter_chunks((text[i:i + 7] for i in range(0, len(text), 7)), size=120, overlap=40))
+    assert chunks == splitter_chunks(text, size=120, overlap=40)
+    # each chunk starts with the previous one's last paragraph
+    assert all(a.split('paragraph')[-1] in b for a, b in zip(chunks, chunks[1:]))
+
+
+def test_text_without_paragraphs():
+    text = "no paragraph breaks here. " * 200
+    assert list(iter_chunks([text[:1000], text[1000:]])) == splitter_chunks(text)
+    assert list(iter_chunks('')) == []
@@ -0,0 +1,44 @@
+from utils.context import merge_passages, pack_prompt
+
+
+def words(text: str) -> int:
+    return len(text.split())
+
+
+def result(vector_id: int, text: str, file_name: str = 'a.txt') -> dict:
+    return {'id': vector_id, 'text': text, 'file_name': file_name}
+
+
+def test_neighbouring_chunks_merge_without_the_overlap():
+    results = [result(8, "c d e f"), result(3, "x y z", 'b.txt'), result(7, "a b c d")]
+    assert merge_passages(results, max_overlap=8) == ["a b c d e f", "x y z"]
+
+
+def test_passages_fit_the_budget_best_first():
+    results = [result(i * 10, ' '.join([f"w{i}"] * 30)) for i in range(10)]
+    packed = pack_prompt("what now", results, [], budget=100, history_share=0.3, count=words)
+    assert len(packed.passages) == 2 # 30 + 30 <= 0.7 * 98 < 90
+    assert packed.passages[0].startswith('w0') and packed.passages[1].startswith('w1')
+    assert packed.dropped_passages == 8
+    assert packed.tokens['total'] <= 100
+
+
+def test_history_keeps_recent_turns_and_shortens_old_answers():
+    history = []
+    for turn in range(4):
+        history += [{'role': 'user', 'content': f"question {turn}"},
+                    {'role': 'assistant', 'content': f"Answer {turn}. " + ' '.join(['detail'] * 20)}]
+    packed = pack_prompt("next", [], history, budget=1000, keep_turns=2, count=words)
+    assert packed.dropped_messages == 0
+    assert "assistant: Answer 0.\n" in packed.query # older answers cut to their first sentence
+    assert "Answer 3. detail" in packed.query # the last two turns verbatim
+    assert packed.query.index("question 0") < packed.query.index("question 3") # still oldest first
+    assert packed.query.endswith("Current Query: next")
+
+
+def test_oldest_history_goes_first_when_out_of_room():
+    history = [{'role': 'user', 'content': ' '.join([f"m{i}"] * 10)} for i in range(10)]
+    packed = pack_prompt("q", [result(0, ' '.join(['p'] * 20))], history, budget=60, count=words)
+    assert packed.passages and packed.tokens['total'] <= 60
+    assert packed.dropped_messages > 0
+    assert 'm9' in packed.query and 'm0' not in packed.query
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import pytest
+
+from utils.embed_engine import EmbeddingEngine, TokenBucket
+
+
+class ApiError(Exception):
+    def __init__(self, status_code: int):
+        super().__init__(f"HTTP {status_code}")
+        self.status_code = status_code
+
+
+class FakeEmbedder():
+    """Async embed_fn: fails with the queued statuses first, and tracks how many calls overlap."""
+
+    def __init__(self, failures=(), latency: float = 0.0):
+        self.failures = list(failures)
+        self.latency = latency
+        self.calls = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, texts: list[str], method: str, **kwargs) -> list[list[float]]:
+        self.calls += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.latency)
+            if self.failures:
+                raise ApiError(self.failures.pop(0))
+            return [[float(len(text))] for text in texts]
+        finally:
+            self.in_flight -= 1
+
+
+def engine(embed_fn, **kwargs) -> EmbeddingEngine:
+    return EmbeddingEngine(embed_fn, base_delay=0.001, max_delay=0.01, progress=False, **kwargs)
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_rate_limits_and_server_errors(status):
+    fake = FakeEmbedder(failures=[status, status])
+    assert asyncio.run(engine(fake).embed(['a', 'bb'], 'm')) == [[1.0], [2.0]]
+    assert fake.calls == 3
+
+
+def test_client_errors_are_not_retried():
+    fake = FakeEmbedder(failures=[400])
+    with pytest.raises(ApiError):
+        asyncio.run(engine(fake).embed(['a'], 'm'))
+    assert fake.calls == 1
+
+
+def test_gives_up_after_max_retries():
+    fake = FakeEmbedder(failures=[429] * 10)
+    with pytest.raises(ApiError):
+        asyncio.run(engine(fake, max_retries=2).embed(['a'], 'm'))
+    assert fake.calls == 3
+
+
+def test_in_flight_limit_and_order():
+    fake = FakeEmbedder(latency=0.02)
+    texts = ['x' * n for n in range(1, 41)]
+    vectors = asyncio.run(engine(fake, batch_size=2, max_in_flight=3).embed(texts, 'm'))
+    assert vectors == [[float(n)] for n in range(1, 41)]
+    assert fake.calls == 20
+    assert fake.max_in_flight == 3
+
+
+def test_token_bucket_paces_requests():
+    fake = FakeEmbedder()
+    limited = engine(fake, batch_size=1, max_in_flight=8)
+    limited.limiter = TokenBucket(rate=50, capacity=1) # one request now, then one every 20ms
+
+    start = time.monotonic()
+    asyncio.run(limited.embed(['a'] * 6, 'm'))
+    assert time.monotonic() - start >= 5 / 50 * 0.9
+    assert fake.calls == 6
+
+
+def test_sync_embed_fn_runs_off_the_loop():
+    on_loop = []
+
+    def blocking(texts: list[str], method: str) -> list[list[float]]:
+        try:
+            asyncio.get_running_loop()
+            on_loop.append(True)
+        except RuntimeError: # a worker thread
+            on_loop.append(False)
+        return [[0.0] for _ in texts]
+
+    assert asyncio.run(engine(blocking).embed(['a', 'b'], 'm')) == [[0.0], [0.0]]
+    assert on_loop == [False]
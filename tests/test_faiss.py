@@ -0,0 +1,126 @@
+import time
+
+import numpy as np
+import pytest
+
+from classes import Faiss
+from classes.faiss_ import SHARED_PARTITION
+from classes.index_types import CODECS, INDEX_TYPES, normalize_codec
+from utils import HashingEmbedder, runner
+
+EMBEDDER = HashingEmbedder(64)
+
+
+def chunks(file_name: str, n: int = 100, tag: str = '') -> list[dict]:
+    texts = [f"{file_name} {tag} topic{i} word{i % 13} note{i % 7}" for i in range(n)]
+    return [{'values': vector, 'metadata': {'text': text, 'file_name': file_name}}
+            for text, vector in zip(texts, EMBEDDER.encode(texts))]
+
+
+def settle(faiss_agent: Faiss, key: str, timeout: float = 30.0):
+    # waits for the background promotion/compaction of `key`'s partition to finish
+    partition = faiss_agent.partitions[key]
+    deadline = time.monotonic() + timeout
+    while partition.rebuilding and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not partition.rebuilding
+    return partition
+
+
+def search(faiss_agent: Faiss, user: str, text: str, top_k: int = 5) -> list[str]:
+    found = runner.run(faiss_agent.query(texts=text, user_id=user, top_k=top_k,
+                                         query_vector=EMBEDDER.encode([text])[0]))
+    return [hit['file_name'] for hit in found or ()]
+
+
+PAIRS = []
+for kind in INDEX_TYPES:
+    for codec in CODECS:
+        try:
+            normalize_codec(kind, codec)
+        except ValueError:
+            continue
+        PAIRS.append((kind, codec))
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+@pytest.mark.parametrize('kind,codec', PAIRS)
+def test_query_after_delete_every_index(kind, codec, dedup):
+    faiss_agent = Faiss(embedder=EMBEDDER, index_type=kind, codec=codec, promote_at=250, compact_ratio=1.0,
+                        dedup=dedup)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        faiss_agent.add_embedded('alice', chunks(name), replace_file=name)
+    partition = settle(faiss_agent, 'alice' if not dedup else next(iter(faiss_agent.partitions)))
+    if (kind, codec) != ('flat', 'f32'):
+        assert (partition.kind, partition.codec) == (kind, normalize_codec(kind, codec))
+
+    assert faiss_agent.delete_doc('alice', 'b.txt') == 100
+    assert 'b.txt' not in search(faiss_agent, 'alice', 'b.txt topic3 word3 note3', top_k=10)
+    assert search(faiss_agent, 'alice', 'a.txt topic3 word3 note3')[0] == 'a.txt'
+
+    faiss_agent.add_embedded('alice', chunks('a.txt', tag='v2'), replace_file='a.txt')
+    assert 'b.txt' not in search(faiss_agent, 'alice', 'a.txt v2 topic5 word5 note5', top_k=10)
+    assert search(faiss_agent, 'alice', 'c.txt topic5 word5 note5')[0] == 'c.txt'
+
+
+def test_flat_pq_is_refused():
+    with pytest.raises(ValueError):
+        Faiss(embedder=EMBEDDER, index_type='flat', codec='pq')
+
+
+@pytest.mark.parametrize('dedup', [False, True])
+def test_recall_only_counts_what_the_user_can_find(dedup):
+    # flat f32 is exact, so anything short of 1.0 means the two sides looked at different rows
+    # random vectors: no ties, which the two sides could break differently
+    rng = np.random.default_rng(0)
+    faiss_agent = Faiss(embedder=EMBEDDER, compact_ratio=1.0, dedup=dedup)
+    for user, name in (('alice', 'a.txt'), ('alice', 'b.txt'), ('alice', 'c.txt'), ('bob', 'd.txt')):
+        embedded = [{'values': rng.standard_normal(64).astype('float32'),
+                     'metadata': {'text': f"{name} {i}", 'file_name': name}} for i in range(100)]
+        faiss_agent.add_embedded(user, embedded, replace_file=name)
+    faiss_agent.delete_doc('alice', 'b.txt')
+    assert faiss_agent.recall_at_k('alice') == 1.0
+    assert faiss_agent.recall_at_k('bob') == 1.0
+
+
+def test_compaction_in_memory_keeps_the_live_rows():
+    faiss_agent = Faiss(embedder=EMBEDDER, compact_ratio=0.3)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        faiss_agent.add_embedded('alice', chunks(name), replace_file=name)
+    ids = faiss_agent.file_ids('alice', 'c.txt')
+    faiss_agent.delete_doc('alice', 'b.txt')
+    partition = settle(faiss_agent, 'alice')
+
+    assert partition.ntotal == 200 and not partition.dead
+    assert faiss_agent.file_ids('alice', 'c.txt') == ids # vector ids survive the compaction
+    assert search(faiss_agent, 'alice', 'c.txt topic7 word7 note7')[0] == 'c.txt'
+    assert 'b.txt' not in search(faiss_agent, 'alice', 'b.txt topic7 word7 note7', top_k=20)
+
+
+def test_dedup_stores_shared_chunks_once(tmp_path):
+    faiss_agent = Faiss(str(tmp_path), embedder=EMBEDDER, compact_ratio=1.0, dedup=True)
+    faiss_agent.add_embedded('alice', chunks('a.txt'), replace_file='a.txt')
+    faiss_agent.add_embedded('bob', chunks('a.txt'), replace_file='a.txt')
+    faiss_agent.add_embedded('bob', chunks('b.txt'), replace_file='b.txt')
+    partition = faiss_agent.partitions[SHARED_PARTITION]
+    assert partition.ntotal == 200
+    assert faiss_agent.file_ids('alice', 'a.txt') == faiss_agent.file_ids('bob', 'a.txt')
+
+    # alice only ever sees her own references
+    assert 'b.txt' not in search(faiss_agent, 'alice', 'b.txt topic3 word3 note3', top_k=20)
+    assert search(faiss_agent, 'bob', 'b.txt topic3 word3 note3')[0] == 'b.txt'
+
+    # a chunk stays as long as somebody references it
+    assert faiss_agent.delete_doc('alice', 'a.txt') == 100
+    assert not partition.dead and not faiss_agent.has_chunks('alice')
+    assert search(faiss_agent, 'bob', 'a.txt topic3 word3 note3')[0] == 'a.txt'
+    assert faiss_agent.delete_doc('bob', 'a.txt') == 100
+    assert len(partition.dead) == 100
+
+    reopened = Faiss(str(tmp_path), embedder=EMBEDDER, compact_ratio=1.0, dedup=True)
+    assert reopened.partitions[SHARED_PARTITION].dead == partition.dead
+    assert reopened.file_ids('bob', 'b.txt') == faiss_agent.file_ids('bob', 'b.txt')
+    assert not reopened.file_ids('bob', 'a.txt')
+    # a re-upload of the dropped text gets stored (and searchable) again
+    reopened.add_embedded('alice', chunks('a.txt'), replace_file='a.txt')
+    assert search(reopened, 'alice', 'a.txt topic3 word3 note3')[0] == 'a.txt'
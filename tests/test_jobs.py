@@ -0,0 +1,120 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from classes import Faiss
+from utils import HashingEmbedder
+import utils.jobs as jobs_module
+from utils.jobs import IngestQueue
+
+
+def wait(queue: IngestQueue, *jobs, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while any(queue.get(job.id).active for job in jobs):
+        assert time.monotonic() < deadline, "ingestion didn't finish"
+        time.sleep(0.05)
+    return [queue.get(job.id) for job in jobs]
+
+
+def live_texts(faiss_agent: Faiss, username: str) -> list[str]:
+    partition = faiss_agent.partitions[username]
+    return [partition.info.text(row) for row in range(partition.ntotal) if row not in partition.dead]
+
+
+def document(word: str, paragraphs: int = 60) -> bytes:
+    return "\n\n".join(f"{word} paragraph {i}: " + f"{word} text " * 40 for i in range(paragraphs)).encode()
+
+
+@pytest.fixture
+def faiss_agent():
+    return Faiss(embedder=HashingEmbedder(64))
+
+
+@pytest.fixture
+def queue(tmp_path, faiss_agent):
+    queue = IngestQueue(tmp_path / 'jobs', faiss_agent, concurrency=2, poll=0.05)
+    queue.start()
+    return queue
+
+
+def test_reupload_while_running_leaves_only_the_newest(queue, faiss_agent):
+    done = wait(queue, queue.submit('alice', 'doc.txt', document('first')))
+    assert done[0].status == 'done'
+
+    # both re-uploads are queued at once; with concurrency 2 they'd otherwise run side by side
+    jobs = wait(queue, queue.submit('alice', 'doc.txt', document('second')),
+                queue.submit('alice', 'doc.txt', document('third', paragraphs=40)))
+    assert [job.status for job in jobs] == ['replaced', 'done'] # the third upload replaced the second
+    texts = live_texts(faiss_agent, 'alice')
+    assert texts and all(text.startswith('third') or ' third ' in text for text in texts)
+
+
+def test_same_bytes_same_name_is_one_job(queue):
+    first = queue.submit('alice', 'a.txt', document('same'))
+    assert queue.submit('alice', 'a.txt', document('same')).id == first.id
+    assert queue.submit('alice', 'b.txt', document('same')).id != first.id
+    assert queue.submit('bob', 'a.txt', document('same')).id != first.id
+
+
+def test_running_jobs_are_requeued_on_restart(tmp_path, faiss_agent):
+    queue = IngestQueue(tmp_path / 'jobs', faiss_agent) # not started: nothing claims the job
+    job = queue.submit('alice', 'a.txt', document('restart'))
+    queue._update(job.id, status='running')
+
+    reopened = IngestQueue(tmp_path / 'jobs', faiss_agent, poll=0.05)
+    assert reopened.get(job.id).status == 'queued'
+    reopened.start()
+    assert wait(reopened, job)[0].status == 'done'
+    assert any('restart' in text for text in live_texts(faiss_agent, 'alice'))
+
+
+def test_job_updates_stay_off_the_loop(queue, monkeypatch):
+    on_loop = []
+    update = queue._update
+
+    def recording(job_id, **fields):
+        on_loop.append(threading.current_thread() is queue.runner._thread)
+        update(job_id, **fields)
+
+    monkeypatch.setattr(queue, '_update', recording)
+    job = wait(queue, queue.submit('alice', 'a.txt', document('threads')))[0]
+    assert job.status == 'done' and job.progress == 1.0
+    assert on_loop and not any(on_loop)
+
+
+def test_queued_files_go_through_one_run(tmp_path, faiss_agent, monkeypatch):
+    runs = []
+
+    async def ingest_files(files, faiss_agent, username, **kwargs):
+        runs.append(sorted(name for name, _ in files))
+        return await real_ingest(files, faiss_agent, username, **kwargs)
+
+    real_ingest = jobs_module.ingest_files
+    monkeypatch.setattr(jobs_module, 'ingest_files', ingest_files)
+    queue = IngestQueue(tmp_path / 'jobs', faiss_agent, concurrency=1, batch=8, poll=0.05)
+    submitted = [queue.submit('alice', f"{i}.txt", document(f"file{i}", paragraphs=5)) for i in range(3)]
+    queue.start()
+    assert [job.status for job in wait(queue, *submitted)] == ['done'] * 3
+    assert runs == [['0.txt', '1.txt', '2.txt']]
+
+
+def test_cancel_one_job_of_a_batch(tmp_path, faiss_agent, monkeypatch):
+    async def ingest_files(files, faiss_agent, username, **kwargs):
+        if any(name == 'slow.txt' for name, _ in files):
+            await asyncio.sleep(60)
+        return {}
+
+    monkeypatch.setattr(jobs_module, 'ingest_files', ingest_files)
+    queue = IngestQueue(tmp_path / 'jobs', faiss_agent, concurrency=1, poll=0.05)
+    slow, other = queue.submit('alice', 'slow.txt', b'slow'), queue.submit('alice', 'other.txt', b'other')
+    queue.start()
+    deadline = time.monotonic() + 10
+    while queue.get(slow.id).status != 'running':
+        assert time.monotonic() < deadline
+        time.sleep(0.02)
+
+    assert queue.cancel(slow.id)
+    # the job asked for is cancelled, the other one in its batch runs again by itself
+    assert [job.status for job in wait(queue, slow, other)] == ['cancelled', 'done']
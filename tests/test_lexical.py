@@ -0,0 +1,63 @@
+import numpy as np
+
+from classes import Faiss
+from classes.lexical import LexicalIndex, reciprocal_rank_fusion, tokenize
+from utils import HashingEmbedder, runner
+
+TEXTS = [
+    "the pump model ab-123 needs a new seal",
+    "replace the seal on the ab-124 pump every year",
+    "firmware v2.1 fixes the pump controller",
+    "the weather was fine all week",
+    "seal seal seal seal seal the seal of the seal",
+]
+
+
+def test_tokenize_keeps_part_numbers_whole():
+    assert tokenize("Pump AB-123 runs v2.1, see foo.bar") == ['pump', 'ab-123', 'runs', 'v2.1', 'see', 'foo.bar']
+
+
+def test_bm25_ranks_rare_terms_and_skips_non_matches():
+    index = LexicalIndex()
+    index.add(TEXTS)
+    scores, rows = index.search("ab-123 pump", k=10)
+    assert rows[0] == 0 # the only one with the exact part number
+    assert set(rows) == {0, 1, 2} # nothing without a query term comes back
+    assert np.all(np.diff(scores) <= 0)
+
+    # term frequency saturates: the long chunk stuffed with "seal" doesn't bury the short ones
+    _, rows = index.search("pump seal", k=2)
+    assert set(rows) == {0, 1}
+
+
+def test_bm25_dead_and_allowed_rows():
+    index = LexicalIndex()
+    index.add(TEXTS)
+    _, rows = index.search("pump", k=10, dead={0})
+    assert 0 not in rows and set(rows) == {1, 2}
+    _, rows = index.search("pump", k=10, allowed=np.array([2, 3]))
+    assert list(rows) == [2]
+    assert len(index.search("turbine", k=10)[1]) == 0
+    assert len(index.search("pump", k=0)[1]) == 0
+
+
+def test_rrf_favours_rows_both_lists_agree_on():
+    fused = reciprocal_rank_fusion([[1, 2, 3, -1], [1, 4, 3]])
+    assert fused[:2] == [1, 3] # in both lists beats first in one
+    assert set(fused) == {1, 2, 3, 4} # -1 is faiss' padding, not a row
+    assert reciprocal_rank_fusion([[], []]) == []
+
+
+def test_hybrid_query_finds_exact_terms_dense_misses():
+    embedder = HashingEmbedder(64)
+    faiss_agent = Faiss(embedder=embedder)
+    texts = [f"general notes on maintenance {i}" for i in range(50)] + ["error code zx-9917 means a blocked filter"]
+    embedded = [{'values': vector, 'metadata': {'text': text, 'file_name': 'manual.txt'}}
+                for text, vector in zip(texts, embedder.encode(texts))]
+    faiss_agent.add_embedded('alice', embedded)
+
+    query = "zx-9917"
+    for mode in ('lexical', 'hybrid'):
+        found = runner.run(faiss_agent.query(texts=query, user_id='alice', top_k=3, mode=mode,
+                                             query_vector=embedder.encode([query])[0]))
+        assert 'zx-9917' in found[0]['text']
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+
+import pytest
+
+import utils.parser as parser
+from utils.parser import ParserPool
+
+
+def fake_convert(source: str, use_ocr: bool, page_range=None) -> str:
+    # runs in the pool's worker processes, stands in for docling
+    name = Path(source).name
+    if name.startswith('slow'):
+        time.sleep(60)
+    if name.startswith('crash'):
+        os._exit(1)
+    return f"parsed {name}"
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    monkeypatch.setattr(parser, '_convert', fake_convert)
+    pool = ParserPool(workers=1, warm_ocr=())
+    yield pool
+    pool.shutdown()
+
+
+def test_timeout_only_fails_that_job(pool):
+    async def run():
+        await pool.convert(Path('warm.pdf'), timeout=120) # worker spawned and imported before timing anything
+        # one worker: a.pdf and b.pdf are queued behind the slow one when it times out and the pool restarts
+        return await asyncio.gather(pool.convert(Path('slow.pdf'), timeout=3),
+                                    pool.convert(Path('a.pdf'), timeout=120),
+                                    pool.convert(Path('b.pdf'), timeout=120), return_exceptions=True)
+
+    slow, a, b = asyncio.run(run())
+    assert isinstance(slow, RuntimeError) and 'timed out' in str(slow)
+    assert (a, b) == ('parsed a.pdf', 'parsed b.pdf')
+
+
+def test_crash_only_fails_that_job(pool):
+    async def run():
+        await pool.convert(Path('warm.pdf'), timeout=120)
+        return await asyncio.gather(pool.convert(Path('crash.pdf'), timeout=120),
+                                    pool.convert(Path('a.pdf'), timeout=120), return_exceptions=True)
+
+    crash, a = asyncio.run(run())
+    assert isinstance(crash, RuntimeError) and 'crashed' in str(crash)
+    assert a == 'parsed a.pdf'
@@ -0,0 +1,93 @@
+import asyncio
+
+import pytest
+
+from classes import Faiss
+from utils import HashingEmbedder
+from utils.pipeline import ingest_files
+
+
+class FailingEmbedder(HashingEmbedder):
+    """Fails every embed call after the first `ok` ones."""
+
+    def __init__(self, ok: int):
+        super().__init__(64)
+        self.ok = ok
+
+    async def embed(self, texts, method, **kwargs):
+        if self.ok <= 0:
+            await asyncio.sleep(0.2) # lets the groups before it reach the index
+            raise RuntimeError("embedding API down")
+        self.ok -= 1
+        return await super().embed(texts, method, **kwargs)
+
+
+def write(tmp_path, name: str, word: str, paragraphs: int = 200):
+    path = tmp_path / word / name
+    path.parent.mkdir(exist_ok=True)
+    path.write_text("\n\n".join(f"{word} paragraph {i}: " + f"{word} text " * 40 for i in range(paragraphs)))
+    return path
+
+
+def live_words(faiss_agent: Faiss, username: str = 'alice') -> set[str]:
+    # which versions of the document a query could find chunks of
+    partition = faiss_agent.partitions.get(username)
+    if partition is None:
+        return set()
+    texts = [partition.info.text(row) for row in range(partition.ntotal) if row not in partition.dead]
+    return {word for word in ('first', 'second') if any(word in text for text in texts)}
+
+
+@pytest.fixture
+def faiss_agent():
+    return Faiss(embedder=HashingEmbedder(64))
+
+
+def test_new_file_streams_in_groups(tmp_path, faiss_agent, monkeypatch):
+    calls = []
+    add = faiss_agent.add_embedded
+    monkeypatch.setattr(faiss_agent, 'add_embedded', lambda *args, **kwargs: calls.append(kwargs) or add(*args, **kwargs))
+
+    assert asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'first'))], faiss_agent, 'alice')) == {}
+    assert len(calls) > 1 and all(kwargs.get('replace_file') is None for kwargs in calls)
+    assert live_words(faiss_agent) == {'first'}
+
+
+def test_reupload_replaces_in_one_step(tmp_path, faiss_agent, monkeypatch):
+    asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'first'))], faiss_agent, 'alice'))
+
+    seen = []
+    add = faiss_agent.add_embedded
+
+    def add_embedded(*args, **kwargs):
+        seen.append(live_words(faiss_agent)) # what a query could find right before each add
+        return add(*args, **kwargs)
+
+    monkeypatch.setattr(faiss_agent, 'add_embedded', add_embedded)
+    assert asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'second'))], faiss_agent, 'alice')) == {}
+    assert seen == [{'first'}] # nothing of the new copy shows before the swap
+    assert live_words(faiss_agent) == {'second'}
+
+
+def test_failed_reupload_keeps_the_old_copy(tmp_path):
+    embedder = FailingEmbedder(ok=1_000)
+    faiss_agent = Faiss(embedder=embedder)
+    asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'first'))], faiss_agent, 'alice'))
+
+    embedder.ok = 1 # the first group embeds, the next one fails
+    errors = asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'second'))], faiss_agent, 'alice'))
+    assert 'doc.txt' in errors
+    assert live_words(faiss_agent) == {'first'}
+
+
+def test_failed_new_file_is_rolled_back(tmp_path, monkeypatch):
+    faiss_agent = Faiss(embedder=FailingEmbedder(ok=1))
+    dropped = []
+    drop_ids = faiss_agent.drop_ids
+    monkeypatch.setattr(faiss_agent, 'drop_ids', lambda *args: dropped.append(drop_ids(*args)) or dropped[-1])
+    errors = asyncio.run(ingest_files([('doc.txt', write(tmp_path, 'doc.txt', 'first', paragraphs=600))],
+                                      faiss_agent, 'alice'))
+    assert 'doc.txt' in errors
+    assert dropped and dropped[0] > 0 # its first group made it in, and was taken out again
+    assert live_words(faiss_agent) == set()
+    assert not faiss_agent.has_chunks('alice')
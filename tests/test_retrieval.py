@@ -0,0 +1,69 @@
+import secrets
+from multiprocessing import AuthenticationError
+
+import pytest
+
+from classes import RetrievalClient, RetrievalServer
+from utils import get_embedder, runner
+
+AUTHKEY = secrets.token_bytes(32)
+
+CATS = "Cats are small furry animals that like to sleep in the sun. " * 20
+MARKETS = "The stock market fell sharply after the interest rate decision. " * 20
+
+
+@pytest.fixture(scope='module')
+def server():
+    # two shards, so users land in different worker processes
+    with RetrievalServer(('127.0.0.1', 0), 2, embedder='hashing', authkey=AUTHKEY) as server:
+        yield server
+
+
+@pytest.fixture
+def client(server):
+    client = RetrievalClient(server.address, get_embedder('hashing'), authkey=AUTHKEY)
+    yield client
+    client.close()
+
+
+def test_add_query_delete(client):
+    runner.run(client.replace_doc(CATS, 'alice', {'file_name': 'cats.txt'}))
+    runner.run(client.replace_doc(MARKETS, 'bob', {'file_name': 'markets.txt'}))
+
+    found = runner.run(client.query(texts='furry cats sleeping', user_id='alice', top_k=1))
+    assert found[0]['file_name'] == 'cats.txt'
+    # users only ever see their own files, whichever shard they're on
+    found = runner.run(client.query_many(['furry cats', 'stock market'], ['alice', 'bob'], top_k=1))
+    assert [hits[0]['file_name'] for hits in found] == ['cats.txt', 'markets.txt']
+
+    assert client.has_chunks('alice')
+    assert client.delete_doc('alice', 'cats.txt') > 0
+    assert not client.has_chunks('alice')
+    assert runner.run(client.query(texts='furry cats', user_id='alice', top_k=1)) is None
+
+
+def test_ids_come_back_and_changes_reach_other_clients(server, client):
+    other = RetrievalClient(server.address, get_embedder('hashing'), authkey=AUTHKEY)
+    changed = []
+    other.on_change.append(lambda username, file_name: changed.append((username, file_name)))
+
+    runner.run(client.replace_doc(CATS, 'carol', {'file_name': 'notes.txt'}))
+    ids = client.file_ids('carol', 'notes.txt')
+    assert ids
+    assert client.drop_ids('carol', 'notes.txt', ids) == len(ids)
+
+    other.stats() # any request picks up the server's change log
+    assert ('carol', 'notes.txt') in changed
+    other.close()
+
+
+def test_wrong_authkey_is_refused(server):
+    with pytest.raises(AuthenticationError):
+        RetrievalClient(server.address, get_embedder('hashing'), authkey=b'not the key')
+
+
+def test_authkey_is_required():
+    with pytest.raises(ValueError):
+        RetrievalServer(('127.0.0.1', 0), 1, embedder='hashing', authkey=b'')
+    with pytest.raises(TypeError):
+        RetrievalClient(('127.0.0.1', 0), get_embedder('hashing'))
@@ -0,0 +1,152 @@
+import time
+
+import pytest
+
+from classes import Faiss
+from classes.store import TOMBSTONES, VECTORS, IndexStore
+from utils import HashingEmbedder
+
+EMBEDDER = HashingEmbedder(64)
+
+
+def chunks(file_name: str, n: int = 50, tag: str = '') -> list[dict]:
+    texts = [f"{file_name} {tag} topic{i} word{i % 13}" for i in range(n)]
+    return [{'values': vector, 'metadata': {'text': text, 'file_name': file_name}}
+            for text, vector in zip(texts, EMBEDDER.encode(texts))]
+
+
+def live_files(faiss_agent: Faiss, username: str = 'alice') -> dict[str, int]:
+    partition = faiss_agent.partitions[username]
+    counts = {}
+    for row in range(partition.ntotal):
+        if row not in partition.dead:
+            counts[partition.info.file_name(row)] = counts.get(partition.info.file_name(row), 0) + 1
+    return counts
+
+
+@pytest.fixture
+def store_dir(tmp_path):
+    return tmp_path / 'store'
+
+
+def test_snapshot_waits_for_a_running_rebuild(store_dir):
+    faiss_agent = Faiss(str(store_dir), snapshot_every=10, embedder=EMBEDDER)
+    faiss_agent.add_embedded('alice', chunks('a.txt', 5))
+    partition = faiss_agent.partitions['alice']
+
+    assert partition.start_rebuild() # a promotion or compaction holds the partition
+    faiss_agent.add_embedded('alice', chunks('b.txt', 20))
+    assert partition.base is None and partition.delta.ntotal == 25 # no snapshot under it
+    partition.end_rebuild(True)
+
+    faiss_agent.add_embedded('alice', chunks('c.txt', 5))
+    assert partition.base_rows == 30 and partition.delta.ntotal == 0
+    assert not partition.rebuilding
+
+
+def settle(partition, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while partition.rebuilding and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert not partition.rebuilding
+
+
+def test_reopen_keeps_adds_replaces_and_deletes(store_dir):
+    faiss_agent = Faiss(str(store_dir), snapshot_every=30, compact_ratio=1.0, embedder=EMBEDDER)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        faiss_agent.add_embedded('alice', chunks(name), replace_file=name)
+    faiss_agent.add_embedded('alice', chunks('a.txt', 20, tag='v2'), replace_file='a.txt')
+    assert faiss_agent.delete_doc('alice', 'b.txt') == 50
+    before = live_files(faiss_agent)
+    assert before == {'a.txt': 20, 'c.txt': 50}
+
+    reopened = Faiss(str(store_dir), snapshot_every=30, compact_ratio=1.0, embedder=EMBEDDER)
+    assert live_files(reopened) == before
+    assert reopened.next_id == faiss_agent.next_id
+    texts = {reopened.partitions['alice'].info.text(row) for row in reopened.partitions['alice'].rows_of('a.txt')}
+    assert all(' v2 ' in text for text in texts)
+
+
+def test_crash_mid_replace_leaves_the_old_copy(store_dir, monkeypatch):
+    faiss_agent = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    faiss_agent.add_embedded('alice', chunks('a.txt'), replace_file='a.txt')
+
+    # the conditional tombstones of the old copy are logged, then the process dies before the new rows are
+    def crash(*args, **kwargs):
+        raise OSError('disk went away')
+    with monkeypatch.context() as m:
+        m.setattr(IndexStore, 'append', crash)
+        with pytest.raises(OSError):
+            faiss_agent.add_embedded('alice', chunks('a.txt', tag='v2'), replace_file='a.txt')
+
+    reopened = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    assert live_files(reopened) == {'a.txt': 50}
+    # enough unrelated rows to meet the crashed replace's marker must not tombstone the old copy after all
+    reopened.add_embedded('alice', chunks('b.txt', 60), replace_file='b.txt')
+    assert live_files(Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)) == {'a.txt': 50, 'b.txt': 60}
+
+
+def test_replace_logged_in_full_survives_reopen(store_dir):
+    faiss_agent = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    faiss_agent.add_embedded('alice', chunks('a.txt'), replace_file='a.txt')
+    faiss_agent.add_embedded('alice', chunks('a.txt', 30, tag='v2'), replace_file='a.txt')
+
+    reopened = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    partition = reopened.partitions['alice']
+    assert live_files(reopened) == {'a.txt': 30}
+    assert partition.dead == set(range(50))
+
+
+def test_torn_tails_are_cut_on_reopen(store_dir):
+    faiss_agent = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    faiss_agent.add_embedded('alice', chunks('a.txt'))
+    faiss_agent.delete_doc('alice', 'a.txt')
+    faiss_agent.add_embedded('alice', chunks('b.txt'))
+    path = store_dir / faiss_agent.store.manifest['partitions']['alice']
+    with open(path / VECTORS, 'ab') as f:
+        f.write(b'\0' * 100) # half a row
+    with open(path / TOMBSTONES, 'ab') as f:
+        f.write(b'\0' * 3) # half an entry
+
+    reopened = Faiss(str(store_dir), compact_ratio=1.0, embedder=EMBEDDER)
+    assert reopened.partitions['alice'].ntotal == 100
+    assert live_files(reopened) == {'b.txt': 50}
+    assert (path / VECTORS).stat().st_size == 100 * 64 * 4
+    assert (path / TOMBSTONES).stat().st_size % 8 == 0
+
+
+def test_compaction_drops_dead_rows_for_good(store_dir):
+    faiss_agent = Faiss(str(store_dir), snapshot_every=40, compact_ratio=0.3, embedder=EMBEDDER)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        faiss_agent.add_embedded('alice', chunks(name), replace_file=name)
+    old_dir = faiss_agent.store.manifest['partitions']['alice']
+    faiss_agent.delete_doc('alice', 'b.txt')
+    partition = faiss_agent.partitions['alice']
+    settle(partition)
+
+    assert partition.ntotal == 100 and not partition.dead
+    assert live_files(faiss_agent) == {'a.txt': 50, 'c.txt': 50}
+    assert faiss_agent.store.manifest['partitions']['alice'] != old_dir
+    assert not (store_dir / old_dir).exists()
+
+    faiss_agent.add_embedded('alice', chunks('d.txt', 10))
+    reopened = Faiss(str(store_dir), snapshot_every=40, compact_ratio=0.3, embedder=EMBEDDER)
+    assert reopened.partitions['alice'].ntotal == 110
+    assert live_files(reopened) == {'a.txt': 50, 'c.txt': 50, 'd.txt': 10}
+    # vector ids survive the compaction, so new ones don't collide with the dropped file's
+    ids = [reopened.partitions['alice'].info.vector_id(row) for row in range(110)]
+    assert len(set(ids)) == 110 and reopened.next_id == 160
+
+
+def test_promotion_survives_reopen(store_dir):
+    faiss_agent = Faiss(str(store_dir), index_type='hnsw', promote_at=120, compact_ratio=1.0, embedder=EMBEDDER)
+    for name in ('a.txt', 'b.txt', 'c.txt'):
+        faiss_agent.add_embedded('alice', chunks(name), replace_file=name)
+    partition = faiss_agent.partitions['alice']
+    settle(partition)
+    assert partition.kind == 'hnsw' and partition.base_rows == 150
+
+    reopened = Faiss(str(store_dir), index_type='hnsw', promote_at=120, compact_ratio=1.0, embedder=EMBEDDER)
+    partition = reopened.partitions['alice']
+    assert partition.kind == 'hnsw' and partition.base_rows == 150 and not partition.rebuilding
+    assert live_files(reopened) == {'a.txt': 50, 'b.txt': 50, 'c.txt': 50}
@@ -1,3 +1,10 @@
 from .utils import *
+from .embedders import *
+from .audio import *
+from .chunker import *
 from .parser import *
-from .ui_components import *
\ No newline at end of file
+from .ui_components import *
+from .pipeline import *
+from .jobs import *
+from .context import *
+from .tracing import *
\ No newline at end of file
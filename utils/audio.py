@@ -0,0 +1,144 @@
+import asyncio
+import io
+import logging
+import wave
+from typing import AsyncIterator
+
+import numpy as np
+
+from .tracing import tracer
+from .utils import get_groq_client
+
+logger = logging.getLogger(__name__)
+
+STT_MODEL = "whisper-large-v3-turbo"
+# stands in for a segment that failed to transcribe
+GAP = "[inaudible]"
+
+stt_prompt = """
+You are a highly accurate AI transcription assistant. Your task is to convert spoken language into clean, readable text.
+
+Guidelines:
+- Transcribe the spoken input word-for-word, preserving the speaker’s intent.
+- Correct minor grammatical issues only if necessary for clarity.
+- Do not add or omit any information.
+- Use punctuation to make the transcription easier to read (e.g., commas, periods).
+- If the speaker hesitates or repeats a word, clean it up unless it changes the meaning.
+- Avoid inserting labels like "um", "uh", unless they’re contextually important.
+
+Context:
+The following audio was captured as part of a user request. Your job is to return the most accurate, raw readable transcript possible.
+"""
+
+_SAMPLE_TYPES = {1: np.uint8, 2: np.int16, 4: np.int32}
+
+
+def _loudness(frames: bytes, sample_width: int, channels: int, window: int) -> np.ndarray:
+    # RMS per `window` frames, channels averaged, on a 0..1 scale
+    samples = np.frombuffer(frames, dtype=_SAMPLE_TYPES[sample_width]).astype('float32')
+    if sample_width == 1: # 8 bit wav is unsigned
+        samples -= 128
+    samples = samples.reshape(-1, channels).mean(axis=1) / float(1 << (8 * sample_width - 1))
+    usable = len(samples) - len(samples) % window
+    return np.sqrt((samples[:usable].reshape(-1, window) ** 2).mean(axis=1))
+
+
+def _wav(params, frames: bytes) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as out:
+        out.setparams(params)
+        out.writeframes(frames)
+    return buffer.getvalue()
+
+
+def split_on_silence(audio: bytes, *, max_seconds: float = 20.0, min_seconds: float = 6.0,
+                     pause_ms: int = 300) -> list[bytes]:
+    """
+    Cuts a WAV recording into segments of at most `max_seconds`, each cut placed at the quietest `pause_ms`
+    stretch between `min_seconds` and `max_seconds` after the previous one, so words aren't split. Everything
+    stays in memory; each segment is a complete WAV. Anything that isn't a PCM WAV comes back as one segment.
+    """
+    try:
+        with wave.open(io.BytesIO(audio), 'rb') as source:
+            params = source.getparams()
+            frames = source.readframes(params.nframes)
+    except (wave.Error, EOFError):
+        return [audio]
+    if params.sampwidth not in _SAMPLE_TYPES:
+        return [audio]
+
+    rate, frame_bytes = params.framerate, params.sampwidth * params.nchannels
+    total = len(frames) // frame_bytes
+    if total <= max_seconds * rate:
+        return [audio]
+
+    window = max(1, rate // 100) # 10ms of frames per loudness value
+    loudness = _loudness(frames[:total * frame_bytes], params.sampwidth, params.nchannels, window)
+    span = max(1, pause_ms // 10)
+    # mean loudness of the pause_ms stretch centred on each 10ms window
+    quiet = np.convolve(loudness, np.ones(span) / span, mode='same')
+
+    cuts, start = [0], 0
+    while total - start > max_seconds * rate:
+        lo, hi = (start + int(min_seconds * rate)) // window, (start + int(max_seconds * rate)) // window
+        start = (lo + int(np.argmin(quiet[lo:hi]))) * window
+        cuts.append(start)
+    cuts.append(total)
+    return [_wav(params, frames[a * frame_bytes:b * frame_bytes]) for a, b in zip(cuts, cuts[1:])]
+
+
+async def transcribe_segment(audio: bytes, name: str = "audio.wav", client=None) -> str:
+    transcription = await (client or get_groq_client()).audio.transcriptions.create(
+        file=(name, audio),
+        model=STT_MODEL,
+        response_format="text",
+        prompt=stt_prompt
+    )
+    # a plain str for response_format text, a Transcription otherwise
+    return str(getattr(transcription, 'text', transcription)).strip()
+
+
+async def transcribe_stream(audio: bytes, *, concurrency: int = 4, client=None,
+                            **split_kwargs) -> AsyncIterator[str | None]:
+    """
+    Transcribes a recording segment by segment, up to `concurrency` requests in flight, and yields each
+    segment's text in recording order as soon as it and everything before it is done, so the caller can
+    show the start of a long recording while the rest is still being transcribed.
+
+    A segment that fails to transcribe comes out as None, so the caller can mark the gap (see GAP) instead
+    of silently running the text on either side of it together. If every segment fails the error is raised.
+    """
+    with tracer.span('stt.split', bytes=len(audio)) as span:
+        segments = await asyncio.to_thread(split_on_silence, audio, **split_kwargs)
+        span.set(segments=len(segments))
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int, segment: bytes) -> str:
+        async with semaphore:
+            with tracer.span('stt.segment', segment=i):
+                return await transcribe_segment(segment, f"segment-{i}.wav", client)
+
+    tasks = [asyncio.create_task(one(i, segment)) for i, segment in enumerate(segments)]
+    failures = 0
+    try:
+        for i, task in enumerate(tasks):
+            try:
+                text = await task
+            except Exception as e:
+                logger.error(f"Error during Groq transcription of segment {i + 1}/{len(tasks)}: {e}")
+                failures += 1
+                if failures == len(tasks):
+                    raise
+                yield None
+                continue
+            if text:
+                yield text
+    finally:
+        for task in tasks: # the caller stopped early
+            task.cancel()
+
+
+async def transcribe(audio: bytes, **kwargs) -> str:
+    """The whole transcript, with GAP where a segment couldn't be transcribed."""
+    return " ".join([GAP if text is None else text async for text in transcribe_stream(audio, **kwargs)])
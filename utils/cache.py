@@ -0,0 +1,184 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class DiskLRU():
+    """
+    Size-bounded key -> bytes store in sqlite. Every read bumps the entry's access time and once the total
+    size goes over max_bytes the least recently used entries are dropped. sqlite's own locking makes it
+    safe to share between threads and processes.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._size_estimate: int | None = None # upper bound on this process's view of the total size
+        with self._conn() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS entries (
+                                key TEXT PRIMARY KEY, value BLOB NOT NULL,
+                                size INTEGER NOT NULL, accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't hop threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, keys: list[str]) -> dict[str, bytes]:
+        found = {}
+        conn = self._conn()
+        for start in range(0, len(keys), 500): # stay under sqlite's bound-parameter limit
+            batch = keys[start:start + 500]
+            marks = ','.join('?' * len(batch))
+            found.update(conn.execute(f"SELECT key, value FROM entries WHERE key IN ({marks})", batch).fetchall())
+        if found:
+            with conn:
+                conn.executemany("UPDATE entries SET accessed = ? WHERE key = ?", [(time.time(), k) for k in found])
+        return found
+
+    def get(self, key: str) -> bytes | None:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, items: dict[str, bytes]):
+        if not items:
+            return
+        now = time.time()
+        conn = self._conn()
+        with conn:
+            conn.executemany("INSERT OR REPLACE INTO entries (key, value, size, accessed) VALUES (?, ?, ?, ?)",
+                             [(k, v, len(v), now) for k, v in items.items()])
+        # replaced entries are double counted and other processes' writes missed; the estimate only decides
+        # when to pay for an exact SUM over the table, not what gets evicted
+        if self._size_estimate is not None:
+            self._size_estimate += sum(len(v) for v in items.values())
+        if self._size_estimate is None or self._size_estimate > self.max_bytes:
+            self._evict()
+
+    def put(self, key: str, value: bytes):
+        self.put_many({key: value})
+
+    def _evict(self):
+        conn = self._conn()
+        with conn:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            self._size_estimate = total
+            if total <= self.max_bytes:
+                return
+            # walk from the oldest entry until enough bytes are freed
+            freed, cutoff = 0, None
+            for accessed, size in conn.execute("SELECT accessed, size FROM entries ORDER BY accessed"):
+                freed += size
+                cutoff = accessed
+                if total - freed <= self.max_bytes:
+                    break
+            conn.execute("DELETE FROM entries WHERE accessed <= ?", (cutoff,))
+            self._size_estimate = total - freed
+        logger.info(f"Evicted {freed} bytes from {self.path.name}")
+
+
+class EmbeddingCache():
+    """
+    Content-addressed embedding cache: an in-memory LRU in front of a DiskLRU, keyed by a hash of
+    (model_name, method, output_dimensionality, text).
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30, memory_items: int = 50_000):
+        self.disk = DiskLRU(path, max_bytes)
+        self.memory_items = memory_items
+        self._memory: OrderedDict[str, list[float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(model_name: str, method: str, dimension: int, text: str) -> str:
+        return hashlib.sha256(f"{model_name}\x1f{method}\x1f{dimension}\x1f{text}".encode()).hexdigest()
+
+    def _remember(self, key: str, values: list[float]):
+        self._memory[key] = values
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        found = {}
+        with self._lock:
+            for key in keys:
+                if key in self._memory:
+                    self._memory.move_to_end(key)
+                    found[key] = self._memory[key]
+
+        missing = [k for k in set(keys) if k not in found]
+        if missing:
+            on_disk = self.disk.get_many(missing)
+            with self._lock:
+                for key, blob in on_disk.items():
+                    found[key] = np.frombuffer(blob, dtype='float32').tolist()
+                    self._remember(key, found[key])
+
+        with self._lock:
+            hits = sum(1 for k in keys if k in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+        return found
+
+    def put_many(self, items: dict[str, list[float]]):
+        with self._lock:
+            for key, values in items.items():
+                self._remember(key, values)
+        self.disk.put_many({k: np.asarray(v, dtype='float32').tobytes() for k, v in items.items()})
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0,
+                'memory_items': len(self._memory)}
+
+
+class ParseCache():
+    """
+    Parsed documents (markdown for now) keyed by a hash of the file's bytes plus the parser options and
+    version that produced them, zlib compressed in a DiskLRU. Shared by every user, session and process, so
+    a document anyone has uploaded before is never parsed again.
+    """
+
+    def __init__(self, path: str | Path, max_bytes: int = 1 << 30):
+        self.disk = DiskLRU(path, max_bytes)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(content_hash: str, kind: str = 'markdown', **options) -> str:
+        described = '\x1f'.join(f"{k}={options[k]}" for k in sorted(options))
+        return hashlib.sha256(f"{kind}\x1f{content_hash}\x1f{described}".encode()).hexdigest()
+
+    def get(self, key: str) -> str | None:
+        blob = self.disk.get(key)
+        if blob is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return zlib.decompress(blob).decode('utf-8')
+
+    def put(self, key: str, text: str):
+        self.disk.put(key, zlib.compress(text.encode('utf-8'), 6))
+
+    def stats(self) -> dict[str, int | float]:
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / total if total else 0.0}
@@ -0,0 +1,110 @@
+import re
+from typing import Callable, Iterable, Iterator
+
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+try:
+    import tiktoken
+except ImportError: # optional, token_length falls back to an estimate without it
+    tiktoken = None
+
+CHUNK_SIZE = 300
+CHUNK_OVERLAP = 20
+SEPARATORS = ["\n\n", "\n", " ", "", '.', "NEW BOOK: "]
+
+_WORD_PIECE = re.compile(r"\w+|[^\w\s]")
+
+
+def token_length(encoding: str = 'cl100k_base') -> Callable[[str], int]:
+    """Length function counting tokens instead of characters, for iter_chunks(length_function=...)."""
+    if tiktoken is not None:
+        encoder = tiktoken.get_encoding(encoding)
+        return lambda text: len(encoder.encode(text, disallowed_special=()))
+    # close enough for sizing chunks: words and punctuation marks
+    return lambda text: len(_WORD_PIECE.findall(text))
+
+
+def clean_chunk(chunk: str) -> str:
+    return chunk.replace('\n\n', '').replace('\n', '').replace('  ', '')
+
+
+class _Merger():
+    """
+    RecursiveCharacterTextSplitter._merge_splits fed one split at a time: packs splits into chunks of up to
+    `size`, each starting with the last `overlap` worth of the one before, and hands back each chunk as soon as
+    it is closed instead of once every split is in.
+    """
+
+    def __init__(self, size: int, overlap: int, length_function: Callable[[str], int]):
+        self.size, self.overlap, self.length = size, overlap, length_function
+        self.current: list[str] = []
+        self.total = 0
+
+    def add(self, split: str) -> list[str]:
+        # splits are joined with "" (the splitter keeps separators on the splits), so no separator length
+        closed = []
+        length = self.length(split)
+        if self.total + length > self.size and self.current:
+            closed = self.flush(keep=True)
+            while self.total > self.overlap or (self.total + length > self.size and self.total > 0):
+                self.total -= self.length(self.current.pop(0))
+        self.current.append(split)
+        self.total += length
+        return closed
+
+    def flush(self, keep: bool = False) -> list[str]:
+        chunk = ''.join(self.current).strip()
+        if not keep:
+            self.current, self.total = [], 0
+        return [chunk] if chunk else []
+
+
+def _paragraphs(text: str) -> list[str]:
+    # text split before each "\n\n", the separator staying at the start of the paragraph after it
+    parts = text.split(SEPARATORS[0])
+    return [split for split in parts[:1] + [SEPARATORS[0] + part for part in parts[1:]] if split]
+
+
+def iter_chunks(stream: str | Iterable[str], size: int = CHUNK_SIZE, overlap: int = CHUNK_OVERLAP,
+                length_function: Callable[[str], int] = len) -> Iterator[str]:
+    """
+    Yields cleaned chunks of `stream` (a string or an iterable of text pieces, e.g. pages) as they are split.
+
+    The chunks are exactly what RecursiveCharacterTextSplitter gives for the whole text with the same size
+    and overlap, overlap across paragraphs included, but only the paragraph being read and the chunk being
+    packed are held, never the whole document or all of its chunks. Text with no paragraph break at all is
+    split in one go. Chunks that clean down to nothing are dropped.
+    """
+    splitter = RecursiveCharacterTextSplitter(separators=SEPARATORS, is_separator_regex=True,
+                                              chunk_size=size, chunk_overlap=overlap, length_function=length_function)
+    # what the splitter does with a paragraph too long to be a piece of a chunk by itself
+    inner = RecursiveCharacterTextSplitter(separators=SEPARATORS[1:], is_separator_regex=True,
+                                           chunk_size=size, chunk_overlap=overlap, length_function=length_function)
+    merger = _Merger(size, overlap, length_function)
+
+    def paragraph(split: str) -> Iterator[str]:
+        if length_function(split) < size:
+            yield from merger.add(split)
+        else: # closes the chunk being packed, the next one starts afresh after it
+            yield from merger.flush()
+            yield from inner.split_text(split)
+
+    buffer, paragraphs = '', False
+    for piece in ([stream] if isinstance(stream, str) else stream):
+        buffer += piece
+        if not paragraphs and SEPARATORS[0] not in buffer:
+            continue # no paragraph break yet: the splitter might not split on them at all
+        paragraphs = True
+        *done, buffer = _paragraphs(buffer) or ['']
+        for split in done: # the last one may go on in the next piece
+            for chunk in paragraph(split):
+                if chunk := clean_chunk(chunk):
+                    yield chunk
+
+    if not paragraphs:
+        chunks = splitter.split_text(buffer)
+    else:
+        chunks = [chunk for split in _paragraphs(buffer) for chunk in paragraph(split)] + merger.flush()
+    for chunk in chunks:
+        if chunk := clean_chunk(chunk):
+            yield chunk
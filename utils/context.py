@@ -0,0 +1,121 @@
+import logging
+import re
+from dataclasses import dataclass, field
+from typing import Callable
+
+from .chunker import CHUNK_OVERLAP, token_length
+
+logger = logging.getLogger(__name__)
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s")
+
+
+@dataclass
+class PackedPrompt():
+    query: str # "Previous interactions: ...\nCurrent Query: ..." as groq_generate expects it
+    passages: list[str]
+    tokens: dict[str, int] = field(default_factory=dict) # per section
+    dropped_passages: int = 0
+    dropped_messages: int = 0
+
+
+def _strip_overlap(previous: str, text: str, max_overlap: int) -> str:
+    # adjacent chunks repeat up to chunk_overlap characters of each other at the seam
+    for size in range(min(max_overlap, len(previous), len(text)), 0, -1):
+        if previous.endswith(text[:size]):
+            return text[size:]
+    return text
+
+
+def merge_passages(results: list[dict], max_overlap: int = CHUNK_OVERLAP * 2) -> list[str]:
+    """
+    Turns retrieval results ({id, text, file_name}, best first) into passages: chunks of the same file with
+    consecutive vector ids (neighbours in the document) are merged into one passage and the overlap at each
+    seam is cut. Passages keep the rank of their best chunk.
+    """
+    groups: list[list[dict]] = []
+    for result in sorted(results, key=lambda r: (r.get('file_name', ''), r['id'])):
+        last = groups[-1][-1] if groups else None
+        if last is not None and last.get('file_name') == result.get('file_name') and result['id'] == last['id'] + 1:
+            groups[-1].append(result)
+        else:
+            groups.append([result])
+
+    rank = {r['id']: i for i, r in enumerate(results)}
+    groups.sort(key=lambda group: min(rank[r['id']] for r in group))
+
+    passages = []
+    for group in groups:
+        text = group[0]['text']
+        for previous, result in zip(group, group[1:]):
+            text += _strip_overlap(previous['text'], result['text'], max_overlap)
+        passages.append(text)
+    return passages
+
+
+def _first_sentence(text: str) -> str:
+    return _SENTENCE_END.split(text.strip(), maxsplit=1)[0]
+
+
+def _truncate(text: str, tokens: int, count: Callable[[str], int]) -> str:
+    words = text.split()
+    lo, hi = 0, len(words)
+    while lo < hi: # longest word prefix that fits in `tokens` with the marker
+        mid = (lo + hi + 1) // 2
+        if count(' '.join(words[:mid]) + ' ...') <= tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return ' '.join(words[:lo]) + ' ...'
+
+
+def pack_prompt(query: str, results: list[dict] | None, history: list[dict], budget: int = 4000,
+                history_share: float = 0.3, keep_turns: int = 2,
+                count: Callable[[str], int] | None = None) -> PackedPrompt:
+    """
+    Fits the retrieved passages and the chat history into `budget` tokens next to the query.
+
+    Passages go first, best ranked first, and may use all but `history_share` of the room left after the query.
+    History fills what is left, newest first: the last `keep_turns` user/assistant turns verbatim, older
+    assistant answers cut down to their first sentence, and the oldest messages dropped once nothing fits.
+    """
+    count = count or token_length()
+    query_tokens = count(query)
+    room = max(budget - query_tokens, 0)
+
+    packed_passages, passage_tokens, dropped_passages = [], 0, 0
+    for passage in merge_passages(results or []):
+        tokens = count(passage)
+        if passage_tokens + tokens > room * (1 - history_share):
+            dropped_passages += 1
+            continue
+        packed_passages.append(passage)
+        passage_tokens += tokens
+
+    lines, history_tokens = [], 0
+    for age, message in enumerate(reversed(history)):
+        content = message['content']
+        if age >= keep_turns * 2 and message['role'] != 'user':
+            content = _first_sentence(content)
+        line = f"{message['role']}: {content}"
+        tokens = count(line)
+        if history_tokens + tokens > room - passage_tokens:
+            left = room - passage_tokens - history_tokens
+            if left > 16: # still worth the head of the message
+                line = _truncate(line, left, count)
+                lines.append(line)
+                history_tokens += count(line)
+            break
+        lines.append(line)
+        history_tokens += tokens
+    dropped_messages = len(history) - len(lines)
+
+    interactions = '\n\n'.join(reversed(lines))
+    packed = PackedPrompt(query=f"\nPrevious interactions: {interactions}\nCurrent Query: {query}",
+                          passages=packed_passages, dropped_passages=dropped_passages, dropped_messages=dropped_messages,
+                          tokens={'context': passage_tokens, 'history': history_tokens, 'query': query_tokens})
+    packed.tokens['total'] = sum(packed.tokens.values())
+    logger.info(f"Prompt tokens {packed.tokens} (budget {budget}), {len(results or [])} chunks -> "
+                f"{len(packed_passages)} passages ({dropped_passages} over budget), "
+                f"{len(lines)}/{len(history)} history messages")
+    return packed
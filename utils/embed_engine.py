@@ -0,0 +1,124 @@
+import asyncio
+import inspect
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+import tqdm
+
+logger = logging.getLogger(__name__)
+
+# (texts, task_type, **kwargs) -> one vector per text, sync or async
+EmbedFn = Callable[..., list[list[float]] | Awaitable[list[list[float]]]]
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket():
+    """Async token bucket: `rate` tokens per second refilled up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = None
+        self._loop = None
+
+    @classmethod
+    def per_minute(cls, requests: float) -> 'TokenBucket':
+        return cls(rate=requests / 60, capacity=max(1.0, requests / 60))
+
+    async def acquire(self, tokens: float = 1.0):
+        # asyncio locks belong to one loop, make a new one if we are being driven by a different loop
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._lock, self._loop = asyncio.Lock(), loop
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+
+def status_of(error: Exception) -> int | None:
+    # google-genai puts it on .code, httpx/groq style clients on .status_code or .response
+    for attr in ('code', 'status_code'):
+        if isinstance(getattr(error, attr, None), int):
+            return getattr(error, attr)
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+class EmbeddingEngine():
+    """
+    Embeds texts in batches with at most `max_in_flight` requests outstanding, a token bucket in front of
+    every request and exponential backoff (with jitter) on 429/5xx. Results always come back in input order.
+    """
+
+    def __init__(self, embed_fn: EmbedFn, *, batch_size: int = 10, max_in_flight: int = 4,
+                 requests_per_minute: float | None = None, max_retries: int = 5,
+                 base_delay: float = 0.5, max_delay: float = 30.0, progress: bool = True):
+        self.embed_fn = embed_fn
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.limiter = TokenBucket.per_minute(requests_per_minute) if requests_per_minute else None
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.progress = progress
+
+    async def _call(self, texts: list[str], method: str, kwargs: dict) -> list[list[float]]:
+        # async functions, or objects with an async __call__
+        if inspect.iscoroutinefunction(self.embed_fn) or inspect.iscoroutinefunction(type(self.embed_fn).__call__):
+            return await self.embed_fn(texts, method, **kwargs)
+        # a blocking client must not stall the event loop
+        return await asyncio.to_thread(self.embed_fn, texts, method, **kwargs)
+
+    async def _embed_batch(self, texts: list[str], method: str, semaphore: asyncio.Semaphore,
+                           kwargs: dict) -> list[list[float]]:
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                if self.limiter is not None:
+                    await self.limiter.acquire()
+                try:
+                    vectors = await self._call(texts, method, kwargs)
+                except Exception as e:
+                    status = status_of(e)
+                    if status not in RETRYABLE_STATUS or attempt == self.max_retries:
+                        raise
+                    delay = min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    logger.warning(f"Embedding batch got {status}, retrying in {delay:.2f}s "
+                                   f"(attempt {attempt + 1}/{self.max_retries})")
+                    await asyncio.sleep(delay)
+                    continue
+
+                if len(vectors) != len(texts):
+                    raise RuntimeError(f"Embedder returned {len(vectors)} vectors for {len(texts)} texts")
+                return vectors
+
+    async def embed(self, texts: list[str], method: str, batch_size: int | None = None, **kwargs) -> list[list[float]]:
+        """Extra keyword arguments (e.g. model) are passed through to embed_fn."""
+        batch_size = batch_size or self.batch_size
+        batches = [texts[start:start + batch_size] for start in range(0, len(texts), batch_size)]
+        semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        tasks = [asyncio.ensure_future(self._embed_batch(batch, method, semaphore, kwargs)) for batch in batches]
+        try:
+            with tqdm.tqdm(total=len(tasks), disable=not self.progress) as bar:
+                for task in asyncio.as_completed(tasks):
+                    await task
+                    bar.update(1)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+
+        # tasks are in batch order, so flattening them restores chunk order
+        return [vector for task in tasks for vector in task.result()]
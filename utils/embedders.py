@@ -0,0 +1,110 @@
+import asyncio
+import functools
+import hashlib
+import re
+from pathlib import Path
+from typing import Protocol, runtime_checkable
+
+import numpy as np
+
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError: # optional, only LocalModelEmbedder needs it
+    SentenceTransformer = None
+
+_TOKEN = re.compile(r"\w+")
+
+
+@runtime_checkable
+class Embedder(Protocol):
+    """
+    What Faiss and batch_embed_text need from an embedding backend. `name`, `dimension` and `metric` identify
+    the vector space: indexes (and cached embeddings) built with one backend are never mixed with another's.
+    """
+    name: str
+    dimension: int
+    metric: str # 'l2' (raw vectors) or 'cosine' (unit vectors, so L2 search ranks by cosine)
+    cacheable: bool # worth a round trip to the embedding cache
+
+    async def embed(self, texts: list[str], method: str, **kwargs) -> list[list[float]] | np.ndarray: ...
+
+
+def embedder_spec(embedder: Embedder) -> dict:
+    return {'name': embedder.name, 'dimension': embedder.dimension, 'metric': embedder.metric}
+
+
+@functools.lru_cache(maxsize=1 << 18)
+def _digest(token: str, hashes: int) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=8 * hashes).digest()
+
+
+class HashingEmbedder():
+    """
+    Offline CPU embedder: signed feature hashing of words and word bigrams straight into `dimension` buckets
+    (a sparse random projection of the bag of words), log-scaled and normalised. No model, no network;
+    lexical rather than semantic similarity, but deterministic across processes and machines.
+    """
+    metric = 'cosine'
+    cacheable = False
+
+    def __init__(self, dimension: int = 768, hashes: int = 2):
+        self.dimension = dimension
+        self.hashes = hashes
+        self.name = f"hashing-v1-h{hashes}"
+
+    def encode(self, texts: list[str]) -> np.ndarray:
+        vocab: dict[str, int] = {} # token -> position, each distinct token is hashed once per call
+        ids, lengths = [], []
+        for text in texts:
+            words = _TOKEN.findall(text.lower())
+            tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+            ids.extend([vocab.setdefault(token, len(vocab)) for token in tokens])
+            lengths.append(len(tokens))
+
+        digests = np.frombuffer(b''.join(_digest(token, self.hashes) for token in vocab), dtype='<u8')
+        digests = digests.reshape(len(vocab), self.hashes)[np.asarray(ids, dtype='int64')]
+        rows = np.repeat(np.arange(len(texts)), np.asarray(lengths) * self.hashes)
+        signs = np.where(digests >> 63, -1.0, 1.0).ravel()
+        # one flat bincount instead of a scatter-add per token
+        matrix = np.bincount(rows * self.dimension + (digests % self.dimension).ravel().astype('int64'),
+                             weights=signs, minlength=len(texts) * self.dimension)
+        matrix = matrix.reshape(len(texts), self.dimension).astype('float32')
+        matrix = np.sign(matrix) * np.log1p(np.abs(matrix))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms == 0, 1, norms)
+
+    async def embed(self, texts: list[str], method: str, **kwargs) -> np.ndarray:
+        if len(texts) < 64:
+            return self.encode(texts)
+        return await asyncio.to_thread(self.encode, texts)
+
+
+def _weights_digest(path: Path) -> str:
+    """Content hash of a model directory (file names and bytes); a hub model id that isn't on disk hashes as is."""
+    digest = hashlib.blake2b(digest_size=8)
+    if not path.exists():
+        digest.update(str(path).encode())
+        return digest.hexdigest()
+    files = sorted(p for p in path.rglob('*') if p.is_file()) if path.is_dir() else [path]
+    for file in files:
+        digest.update(file.relative_to(path).as_posix().encode() if path.is_dir() else file.name.encode())
+        with open(file, 'rb') as f:
+            digest.update(hashlib.file_digest(f, 'blake2b').digest())
+    return digest.hexdigest()
+
+
+class LocalModelEmbedder():
+    """A sentence-transformers model loaded from local weights (needs the optional sentence_transformers)."""
+    metric = 'cosine'
+    cacheable = True
+
+    def __init__(self, path: str | Path, device: str | None = None):
+        if SentenceTransformer is None:
+            raise ImportError("LocalModelEmbedder needs sentence_transformers installed")
+        self.model = SentenceTransformer(str(path), device=device)
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        # keyed on the weights themselves: two checkpoints in same-named directories never share cached vectors
+        self.name = f"local:{Path(path).name}:{_weights_digest(Path(path))}"
+
+    async def embed(self, texts: list[str], method: str, **kwargs) -> np.ndarray:
+        return await asyncio.to_thread(self.model.encode, texts, normalize_embeddings=True, convert_to_numpy=True)
@@ -0,0 +1,258 @@
+import asyncio
+import hashlib
+import logging
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from pathlib import Path
+
+from .pipeline import STAGES, ingest_files
+from .runner import AsyncRunner, runner
+
+logger = logging.getLogger(__name__)
+
+# queued -> running -> done / error / cancelled; a done job becomes 'replaced' once its file is re-uploaded or deleted
+JOB_STATES = ('queued', 'running', 'done', 'error', 'cancelled', 'replaced')
+ACTIVE_STATES = ('queued', 'running')
+
+# SQL: another upload of job {0}'s file is running, or queued ahead of it
+_BUSY = ("EXISTS (SELECT 1 FROM jobs r WHERE r.user = {0}.user AND r.file_name = {0}.file_name AND r.id != {0}.id "
+         "AND (r.status = 'running' OR (r.status = 'queued' AND r.created < {0}.created)))")
+
+
+@dataclass
+class Job():
+    id: str
+    user: str
+    file_name: str
+    file_hash: str
+    status: str
+    stage: str | None # the pipeline stage (one of STAGES) it last reported
+    progress: float # 0..1
+    error: str | None
+    created: float
+    updated: float
+
+    @property
+    def active(self) -> bool:
+        return self.status in ACTIVE_STATES
+
+
+class IngestQueue():
+    """
+    Background ingestion shared by every session. Uploads are spooled to disk and recorded in a sqlite job
+    table; a worker task on the app's runner loop runs them through ingest_files, `concurrency` runs at a time,
+    so a Streamlit rerun only ever submits and polls. Each run takes up to `batch` of one user's queued files,
+    so the pipeline's stages overlap across them (parsing one while embedding another) as they do for a
+    multi-file upload. Queries keep being served from the live index meanwhile: a new file's chunks go in group
+    by group, a re-upload replaces the old copy in one step once it's all embedded.
+
+    Uploads of the same file run one after the other, in the order they came in. Jobs survive restarts (running
+    ones are requeued). Submitting a file whose bytes are already queued, running or indexed under that name for
+    that user returns the existing job. cancel() drops a queued job, or cancels
+    a running one and takes back whatever of it was already indexed.
+    """
+
+    def __init__(self, root: str | Path, faiss_agent, *, concurrency: int = 2, batch: int = 8, poll: float = 1.0,
+                 runner: AsyncRunner = runner, **ingest_kwargs):
+        self.root = Path(root)
+        self.spool = self.root / 'files'
+        self.spool.mkdir(parents=True, exist_ok=True)
+        self.faiss_agent = faiss_agent
+        self.concurrency = concurrency
+        self.batch = batch
+        self.poll = poll # seconds, picks up jobs submitted by other processes sharing the table
+        self.ingest_kwargs = ingest_kwargs # passed through to ingest_files (use_ocr, embed_workers, ...)
+        self.runner = runner # the worker shares the app's loop (and its API clients)
+        self._local = threading.local()
+        self._running: dict[str, asyncio.Task] = {} # job id -> the run (shared by its batch) it's part of
+        self._cancelled: set[str] = set() # running jobs cancel() was asked for
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._worker = None
+        self._lock = threading.Lock()
+
+        with self._conn() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id TEXT PRIMARY KEY, user TEXT NOT NULL, file_name TEXT NOT NULL,
+                                file_hash TEXT NOT NULL, status TEXT NOT NULL, stage TEXT,
+                                progress REAL NOT NULL DEFAULT 0, error TEXT,
+                                created REAL NOT NULL, updated REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_user_hash ON jobs(user, file_hash)")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status, created)")
+            # whatever was running when the last process died starts over
+            conn.execute("UPDATE jobs SET status = 'queued', stage = NULL, progress = 0 WHERE status = 'running'")
+
+        # a re-upload or delete makes the file's earlier done job stale, so its bytes are no longer a duplicate
+        faiss_agent.on_change.append(self._replaced)
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite connections can't hop threads, keep one per thread
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.root / 'jobs.sqlite', timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.row_factory = lambda cursor, row: Job(*row)
+            self._local.conn = conn
+        return conn
+
+    def _update(self, job_id: str, **fields):
+        fields['updated'] = time.time()
+        with self._conn() as conn:
+            conn.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in fields)} WHERE id = ?",
+                         [*fields.values(), job_id])
+
+    def _replaced(self, username: str, file_name: str):
+        with self._conn() as conn:
+            conn.execute("UPDATE jobs SET status = 'replaced', updated = ? WHERE user = ? AND file_name = ? "
+                         "AND status = 'done'", (time.time(), username, file_name))
+
+    def submit(self, username: str, file_name: str, data: bytes) -> Job:
+        file_hash = hashlib.sha256(data).hexdigest()
+        conn = self._conn()
+        with self._lock, conn:
+            # same bytes under another name are another file (its own chunks, its own replace/delete)
+            existing = conn.execute("SELECT * FROM jobs WHERE user = ? AND file_hash = ? AND file_name = ? "
+                                    "AND status IN ('queued', 'running', 'done') ORDER BY created DESC LIMIT 1",
+                                    (username, file_hash, file_name)).fetchone()
+            if existing is not None:
+                return existing
+
+            job = Job(uuid.uuid4().hex, username, file_name, file_hash, 'queued', None, 0.0, None,
+                      time.time(), time.time())
+            (self.spool / job.id).mkdir()
+            (self.spool / job.id / file_name).write_bytes(data) # the parser goes by the file's suffix
+            conn.execute("INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (job.id, job.user, job.file_name, job.file_hash, job.status, job.stage, job.progress,
+                          job.error, job.created, job.updated))
+        self._notify()
+        return job
+
+    def get(self, job_id: str) -> Job | None:
+        return self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+    def jobs(self, username: str, limit: int = 20) -> list[Job]:
+        return self._conn().execute("SELECT * FROM jobs WHERE user = ? ORDER BY created DESC LIMIT ?",
+                                    (username, limit)).fetchall()
+
+    def cancel(self, job_id: str) -> bool:
+        """True if the job was queued or running (in this process) and is now cancelled or being cancelled."""
+        with self._conn() as conn:
+            dropped = conn.execute("UPDATE jobs SET status = 'cancelled', updated = ? WHERE id = ? AND status = 'queued'",
+                                   (time.time(), job_id)).rowcount
+        if dropped:
+            shutil.rmtree(self.spool / job_id, ignore_errors=True)
+            return True
+        task = self._running.get(job_id)
+        if task is not None and self._loop is not None:
+            self._cancelled.add(job_id) # the rest of its batch goes back on the queue
+            self._loop.call_soon_threadsafe(task.cancel)
+            return True
+        return False
+
+    def start(self):
+        """Starts the worker on the runner's loop, once."""
+        with self._lock:
+            if self._worker is None:
+                self._worker = self.runner.submit(self._work())
+
+    def _notify(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def _claim(self, runs: int) -> list[list[Job]]:
+        # one job per file at a time: a re-upload waits for the earlier upload of that file to finish, or both
+        # would take the same old copy as theirs to replace and leave a mix of the two versions behind
+        conn = self._conn()
+        batches: dict[str, list[Job]] = {} # user -> their jobs for one run, oldest users first
+        with conn:
+            queued = conn.execute(f"SELECT * FROM jobs q WHERE status = 'queued' AND NOT {_BUSY.format('q')} "
+                                  "ORDER BY created LIMIT ?", (runs * self.batch,)).fetchall()
+            for job in queued:
+                if job.user not in batches and len(batches) == runs:
+                    continue
+                batch = batches.setdefault(job.user, [])
+                # another process sharing the table may have claimed it (or another upload of the file) first
+                if len(batch) < self.batch and conn.execute(
+                        f"UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued' "
+                        f"AND NOT {_BUSY.format('jobs')}", (time.time(), job.id)).rowcount:
+                    batch.append(job)
+        return [batch for batch in batches.values() if batch]
+
+    async def _work(self):
+        self._wakeup = asyncio.Event()
+        self._loop = asyncio.get_running_loop()
+        while True:
+            self._wakeup.clear()
+            free = self.concurrency - len(set(self._running.values()))
+            if free > 0:
+                for batch in await asyncio.to_thread(self._claim, free):
+                    task = asyncio.create_task(self._run(batch))
+                    self._running.update((job.id, task) for job in batch)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run(self, jobs: list[Job]):
+        by_file = {job.file_name: job for job in jobs} # a batch never has two uploads of one file
+        reached = dict.fromkeys(by_file, 0.0)
+        writes: dict[str, asyncio.Task | None] = dict.fromkeys(by_file) # each job's last write, in order
+        finished: set[str] = set() # files fully indexed, whatever happens to the rest of the batch
+        final: dict[str, dict] = {}
+
+        async def write(previous: asyncio.Task | None, job_id: str, **fields):
+            if previous is not None:
+                await previous
+            try:
+                await asyncio.to_thread(self._update, job_id, **fields)
+            except Exception as e: # progress is best effort, the final status still gets written
+                logger.warning(f"Couldn't record progress of job {job_id}: {e}")
+
+        def on_progress(file_name: str, stage: str, status: str):
+            progress = (STAGES.index(stage) + (status == 'done')) / len(STAGES)
+            # the error itself comes back from ingest_files; a pdf streamed in page ranges starts indexing
+            # before its parse is done, so don't step back
+            if status == 'error' or progress < reached[file_name]:
+                return
+            reached[file_name] = progress
+            fields = dict(stage=stage, progress=progress)
+            if (stage, status) == ('index', 'done'): # done now, not when the whole batch is
+                finished.add(file_name)
+                fields['status'] = 'done'
+            # sqlite can block for a while on a busy table: off the loop, which also serves queries
+            writes[file_name] = asyncio.create_task(write(writes[file_name], by_file[file_name].id, **fields))
+
+        user = jobs[0].user
+        try:
+            try:
+                errors = await ingest_files([(job.file_name, self.spool / job.id / job.file_name) for job in jobs],
+                                            self.faiss_agent, user, on_progress=on_progress, **self.ingest_kwargs)
+                for job in jobs:
+                    final[job.id] = (dict(status='error', error=str(errors[job.file_name]))
+                                     if job.file_name in errors else dict(status='done', progress=1.0))
+            except asyncio.CancelledError:
+                for job in jobs:
+                    if job.file_name in finished:
+                        continue
+                    # only the jobs cancel() was asked for are cancelled, the others in the batch start over
+                    final[job.id] = (dict(status='cancelled') if job.id in self._cancelled
+                                     else dict(status='queued', stage=None, progress=0.0))
+                logger.info(f"Cancelled ingestion of {', '.join(by_file)} for {user}")
+            except Exception as e:
+                logger.error(f"Ingestion of {', '.join(by_file)} failed: {e}")
+                final.update((job.id, dict(status='error', error=str(e))) for job in jobs
+                             if job.file_name not in finished)
+            # after every progress write, so it's the one that sticks
+            await asyncio.gather(*[write(writes[job.file_name], job.id, **final[job.id])
+                                   for job in jobs if job.id in final])
+        finally:
+            for job in jobs:
+                if final.get(job.id, {}).get('status') != 'queued': # a requeued job still needs its file
+                    shutil.rmtree(self.spool / job.id, ignore_errors=True)
+                self._running.pop(job.id, None)
+                self._cancelled.discard(job.id)
+            self._wakeup.set() # a slot is free
@@ -1,26 +1,222 @@
 from docling.document_converter import DocumentConverter, PdfFormatOption
+import asyncio
+import hashlib
 import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import PdfPipelineOptions
+from importlib.metadata import PackageNotFoundError, version
+from .cache import ParseCache
+from .tracing import tracer
+from .utils import secret
 
-async def parse(source: Path, use_ocr: bool = False):
-    if source.name.endswith('.txt'):
-        with open(source, 'r', encoding='utf-8') as f:
-            return f.read()
-        
-    try:
+try:
+    import pypdfium2
+except ImportError: # comes with docling's pdf backend; without it every pdf is parsed in one piece
+    pypdfium2 = None
+
+logger = logging.getLogger(__name__)
+
+# lives inside each worker process: one ready converter per set of options (only OCR on/off for now)
+_converters: dict[bool, DocumentConverter] = {}
+
+
+def _get_converter(use_ocr: bool) -> DocumentConverter:
+    if use_ocr not in _converters:
         pipeline_options = PdfPipelineOptions()
-        pipeline_options.do_ocr = use_ocr  
-        
+        pipeline_options.do_ocr = use_ocr
+
         converter = DocumentConverter(
             format_options={
                 InputFormat.PDF: PdfFormatOption(pipeline_options=pipeline_options)
             }
         )
+        # loads the layout/table models now rather than on the first document
+        converter.initialize_pipeline(InputFormat.PDF)
+        _converters[use_ocr] = converter
+    return _converters[use_ocr]
+
+
+def _warm_worker(ocr_options: tuple[bool, ...]):
+    for use_ocr in ocr_options:
+        _get_converter(use_ocr)
+
+
+def _convert(source: str, use_ocr: bool, page_range: tuple[int, int] | None = None) -> str:
+    if page_range is None:
+        result = _get_converter(use_ocr).convert(source)
+    else: # 1-based, inclusive
+        result = _get_converter(use_ocr).convert(source, page_range=page_range)
+    return result.document.export_to_markdown()
+
+
+def page_count(source: Path) -> int | None:
+    """Pages in a pdf, None for anything else (or when pypdfium2 isn't there to count them)."""
+    if pypdfium2 is None or source.suffix.lower() != '.pdf':
+        return None
+    document = pypdfium2.PdfDocument(str(source))
+    try:
+        return len(document)
+    finally:
+        document.close()
+
+
+class ParserPool():
+    """
+    Long-lived docling worker processes, each holding warm converters. A job that crashes or overruns its
+    timeout takes down the pool's processes, which are then replaced; that job's caller gets a RuntimeError.
+    Jobs that were queued or running on the pool when it was torn down are resubmitted to the new one.
+    """
+
+    def __init__(self, workers: int | None = None, timeout: float = 600, warm_ocr: tuple[bool, ...] = (False,),
+                 resubmits: int = 3):
+        self.workers = workers or max(1, min(4, (os.cpu_count() or 2) - 1))
+        self.timeout = timeout
+        self.warm_ocr = warm_ocr
+        self.resubmits = resubmits # times a job caught in someone else's restart goes back on the pool
+        self._executor = None
+        self._generation = 0
+        self._killed: set[int] = set() # generations torn down on purpose by _restart
+
+    def _start(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking a process that already has torch/threads loaded is asking for deadlocks
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_warm_worker, initargs=(self.warm_ocr,))
+            self._generation += 1
+        return self._executor
+
+    def _restart(self, generation: int):
+        # only the first job to notice a broken/stuck pool restarts it
+        if self._executor is None or generation != self._generation:
+            return
+        self._killed.add(generation)
+        executor, self._executor = self._executor, None
+        for process in list((executor._processes or {}).values()):
+            process.terminate()
+        # queued futures aren't cancelled: they fail with BrokenProcessPool and convert() resubmits them
+        executor.shutdown(wait=False)
+
+    async def convert(self, source: Path, use_ocr: bool = False, timeout: float | None = None,
+                      page_range: tuple[int, int] | None = None) -> str:
+        timeout = timeout or self.timeout
+        crashes = resubmits = 0
+        while True:
+            executor = self._start()
+            generation = self._generation
+            future = asyncio.get_running_loop().run_in_executor(executor, _convert, str(source), use_ocr, page_range)
+            try:
+                return await asyncio.wait_for(future, timeout)
+            except asyncio.TimeoutError:
+                self._restart(generation)
+                raise RuntimeError(f"Parsing {source.name} timed out after {timeout}s")
+            except BrokenProcessPool:
+                if generation in self._killed and resubmits < self.resubmits:
+                    # another job's timeout or crash restarted the pool under this one
+                    resubmits += 1
+                    continue
+                # either this job crashed its worker or it was caught in a crash: retry once
+                self._restart(generation)
+                crashes += 1
+                if crashes == 2:
+                    raise RuntimeError(f"Parser worker crashed while parsing {source.name}")
+                logger.warning(f"Parser pool broke while parsing {source.name}, retrying on a fresh pool")
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+_pool: ParserPool | None = None
+
+
+def get_parser_pool() -> ParserPool:
+    global _pool
+    if _pool is None:
+        _pool = ParserPool()
+    return _pool
+
+
+# a docling upgrade can change the markdown, so its version is part of the cache key
+try:
+    DOCLING_VERSION = version('docling')
+except PackageNotFoundError:
+    DOCLING_VERSION = 'unknown'
+
+# shared by every user, session and process: a document is parsed once per set of options. Opened on first
+# use, so importing utils creates no sqlite file
+parse_cache: ParseCache | None = None
+_parse_cache_lock = threading.Lock()
+_inflight: dict[str, asyncio.Task] = {} # cache key -> the parse already running for it in this process
+
+
+def get_parse_cache() -> ParseCache:
+    global parse_cache
+    with _parse_cache_lock:
+        if parse_cache is None:
+            parse_cache = ParseCache(secret("PARSE_CACHE_PATH", ".cache/parses.sqlite"))
+        return parse_cache
+
+
+def file_digest(source: Path) -> str:
+    with open(source, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+
+async def _convert_and_store(source: Path, use_ocr: bool, key: str, page_range: tuple[int, int] | None) -> str:
+    # runs on a warm worker process, so the model load is paid once per worker and not per file
+    text = await get_parser_pool().convert(source, use_ocr, page_range=page_range)
+    await asyncio.to_thread(get_parse_cache().put, key, text)
+    return text
+
+
+def _finished(key: str, task: asyncio.Task):
+    _inflight.pop(key, None)
+    if not task.cancelled():
+        task.exception() # retrieved, so a failure every waiter gave up on isn't logged as unhandled
+
+
+async def _parse_cached(source: Path, use_ocr: bool, file_hash: str | None,
+                        page_range: tuple[int, int] | None) -> tuple[str, bool]:
+    file_hash = file_hash or await asyncio.to_thread(file_digest, source)
+    options = {'pages': f"{page_range[0]}-{page_range[1]}"} if page_range is not None else {}
+    cache = await asyncio.to_thread(get_parse_cache) # the first call opens (and maybe creates) it
+    key = cache.key(file_hash, use_ocr=use_ocr, docling=DOCLING_VERSION, **options)
+    if key not in _inflight:
+        cached = await asyncio.to_thread(cache.get, key)
+        if cached is not None:
+            return cached, True
+    # the same bytes uploaded twice at once (by anyone) share one parse; a caller that is cancelled leaves it
+    # running for the others and the cache
+    task = _inflight.get(key)
+    if task is None:
+        task = _inflight[key] = asyncio.create_task(_convert_and_store(source, use_ocr, key, page_range))
+        task.add_done_callback(lambda task: _finished(key, task))
+    return await asyncio.shield(task), False
+
+
+async def parse(source: Path, use_ocr: bool = False, file_hash: str | None = None,
+                page_range: tuple[int, int] | None = None):
+    """
+    `file_hash` is the sha256 of the file's bytes when the caller already has it. `page_range` (first, last),
+    1-based and inclusive, converts only those pages of a pdf.
+    """
+    with tracer.span('parse', file=source.name, ocr=use_ocr, pages=page_range) as span:
+        if source.name.endswith('.txt'):
+            with open(source, 'r', encoding='utf-8') as f:
+                return f.read()
 
-        result = converter.convert(source)
-        return result.document.export_to_markdown()
+        try:
+            text, cached = await _parse_cached(source, use_ocr, file_hash, page_range)
+            span.set(cached=cached)
+            return text
 
-    except Exception as e:
-        raise RuntimeError(f"Failed to parse file: {e}")
+        except Exception as e:
+            raise RuntimeError(f"Failed to parse file: {e}")
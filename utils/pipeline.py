@@ -0,0 +1,194 @@
+import asyncio
+import inspect
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Callable, Iterator
+
+from .parser import file_digest, page_count, parse
+from .chunker import CHUNK_OVERLAP, CHUNK_SIZE, iter_chunks
+from .tracing import tracer
+from .utils import iter_embedded
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+# (file_name, stage, status) -> None, stage is one of STAGES and status 'started' / 'done' / 'error'
+ProgressFn = Callable[[str, str, str], None]
+STAGES = ('parse', 'chunk', 'embed', 'index')
+
+
+async def _run_stage(name: str, workers: int, inbox: asyncio.Queue, outbox: asyncio.Queue | None,
+                     fn, errors: dict, on_progress: ProgressFn | None):
+    async def worker():
+        while True:
+            item = await inbox.get()
+            if item is _DONE:
+                await inbox.put(_DONE) # let the sibling workers see it too
+                return
+
+            file_name, payload = item
+            if file_name in errors: # another page range of the file already failed
+                continue
+            if on_progress:
+                on_progress(file_name, name, 'started')
+            streamed = False
+            try:
+                with tracer.span(f'ingest.{name}', file=file_name):
+                    result = fn(file_name, payload)
+                    if inspect.isasyncgen(result):
+                        # a stage that streams: each item goes downstream as soon as it's made
+                        streamed = True
+                        async for item in result:
+                            await outbox.put((file_name, item))
+                    else:
+                        result = await result
+            except Exception as e:
+                logger.error(f"{name} failed for {file_name}: {e}")
+                errors[file_name] = e
+                if on_progress:
+                    on_progress(file_name, name, 'error')
+                continue
+
+            if on_progress:
+                on_progress(file_name, name, 'done')
+            if outbox is not None and not streamed:
+                await outbox.put((file_name, result))
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    if outbox is not None:
+        await outbox.put(_DONE)
+
+
+async def ingest_files(files: list[tuple[str, Path]], faiss_agent, username: str, *,
+                       on_progress: ProgressFn | None = None, use_ocr: bool = False, queue_size: int = 2,
+                       parse_workers: int = 2, embed_workers: int = 2, embed_method: str = "RETRIEVAL_DOCUMENT",
+                       chunk_length: Callable[[str], int] = len, stream_over: int = 50,
+                       page_batch: int = 20) -> dict[str, Exception]:
+    """
+    Runs parse -> chunk -> embed -> index as concurrent stages with bounded queues between them, so file N+1 is
+    being parsed while file N is embedding. Returns the files that failed, mapped to their error.
+
+    Chunking is lazy: the chunk stage hands over a generator and the embed stage pulls chunks from it in groups,
+    so a file's chunks are never all held at once. Each embedded group goes on to the index stage by itself,
+    so neither are its vectors. chunk_length sizes chunks (len, or chunker.token_length()).
+
+    PDFs of more than stream_over pages go through the stages page_batch pages at a time, so memory stays
+    bounded by a few ranges and the first pages are searchable while the rest are still being converted.
+
+    Groups are indexed in file (page) order. A new file's groups are searchable as soon as each is indexed, and
+    if the file fails part way the groups already in are taken out again. A re-uploaded file's groups are held
+    back and swapped in for the old copy in one replace once the last one is embedded, so queries never see
+    both copies (or a partial new one) side by side; if it fails the old copy is simply left as it was.
+    Progress is still reported per file.
+    """
+    errors: dict[str, Exception] = {}
+    to_parse, to_chunk, to_embed, to_index = (asyncio.Queue(maxsize=queue_size) for _ in range(4))
+    pieces: dict[str, int] = {} # file -> page ranges it was split into
+    reported: dict[tuple[str, str, str], int] = {}
+    waiting: dict[str, dict[tuple[int, int], list[dict] | None]] = {} # file -> groups that came in early
+    indexed: dict[str, tuple[int, int]] = {} # file -> (range, group) it's due to index next
+    staged: dict[str, tuple[set[int], set[int]]] = {} # file -> (old copy's ids, ids indexed so far)
+    held: dict[str, list[dict]] = {} # re-uploaded file -> its embedded chunks, indexed in one go at the end
+
+    def progress(file_name: str, stage: str, status: str):
+        # a split file reports a stage started on its first range and done on its last; do_index reports its own done
+        if on_progress is None or (stage, status) == ('index', 'done'):
+            return
+        seen = reported[file_name, stage, status] = reported.get((file_name, stage, status), 0) + 1
+        if status == 'error' or seen == (1 if status == 'started' else pieces.get(file_name, 1)):
+            on_progress(file_name, stage, status)
+
+    def in_order(fn):
+        # payloads travel as (seq, payload), seq being a page range's place in its file (0 for a whole file)
+        async def run(file_name: str, piece: tuple[int, object]):
+            seq, payload = piece
+            return seq, await fn(file_name, payload)
+        return run
+
+    async def do_parse(file_name: str, source: Path | tuple[Path, tuple[int, int], str]) -> str:
+        if isinstance(source, Path):
+            return f'NEW BOOK: {await parse(source, use_ocr)}'
+        path, page_range, file_hash = source
+        text = await parse(path, use_ocr, file_hash, page_range)
+        return f'NEW BOOK: {text}' if page_range[0] == 1 else text
+
+    async def do_chunk(file_name: str, text: str) -> Iterator[str]:
+        return iter_chunks(text, CHUNK_SIZE, CHUNK_OVERLAP, length_function=chunk_length)
+
+    async def do_embed(file_name: str, piece: tuple[int, Iterator[str]]) -> AsyncIterator[tuple]:
+        # (range, group, embedded) per group of chunks, then (range, groups, None) to mark the range's end
+        seq, chunks = piece
+        group = 0
+        async for embedded in iter_embedded(chunks, method=embed_method, id=username,
+                                            metadata={"file_name": file_name}, embedder=faiss_agent.embedder):
+            yield seq, group, embedded
+            group += 1
+        yield seq, group, None
+
+    async def do_index(file_name: str, item: tuple[int, int, list[dict] | None]):
+        # ranges can finish embedding out of order; hold the early groups so ids (and merge_passages) follow the pages
+        seq, group, embedded = item
+        waiting.setdefault(file_name, {})[seq, group] = embedded
+        if file_name not in staged:
+            staged[file_name] = (await asyncio.to_thread(faiss_agent.file_ids, username, file_name), set())
+            if staged[file_name][0]:
+                held[file_name] = []
+        old, new = staged[file_name]
+        while (due := indexed.get(file_name, (0, 0))) in waiting[file_name]:
+            embedded = waiting[file_name].pop(due)
+            if embedded is None: # that range is done, on to the next one
+                indexed[file_name] = (due[0] + 1, 0)
+                continue
+            if file_name in held:
+                held[file_name].extend(embedded)
+            else:
+                # fsyncs, snapshots and (with a RetrievalClient) a socket round trip: off the loop, which also
+                # serves queries
+                await asyncio.to_thread(faiss_agent.add_embedded, username, embedded)
+                new.update(info['id'] for info in embedded)
+            indexed[file_name] = (due[0], due[1] + 1)
+
+        if indexed.get(file_name) == (pieces.get(file_name, 1), 0): # all in
+            del staged[file_name], waiting[file_name], indexed[file_name]
+            if file_name in held: # the old copy goes and the new one comes in in the same step
+                await asyncio.to_thread(faiss_agent.add_embedded, username, held.pop(file_name),
+                                        replace_file=file_name)
+            if on_progress:
+                on_progress(file_name, 'index', 'done')
+
+    async def feed():
+        for file_name, path in files:
+            try:
+                pages = await asyncio.to_thread(page_count, Path(path))
+            except Exception: # unreadable, let the parse stage report it
+                pages = None
+            if not pages or pages <= stream_over:
+                await to_parse.put((file_name, (0, path)))
+                continue
+            file_hash = await asyncio.to_thread(file_digest, Path(path)) # once, not per range
+            pieces[file_name] = (pages + page_batch - 1) // page_batch
+            for seq, first in enumerate(range(1, pages + 1, page_batch)):
+                page_range = (first, min(first + page_batch - 1, pages))
+                await to_parse.put((file_name, (seq, (Path(path), page_range, file_hash))))
+        await to_parse.put(_DONE)
+
+    with tracer.context(user=username):
+        try:
+            await asyncio.gather(
+                feed(),
+                _run_stage('parse', parse_workers, to_parse, to_chunk, in_order(do_parse), errors, progress),
+                _run_stage('chunk', 1, to_chunk, to_embed, in_order(do_chunk), errors, progress),
+                _run_stage('embed', embed_workers, to_embed, to_index, do_embed, errors, progress),
+                _run_stage('index', 1, to_index, None, do_index, errors, progress),
+            )
+        finally:
+            # a file that failed (or was cancelled) part way: back its indexed groups out, the old copy is untouched
+            for file_name, (old, new) in staged.items():
+                if not new: # nothing of it was indexed (a re-upload is only ever indexed whole)
+                    continue
+                try:
+                    await asyncio.to_thread(faiss_agent.drop_ids, username, file_name, new - old)
+                except Exception as e:
+                    logger.error(f"Couldn't roll back the partial upload of {file_name}: {e}")
+    return errors
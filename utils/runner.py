@@ -0,0 +1,79 @@
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import AsyncIterator, Awaitable, Iterator, TypeVar
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+
+async def _await(awaitable: Awaitable[T]) -> T:
+    return await awaitable
+
+
+class AsyncRunner():
+    """
+    One long-lived event loop on a daemon thread, shared by every Streamlit session and rerun. Async clients
+    made on it (the httpx pools behind AsyncGroq and genai's .aio) stay bound to it, so keep-alive connections
+    and TLS sessions carry over from one request to the next instead of dying with a per-call asyncio.run loop.
+
+    run() blocks the calling thread until the coroutine is done, submit() doesn't; both are thread safe and
+    the coroutine sees the caller's contextvars (tracer.context and friends).
+    """
+
+    def __init__(self, name: str = 'chandra-loop'):
+        self.name = name
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._thread: threading.Thread | None = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        # started on first use, so importing utils doesn't spawn threads
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name=self.name)
+                self._thread.start()
+            return self._loop
+
+    def submit(self, coro: Awaitable[T]) -> concurrent.futures.Future[T]:
+        if not asyncio.iscoroutine(coro): # e.g. anext() / aclose() awaitables
+            coro = _await(coro)
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro: Awaitable[T], timeout: float | None = None) -> T:
+        if threading.current_thread() is self._thread:
+            raise RuntimeError("AsyncRunner.run called from its own loop, await the coroutine instead")
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except (concurrent.futures.TimeoutError, KeyboardInterrupt):
+            future.cancel()
+            raise
+
+    def iterate(self, stream: AsyncIterator[T]) -> Iterator[T]:
+        """A sync iterator over an async generator driven on the loop, e.g. for st.write_stream."""
+        try:
+            while True:
+                try:
+                    yield self.run(anext(stream))
+                except StopAsyncIteration:
+                    return
+        finally:
+            aclose = getattr(stream, 'aclose', None)
+            if aclose is not None:
+                self.run(aclose())
+
+    def stop(self):
+        with self._lock:
+            if self._loop is not None and not self._loop.is_closed():
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+            self._loop = self._thread = None
+
+
+runner = AsyncRunner()
@@ -0,0 +1,187 @@
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# seconds, Prometheus style (cumulative, +Inf implied)
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# attributes every span inside a `tracer.context(...)` block inherits (user, file, ...)
+_context: contextvars.ContextVar[dict] = contextvars.ContextVar('trace_context', default={})
+
+
+class _Histogram():
+    __slots__ = ('counts', 'count', 'sum')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.sum += seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.counts[i] += 1
+                break
+
+
+class _Span():
+    __slots__ = ('tracer', 'name', 'attrs', 'start')
+
+    def __init__(self, tracer: 'Tracer', name: str, attrs: dict):
+        self.tracer, self.name, self.attrs = tracer, name, attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.tracer.record(self.name, time.perf_counter() - self.start, self.attrs)
+
+
+class _NoopSpan():
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+class Tracer():
+    """
+    Timed spans around the request path stages, aggregated into per stage latency histograms plus a ring
+    buffer of the most recent spans with all their attributes (user included: it's left out of the histograms,
+    one series per user would grow the exported metrics without bound).
+
+    Disabled (the default) `span` hands back a shared no-op, so instrumented code costs one attribute check.
+    Export as Prometheus text or JSON: `prometheus()` / `snapshot()`, `export(path)` or `serve(port)`.
+    """
+
+    def __init__(self, enabled: bool = False, recent: int = 2000):
+        self.enabled = enabled
+        self._histograms: dict[str, _Histogram] = {}
+        self._recent: deque[dict] = deque(maxlen=recent)
+        self._lock = threading.Lock()
+        self._server = None
+
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            return _NOOP
+        return _Span(self, name, {**_context.get(), **attrs})
+
+    @contextmanager
+    def context(self, **attrs):
+        token = _context.set({**_context.get(), **attrs})
+        try:
+            yield
+        finally:
+            _context.reset(token)
+
+    def record(self, name: str, seconds: float, attrs: dict | None = None):
+        """Adds an already measured duration, for stages that aren't one block of code (e.g. time to first token)."""
+        if not self.enabled:
+            return
+        attrs = {**_context.get(), **(attrs or {})}
+        with self._lock:
+            if name not in self._histograms:
+                self._histograms[name] = _Histogram()
+            self._histograms[name].observe(seconds)
+            self._recent.append({'name': name, 'seconds': seconds, 'at': time.time(), **attrs})
+
+    def recent(self, limit: int | None = None) -> list[dict]:
+        with self._lock:
+            spans = list(self._recent)
+        return spans[-limit:] if limit else spans
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._recent.clear()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {'histograms': [{'name': name, 'count': h.count, 'sum': h.sum,
+                                    'buckets': dict(zip(map(str, BUCKETS), h.counts))}
+                                   for name, h in sorted(self._histograms.items())],
+                    'recent': list(self._recent)}
+
+    def prometheus(self) -> str:
+        lines = ['# HELP chandra_stage_seconds Time spent per request path stage',
+                 '# TYPE chandra_stage_seconds histogram']
+        with self._lock:
+            for name, h in sorted(self._histograms.items()):
+                labels = f'stage="{_escape(name)}"'
+                cumulative = 0
+                for bound, count in zip(BUCKETS, h.counts):
+                    cumulative += count
+                    lines.append(f'chandra_stage_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'chandra_stage_seconds_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f'chandra_stage_seconds_sum{{{labels}}} {h.sum}')
+                lines.append(f'chandra_stage_seconds_count{{{labels}}} {h.count}')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, path: str | Path):
+        """Writes prometheus text (for a node exporter textfile collector) or JSON, by the file's suffix."""
+        path = Path(path)
+        data = json.dumps(self.snapshot(), default=str) if path.suffix == '.json' else self.prometheus()
+        tmp = path.with_suffix(path.suffix + '.tmp')
+        tmp.write_text(data)
+        os.replace(tmp, path)
+
+    def serve(self, port: int, host: str = '127.0.0.1'):
+        """Serves /metrics (prometheus text) and /spans (JSON) from a daemon thread, once per process."""
+        if self._server is not None:
+            return
+        tracer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.startswith('/metrics'):
+                    body, kind = tracer.prometheus().encode(), 'text/plain; version=0.0.4'
+                elif self.path.startswith('/spans'):
+                    body, kind = json.dumps(tracer.snapshot(), default=str).encode(), 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', kind)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self._server.serve_forever, daemon=True, name='trace-metrics').start()
+        logger.info(f"Serving trace metrics on http://{host}:{port}/metrics")
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+tracer = Tracer(enabled=os.environ.get('CHANDRA_TRACING', '').strip().lower() not in ('', '0', 'false', 'no', 'off'))
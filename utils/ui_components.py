@@ -1,9 +1,10 @@
 import streamlit as st
 import streamlit.components.v1 as components
-import base64
-import asyncio
 import textwrap
-from .utils import transcribe
+import time
+import numpy as np
+from .audio import GAP, transcribe_stream
+from .runner import runner
 
 def apply_premium_theme():
     base_css = textwrap.dedent("""
@@ -148,14 +149,76 @@ def render_unified_input():
         user_input = chat_input
     elif 'temp_voice_input' in st.session_state:
         user_input = st.session_state.pop('temp_voice_input')
+        if gaps := st.session_state.pop('temp_voice_gaps', 0):
+            st.warning(f"{gaps} part(s) of the recording couldn't be transcribed and show up as {GAP}.")
     elif audio_file:
-        with st.spinner(""):
-            audio_bytes = audio_file.read()
-            base64_audio = base64.b64encode(audio_bytes).decode()
-            transcribed_text = asyncio.run(transcribe(base64_audio))
-            if transcribed_text:
-                st.session_state.temp_voice_input = transcribed_text
-                st.session_state.audio_key += 1
-                st.rerun()
+        # raw wav bytes straight to the transcriber; segments show up as they come back
+        placeholder = st.empty()
+        transcribed_text, gaps = "", 0
+        try:
+            with st.spinner(""):
+                for text in runner.iterate(transcribe_stream(audio_file.getvalue())):
+                    gaps += text is None
+                    transcribed_text = f"{transcribed_text} {GAP if text is None else text}".strip()
+                    placeholder.markdown(f"🎙️ {transcribed_text} ▌")
+        except Exception as e:
+            placeholder.empty()
+            st.error(f"Couldn't transcribe the recording: {e}")
+            return user_input
+        if transcribed_text:
+            st.session_state.temp_voice_input = transcribed_text
+            st.session_state.temp_voice_gaps = gaps
+            st.session_state.audio_key += 1
+            st.rerun()
+        placeholder.empty()
                 
     return user_input
+
+def render_ingest_jobs(queue, username: str, limit: int = 10, recent: float = 600.0):
+    # background ingestion status: active jobs plus those that finished in the last `recent` seconds
+    def shown():
+        return [job for job in queue.jobs(username, limit) if job.active or time.time() - job.updated < recent]
+
+    # only poll (rerun this fragment, not the whole app) while something is queued or running
+    polling = any(job.active for job in shown())
+
+    @st.fragment(run_every=1.0 if polling else None)
+    def panel():
+        jobs = shown()
+        for job in jobs:
+            if job.active:
+                cols = st.columns([6, 1])
+                cols[0].progress(job.progress, text=f"{job.file_name}: {job.stage or 'waiting'} ({job.status})")
+                if cols[1].button("Cancel", key=f"cancel_{job.id}"):
+                    queue.cancel(job.id)
+            elif job.status == 'error':
+                st.error(f"Error processing {job.file_name}: {job.error}")
+            elif job.status == 'done':
+                st.caption(f"✅ {job.file_name} indexed")
+            else:
+                st.caption(f"{job.file_name}: {job.status}")
+        if polling and not any(job.active for job in jobs):
+            st.rerun() # all finished, stop polling
+
+    panel()
+
+def render_trace_panel(tracer, limit: int = 500):
+    # developer panel: per stage latency over the most recent spans, and the last few spans themselves
+    with st.sidebar.expander("Latency by stage", expanded=False):
+        spans = tracer.recent(limit)
+        if not spans:
+            st.caption("No spans recorded yet.")
+            return
+
+        by_stage = {}
+        for span in spans:
+            by_stage.setdefault(span['name'], []).append(span['seconds'] * 1000)
+        st.dataframe([{"stage": name, "count": len(ms), "p50 ms": round(float(np.percentile(ms, 50)), 1),
+                       "p95 ms": round(float(np.percentile(ms, 95)), 1), "max ms": round(max(ms), 1)}
+                      for name, ms in sorted(by_stage.items())], hide_index=True)
+
+        st.caption("Last spans")
+        st.dataframe([{k: v for k, v in span.items() if k != 'at'} for span in reversed(spans[-20:])], hide_index=True)
+        st.download_button("Prometheus metrics", tracer.prometheus(), file_name="chandra_metrics.prom")
+        if st.button("Reset traces"):
+            tracer.reset()
@@ -1,9 +1,10 @@
+import functools
 import hashlib 
-import base64
-import os
 import uuid, asyncio
 import streamlit as st, re, json
-import tempfile
+import threading
+import time
+import weakref
 from google import genai
 from google.genai import types
 from googleapiclient.discovery import build
@@ -12,8 +13,13 @@ from groq import AsyncGroq
 from datetime import datetime
 import logging
 import warnings
-import tqdm
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+from itertools import islice
+from typing import AsyncIterator, Iterable
+from .chunker import iter_chunks
+from .cache import EmbeddingCache
+from .embed_engine import EmbeddingEngine
+from .embedders import Embedder, HashingEmbedder, LocalModelEmbedder
+from .tracing import tracer
 
 warnings.filterwarnings("ignore")
 
@@ -25,13 +31,69 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
-GROQ_API_KEY =st.secrets["general"]["GROQ_API_KEY"]
-groq_client = AsyncGroq(api_key= GROQ_API_KEY)
-cx = st.secrets["general"]["CX"] 
-google_search_key = st.secrets["general"]["GOOGLE_SEARCH"]
+_MISSING = object()
 
-GOOGLE_API_KEY = st.secrets["general"]["GOOGLE_API_KEY"]
-gemini_client = genai.Client(api_key= GOOGLE_API_KEY)
+def secret(key: str, default=_MISSING):
+    """st.secrets["general"][key], read only when something needs it so importing utils needs no secrets file."""
+    try:
+        return st.secrets["general"][key]
+    except (KeyError, FileNotFoundError): # FileNotFoundError: no secrets.toml at all
+        if default is _MISSING:
+            raise
+        return default
+
+def as_bool(value) -> bool:
+    """A secrets/env flag: TOML booleans as they are, strings by what they say (so "false" is False)."""
+    if isinstance(value, str):
+        return value.strip().lower() not in ('', '0', 'false', 'no', 'off')
+    return bool(value)
+
+class _NoLoop():
+    pass
+
+_NO_LOOP = _NoLoop()
+
+def _per_loop(factory):
+    """
+    One client per event loop: async http pools belong to the loop they were first used on. In the app that
+    is always runner's loop, so there is exactly one of each and its connections stay warm.
+    """
+    clients = weakref.WeakKeyDictionary()
+    lock = threading.Lock()
+
+    @functools.wraps(factory)
+    def get():
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError: # sync callers share one
+            loop = _NO_LOOP
+        with lock:
+            if loop not in clients:
+                clients[loop] = factory()
+            return clients[loop]
+    return get
+
+# API clients are created on first use; benchmarks and tests pass their own instead
+@_per_loop
+def get_groq_client() -> AsyncGroq:
+    return AsyncGroq(api_key= secret("GROQ_API_KEY"))
+
+@_per_loop
+def get_gemini_client() -> genai.Client:
+    return genai.Client(api_key= secret("GOOGLE_API_KEY"))
+
+EMBED_DIM = 768
+# re-uploads and repeated questions hit this instead of the embedding API; opened on first use (see
+# get_embedding_cache), so importing utils creates no sqlite file. Benchmarks and tests can set their own
+embedding_cache: EmbeddingCache | None = None
+_embedding_cache_lock = threading.Lock()
+
+def get_embedding_cache() -> EmbeddingCache:
+    global embedding_cache
+    with _embedding_cache_lock:
+        if embedding_cache is None:
+            embedding_cache = EmbeddingCache(secret("EMBED_CACHE_PATH", ".cache/embeddings.sqlite"))
+        return embedding_cache
 
 tools = [
         {
@@ -39,14 +101,53 @@ tools = [
         }
     ]
 
-def embedder(model:str, content:str|list[str], method:str):
-    return gemini_client.models.embed_content(
-    model=model,
-    contents=content,
-    config=types.EmbedContentConfig(task_type=method, 
-                                    output_dimensionality= 768))
+async def gemini_embed(content: list[str], method: str, model: str = "models/gemini-embedding-001",
+                       dimension: int = EMBED_DIM) -> list[list[float]]:
+    response = await get_gemini_client().aio.models.embed_content(
+        model=model,
+        contents=content,
+        config=types.EmbedContentConfig(task_type=method, 
+                                        output_dimensionality= dimension))
+    return [embedding.values for embedding in response.embeddings]
+
+# concurrency and request rate are tuned to the Gemini embedding quota, override them in secrets
+embedding_engine = EmbeddingEngine(
+    gemini_embed,
+    batch_size=10,
+    max_in_flight=int(secret("EMBED_MAX_IN_FLIGHT", 8)),
+    requests_per_minute=float(secret("EMBED_REQUESTS_PER_MINUTE", 1500)),
+)
+
+class GeminiEmbedder():
+    """Gemini embeddings (the Embedder protocol) through the shared embedding_engine."""
+    metric = 'l2' # gemini vectors below 3072 dims aren't unit length, and indexes have always searched them raw
+    cacheable = True
+
+    def __init__(self, model: str = "models/gemini-embedding-001", dimension: int = EMBED_DIM):
+        self.name = model
+        self.dimension = dimension
+
+    async def embed(self, texts: list[str], method: str, batch_size: int | None = None, **kwargs) -> list[list[float]]:
+        return await embedding_engine.embed(texts, method, batch_size, model=self.name, dimension=self.dimension)
+
+@functools.cache
+def default_embedder() -> GeminiEmbedder:
+    return GeminiEmbedder()
+
+def get_embedder(spec: str | None = None) -> Embedder:
+    """'gemini[:model]', 'hashing[:dimension]' or 'local:<path to weights>'; EMBEDDER in secrets when not given."""
+    spec = spec or secret("EMBEDDER", "gemini")
+    kind, _, arg = spec.partition(':')
+    if kind == 'gemini':
+        return GeminiEmbedder(arg) if arg else default_embedder()
+    if kind == 'hashing':
+        return HashingEmbedder(int(arg) if arg else EMBED_DIM)
+    if kind == 'local':
+        return LocalModelEmbedder(arg)
+    raise ValueError(f"Unknown embedder {spec!r}, expected gemini[:model], hashing[:dimension] or local:<path>")
         
-async def groq_generate(query: str, relevant_passage: str|list[str] = None, max_tokens: int=4096):
+async def groq_generate(query: str, relevant_passage: str|list[str] = None, max_tokens: int=4096,
+                        client: AsyncGroq | None = None):
     idx = query.index("Current Query:")
     logger.info(query[idx + 14: ].strip())
 
@@ -89,8 +190,10 @@ async def groq_generate(query: str, relevant_passage: str|list[str] = None, max_
                 {"role": "system", "content": sys_instructions},
                 {"role": "user", "content": PROMPT_TEMPLATE}]
     
+    start = time.perf_counter()
+    first_token = None
     try:
-        completion = await groq_client.chat.completions.create(
+        completion = await (client or get_groq_client()).chat.completions.create(
             model='openai/gpt-oss-20b',
             messages=messages,
             tools=tools,
@@ -103,105 +206,85 @@ async def groq_generate(query: str, relevant_passage: str|list[str] = None, max_
 
         async for chunk in completion:
             if data := chunk.choices[0].delta.content:
+                if first_token is None:
+                    first_token = time.perf_counter()
+                    tracer.record('llm.ttft', first_token - start)
                 processed_text = re.split(r"</think>\s*", data, maxsplit=1)[-1]
                 yield processed_text
+        tracer.record('llm.stream', time.perf_counter() - (first_token or start))
 
     except Exception as e:
         logger.error(str(e))
         raise RuntimeError(f"Error generating completion: {e}") from e
 
 async def batch_embed_text(texts: str|list[str], batch_size=10, *, method: str = 'semantic_similarity', 
-                     model_name="models/gemini-embedding-001", metadata: dict = {}, id=None):
-    
-    config = []
+                     model_name: str | None = None, metadata: dict = {}, id=None, embedder: Embedder | None = None):
     
     # in this case.. one string, make it a list to be looped through
     if isinstance(texts, str):
         texts = [texts]
+    embedder = embedder or (GeminiEmbedder(model_name) if model_name else default_embedder())
+
+    with tracer.span('embed', texts=len(texts), method=method, embedder=embedder.name) as span:
+        if not embedder.cacheable: # cheaper to recompute than to look up
+            values = list(await embedder.embed(texts, method, batch_size=batch_size))
+        else:
+            cache = await asyncio.to_thread(get_embedding_cache) # the first call opens (and maybe creates) it
+            keys = [cache.key(embedder.name, method, embedder.dimension, text) for text in texts]
+            # sqlite behind the memory LRU, and shared with the other sessions: off the loop
+            vectors = await asyncio.to_thread(cache.get_many, keys)
+
+            # only texts we have never embedded with this model/method go over the wire
+            misses = list({key: text for key, text in zip(keys, texts) if key not in vectors}.items())
+            span.set(cache_misses=len(misses))
+            if misses:
+                embedded = await embedder.embed([text for _, text in misses], method, batch_size=batch_size)
+                fresh = {key: values for (key, _), values in zip(misses, embedded)}
+                await asyncio.to_thread(cache.put_many, fresh)
+                vectors.update(fresh)
+            values = [vectors[key] for key in keys]
 
-    for batch_start in tqdm.tqdm(range(0, len(texts), batch_size)):
-        size = min(len(texts) - batch_start, batch_size)
-        batch_texts = texts[batch_start:batch_start+size]
-        response = embedder(model = model_name, content = batch_texts, method = method)
-        data =  [
+    config =  [
         {
-                "id": str(uuid.uuid4()),
-                "values": embedding.values,
-                "metadata": {
-                    "text": batch_texts[i], 
-                    'user_id': id,
-                    **(metadata)
-                }
+            "id": str(uuid.uuid4()),
+            "values": vector,
+            "metadata": {
+                "text": text, 
+                'user_id': id,
+                **(metadata)
             }
-        for i, embedding in enumerate(response.embeddings)
-        ]
-        config.extend(data)
+        }
+        for vector, text in zip(values, texts)
+    ]
     return config
 
-async def langchain_chunk(text: str, size:int, overlap:int) -> list[str]:
-    text_splitter = RecursiveCharacterTextSplitter(
-        separators=["\n\n", "\n", " ", "", '.', "NEW BOOK: "],  
-        is_separator_regex= True,    
-        chunk_size=size,
-        chunk_overlap=overlap,
-        length_function=len,
-    )
-
-    chunks = text_splitter.split_text(text)
-    clean_single_chunk = lambda x: x.replace('\n\n', '').replace('\n', '').replace('  ', '')
-    chunks = await asyncio.gather(*[asyncio.to_thread(clean_single_chunk, chunk) for chunk in chunks])
-    return chunks
-
-async def save_audio_from_base64(base64_string: str, file_format: str = "wav"):
-    base64_cleaned = base64_string.strip().replace("\n", "").replace("\r", "")
-    try:
-        with tempfile.NamedTemporaryFile(suffix=f".{file_format}", delete=False) as tmp:
-            output_file_path = tmp.name
-            audio_bytes = base64.b64decode(base64_cleaned)
-            tmp.write(audio_bytes)
-        
-        logger.info(f"Audio decoded and saved successfully to {output_file_path}")
-        return output_file_path
-    except Exception as e:
-        logger.error(f"Failed to decode audio: {e}")
-        return None
+async def iter_embedded(chunks: Iterable[str], group_size: int = 256, **kwargs) -> AsyncIterator[list[dict]]:
+    """
+    batch_embed_text over a (lazy) stream of chunks, pulled group_size at a time, so the chunks are produced
+    while earlier groups are embedding instead of all being split up front. Yields each group's embedded
+    dicts as soon as they're ready, so the caller only holds the file one group at a time. kwargs go to
+    batch_embed_text.
+    """
+    chunks = iter(chunks)
 
-stt_prompt = """ 
-You are a highly accurate AI transcription assistant. Your task is to convert spoken language into clean, readable text.
+    def take():
+        with tracer.span('chunk') as span: # the splitting itself happens here, as the generator is pulled
+            group = list(islice(chunks, group_size))
+            span.set(chunks=len(group))
+            return group
 
-Guidelines:
-- Transcribe the spoken input word-for-word, preserving the speaker’s intent.
-- Correct minor grammatical issues only if necessary for clarity.
-- Do not add or omit any information.
-- Use punctuation to make the transcription easier to read (e.g., commas, periods).
-- If the speaker hesitates or repeats a word, clean it up unless it changes the meaning.
-- Avoid inserting labels like "um", "uh", unless they’re contextually important.
-
-Context:
-The following audio was captured as part of a user request. Your job is to return the most accurate, raw readable transcript possible.
-"""
-
-async def convert_audio_to_text(audio_file_path: str) -> str:
-    try:
-        with open(audio_file_path, "rb") as file:
-            transcription = await groq_client.audio.transcriptions.create(
-                file=(os.path.basename(audio_file_path), file.read()),
-                model="whisper-large-v3-turbo",
-                response_format="text",
-                prompt=stt_prompt
-            )
-        return transcription
-    except Exception as e:
-        logger.error(f"Error during Groq transcription: {e}")
-        return ""
-
-async def transcribe(base64_audio: str):
-    audio_path = await save_audio_from_base64(base64_audio)
-    if not audio_path:
-        return None
+    # one thread handoff per group for the splitting (not one per chunk), the next group splits while this one embeds
+    upcoming = asyncio.create_task(asyncio.to_thread(take))
     try:
-        transcript = await convert_audio_to_text(audio_path)
+        while group := await upcoming:
+            upcoming = asyncio.create_task(asyncio.to_thread(take))
+            yield await batch_embed_text(group, **kwargs)
     finally:
-        if os.path.exists(audio_path):
-            os.remove(audio_path)
-    return transcript
+        upcoming.cancel()
+
+async def embed_chunks(chunks: Iterable[str], group_size: int = 256, **kwargs) -> list[dict]:
+    """iter_embedded, collected: for callers that need the whole file at once (an atomic replace_doc)."""
+    return [info async for embedded in iter_embedded(chunks, group_size, **kwargs) for info in embedded]
+
+async def langchain_chunk(text: str, size:int, overlap:int) -> list[str]:
+    return await asyncio.to_thread(lambda: list(iter_chunks(text, size, overlap)))